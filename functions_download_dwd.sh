@@ -1,64 +1,36 @@
 #Given a variable name and year-month-day-run as environmental variables download and merges the variable
+# The files are listed and downloaded by plotting/download_dwd.py, which uses one pooled session
+# for the DWD server and decompresses the files while they are being downloaded.
 ################################################
-listurls() {
-	filename="$1"
-	url="$2"
-	wget -qO- $url | grep -Eoi '<a [^>]+>' | \
-	grep -Eo 'href="[^\"]+"' | \
-	grep -Eo $filename | \
-	xargs -I {} echo "$url"{}
+download_dwd() {
+	python3 ${HOME_FOLDER}/plotting/download_dwd.py "$@"
 }
-export -f listurls
-#
-get_and_extract_one() {
-  url="$1"
-  file=`basename $url | sed 's/\.bz2//g'`
-  if [ ! -f "$file" ]; then
-  	wget -t 2 -q -O - "$url" | bzip2 -dc > "$file"
-  fi
+export -f download_dwd
+##############################################
+ingest() {
+	python3 ${HOME_FOLDER}/plotting/ingest.py "$@"
 }
-export -f get_and_extract_one
+export -f ingest
 ##############################################
 download_merge_2d_variable_icon_d2()
 {
-	filename="icon-d2_germany_regular-lat-lon_single-level_${year}${month}${day}${run}_*_2d_${1}.grib2"
-	filename_grep="icon-d2_germany_regular-lat-lon_single-level_${year}${month}${day}${run}_(.*)_2d_${1}.grib2.bz2"
-	url="https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/${1}/"
-	forecast_hours=
-	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
-		listurls $filename_grep $url | parallel -j 10 get_and_extract_one {}
-		docker run --rm --volume .:/data  deutscherwetterdienst/regrid:icon-d2 \
-			cdo --reduce_dim -f nc copy \
-				-seltime,00:00,01:00,02:00,03:00,04:00,05:00,06:00,07:00,08:00,09:00,10:00,11:00,12:00,13:00,14:00,15:00,16:00,17:00,18:00,19:00,20:00,21:00,22:00,23:00 \
-				-mergetime \
-				/data/${filename} /data/${1}_${year}${month}${day}${run}_de.nc
-		rm ${filename}
-	fi
+	# The GRIB2 messages are decoded while downloading and written straight
+	# into the run store icon-d2_${year}${month}${day}${run}.zarr, steps already there are skipped
+	# If CROP_PROJECTIONS is set only the box covering those projections is kept
+	ingest --type 2d ${CROP_PROJECTIONS:+--crop ${CROP_PROJECTIONS}} --variables "$@"
 }
 export -f download_merge_2d_variable_icon_d2
 ##############################################
 download_merge_3d_variable_icon_d2()
 {
-	filename="icon-d2_germany_regular-lat-lon_pressure-level_${year}${month}${day}${run}_*_${1}.grib2"
-	filename_grep="icon-d2_germany_regular-lat-lon_pressure-level_${year}${month}${day}${run}_(.*)_(950|850|700|500)_${1}.grib2.bz2"
-	url="https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/${1}/"
-	if [ ! -f "${1}_${year}${month}${day}${run}_de.nc" ]; then
-		listurls $filename_grep $url | parallel -j 10 get_and_extract_one {}
-		cdo merge ${filename} ${1}_${year}${month}${day}${run}_de.grib2
-		rm ${filename}
-		cdo -f nc copy -seltime,00:00,01:00,02:00,03:00,04:00,05:00,06:00,07:00,08:00,09:00,10:00,11:00,12:00,13:00,14:00,15:00,16:00,17:00,18:00,19:00,20:00,21:00,22:00,23:00 ${1}_${year}${month}${day}${run}_de.grib2 ${1}_${year}${month}${day}${run}_de.nc
-		rm ${1}_${year}${month}${day}${run}_de.grib2
-	fi
+	# Every (step, level) file is decoded while downloading and written in its slot
+	# of the (time, plev, lat, lon) arrays of the run store, all levels in parallel
+	ingest --type 3d --levels 950 850 700 500 ${CROP_PROJECTIONS:+--crop ${CROP_PROJECTIONS}} --variables "$@"
 }
 export -f download_merge_3d_variable_icon_d2
 ################################################
 download_invariant_icon_d2()
 {
-	filename="icon-d2_germany_regular-lat-lon_time-invariant_${year}${month}${day}${run}_000_0_hsurf.grib2"
-	wget -r -nH -np -nv -nd --reject "index.html*" --cut-dirs=3 -A "${filename}.bz2" "https://opendata.dwd.de/weather/nwp/icon-d2/grib/${run}/hsurf/"
-	bzip2 -d ${filename}.bz2 
-	docker run --rm --volume ./data:/data    deutscherwetterdienst/regrid:icon-d2 \
-		cdo -f nc copy /data/${filename} /data/HSURF_${year}${month}${day}${run}_de.nc
-	rm ${filename}
+	ingest --type invariant ${CROP_PROJECTIONS:+--crop ${CROP_PROJECTIONS}} --variables hsurf
 }
 export -f download_invariant_icon_d2
@@ -1,21 +1,13 @@
 from datetime import datetime, timedelta
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import codecs
+import json
+import os
+from html.parser import HTMLParser
+import aiohttp
 import pandas as pd
 import argparse
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', '--run', help='Run to search for, otherwise defaults to all runs available for the model',
-                    required=False, default=None)
-parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be checked',
-                    required=False, default=None, nargs='+')
-parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checked',
-                    required=False, default=['t'], nargs='+')
-parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
-                    required=False, default=['850'], nargs='+')
-
-args = parser.parse_args()
+import sys
 
 var_2d_list = ['alb_rad', 'alhfl_s', 'ashfl_s', 'asob_s', 'asob_t', 'aswdifd_s', 'aswdifu_s',
                'aswdir_s', 'athb_s', 'cape_ml', 'cin_ml', 'clch', 'clcl', 'clcm', 'clct',
@@ -28,134 +20,268 @@ var_2d_list = ['alb_rad', 'alhfl_s', 'ashfl_s', 'asob_s', 'asob_t', 'aswdifd_s',
 var_3d_list = ['clc', 'fi', 'omega', 'p',
                'qv', 'relhum', 't', 'tke', 'u', 'v', 'w']
 
+f_times = list(range(0, 49))
+all_runs = ['00', '03', '06', '09', '12', '15', '18', '21']
+# Maximum number of open (keep-alive) connections to the server
+concurrency = 10
+chunk_size = 2 ** 14
 
-def get_url_paths(url, ext='', prefix='', params={}):
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
-    else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a') if (
-        node.get('href').endswith(ext)) & (node.get('href').startswith(prefix))]
-    return parent
+if 'MODEL_DATA_FOLDER' in os.environ:
+    data_folder = os.environ['MODEL_DATA_FOLDER']
+else:
+    data_folder = '.'
+# Listings already downloaded, so that the server is only asked whether they changed
+cache_file = os.path.join(data_folder, 'listing_cache.json')
+last_processed_file = os.path.join(data_folder, 'last_processed_run.txt')
 
 
-def find_file_name(vars_2d=None,
-                   vars_3d=None,
-                   levels_3d=None,
-                   base_url="https://opendata.dwd.de/weather/nwp",
-                   model_url="icon-d2-eps/grib",
-                   date_string=None,
-                   run_string=None):
+class ListingError(Exception):
+    """Some listings could not be downloaded, failures is {url: exception}"""
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('listing of %d folder(s) failed: %s' % (
+            len(failures), ', '.join('%s (%s)' % (url, e) for url, e in failures.items())))
+
 
-    f_times = list(range(0, 49))
+class LinkParser(HTMLParser):
+    """Collect the href of all links of an HTML page fed chunk by chunk"""
+    def __init__(self, ext='', prefix=''):
+        super().__init__()
+        self.ext, self.prefix = ext, prefix
+        self.hrefs = []
 
-    #
-    if type(f_times) is not list:
-        f_times = [f_times]
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        href = dict(attrs).get('href')
+        if href and href.endswith(self.ext) and href.startswith(self.prefix):
+            self.hrefs.append(href)
+
+
+def load_cache(filename=cache_file):
+    """Cached listings {url: {'etag', 'last_modified', 'hrefs'}}"""
+    if filename and os.path.isfile(filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return {}
+
+
+def save_cache(cache, filename=cache_file):
+    if not filename:
+        return
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(filename + '.tmp', filename)
+
+
+async def get_url_paths(session, url, ext='', prefix='', cache=None):
+    """Filenames linked in the listing at url, parsed while the page arrives.
+    If the listing is in cache the server is asked whether it changed
+    (ETag/If-Modified-Since) and the cached one is used if not."""
+    if cache is None:
+        cache = {}
+    headers = {}
+    cached = cache.get(url)
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            hrefs = cached['hrefs']
+        else:
+            response.raise_for_status()
+            parser = LinkParser()
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+            async for chunk in response.content.iter_chunked(chunk_size):
+                parser.feed(decoder.decode(chunk))
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+            hrefs = parser.hrefs
+            cache[url] = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'hrefs': hrefs}
+
+    return [href for href in hrefs if href.endswith(ext) and href.startswith(prefix)]
+
+
+def file_name(var, date_string, run_string, f_time, level='2d',
+              model_url="icon-d2-eps/grib"):
+    """Name of the file of var on the server, level is '2d' for 2d variables"""
+    model = model_url.split('/')[0]
+    if level == '2d':
+        return "%s_germany_icosahedral_single-level_%s%s_%03d_2d_%s.grib2.bz2" % (
+            model, date_string, run_string, f_time, var)
+    return "%s_germany_icosahedral_pressure-level_%s%s_%03d_%s_%s.grib2.bz2" % (
+        model, date_string, run_string, f_time, level, var)
+
+
+def check_variables(vars_2d=None, vars_3d=None, levels_3d=None):
+    """Validate the arguments, returning the list of (variable, level) to check"""
     if (vars_2d is None) and (vars_3d is None):
         raise ValueError(
             'You need to specify at least one 2D or one 3D variable')
-
-    if vars_2d is not None:
-        if type(vars_2d) is not list:
-            vars_2d = [vars_2d]
+    if vars_2d is not None and type(vars_2d) is not list:
+        vars_2d = [vars_2d]
     if vars_3d is not None:
         if levels_3d is None:
             raise ValueError(
                 'When specifying 3d coordinates you also need levels')
         if type(vars_3d) is not list:
             vars_3d = [vars_3d]
-    if levels_3d is not None:
-        if type(levels_3d) is not list:
-            levels_3d = [levels_3d]
+    if levels_3d is not None and type(levels_3d) is not list:
+        levels_3d = [levels_3d]
+    rows = []
+    for var in vars_2d or []:
+        if var not in var_2d_list:
+            raise ValueError('accepted 2d variables are %s' % var_2d_list)
+        rows.append((var, '2d'))
+    for var in vars_3d or []:
+        if var not in var_3d_list:
+            raise ValueError('accepted 3d variables are %s' % var_3d_list)
+        rows += [(var, str(level)) for level in levels_3d]
 
+    return rows
+
+
+async def get_availability_async(runs, vars_2d=None, vars_3d=None, levels_3d=None,
+                                 base_url="https://opendata.dwd.de/weather/nwp",
+                                 model_url="icon-d2-eps/grib", cache=None):
+    """Availability matrices of runs (list of YYYYMMDDHH) as a dictionary
+    {run: DataFrame}, see get_availability. Every listing is only downloaded
+    once, all of them concurrently over the same pooled session. Raises
+    ListingError with the folders whose listing failed."""
+    rows = check_variables(vars_2d, vars_3d, levels_3d)
+    # The folder of every run hour and variable contains the files of the last run with that hour
+    folders = sorted(set((run[-2:], var) for run in runs for var, _ in rows))
+    urls = ["%s/%s/%s/%s/" % (base_url, model_url, hour, var) for hour, var in folders]
+    connector = aiohttp.TCPConnector(limit_per_host=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        listings = await asyncio.gather(*[get_url_paths(session, url, 'grib2.bz2', cache=cache)
+                                          for url in urls], return_exceptions=True)
+    # A failed listing must not look like a folder without files
+    failures = {url: listing for url, listing in zip(urls, listings) if isinstance(listing, Exception)}
+    if failures:
+        raise ListingError(failures)
+    listings = {folder: set(listing) for folder, listing in zip(folders, listings)}
+    matrices = {}
+    for run in runs:
+        data = [[file_name(var, run[:-2], run[-2:], f_time, level, model_url)
+                 in listings[(run[-2:], var)] for f_time in f_times]
+                for var, level in rows]
+        matrices[run] = pd.DataFrame(data, columns=f_times,
+                                     index=pd.MultiIndex.from_tuples(rows, names=['variable', 'level']))
+
+    return matrices
+
+
+def get_availability(runs, vars_2d=None, vars_3d=None, levels_3d=None,
+                     base_url="https://opendata.dwd.de/weather/nwp",
+                     model_url="icon-d2-eps/grib", cache_filename=cache_file):
+    """Return {run: DataFrame} for every run (YYYYMMDDHH) in runs, where the
+    DataFrame has one row for every (variable, level) ('2d' for 2d variables),
+    one column for every forecast step and True where the file is on the server.
+    Raises ListingError if any listing failed."""
+    cache = load_cache(cache_filename)
+    try:
+        matrices = asyncio.run(get_availability_async(runs, vars_2d, vars_3d, levels_3d,
+                                                      base_url, model_url, cache))
+    finally:
+        # Keep the listings that succeeded
+        save_cache(cache, cache_filename)
+
+    return matrices
+
+
+def summarize(run, matrix):
+    """Status of every variable of run given its availability matrix,
+    a step is available when all levels are there."""
     data = {'run': [], 'variable': [], 'status': [],
             'avail_tsteps': [], 'missing_tsteps': []}
-    if vars_2d is not None:
-        for var in vars_2d:
-            if var not in var_2d_list:
-                raise ValueError('accepted 2d variables are %s' % var_2d_list)
-            data['variable'].append(var)
-            data['run'].append('%s%s' % (date_string, run_string))
-            urls_to_check = []
-            for f_time in f_times:
-                var_url = "icon-d2-eps_germany_icosahedral_single-level"
-                urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_2d_%s.grib2.bz2" %
-                                     (base_url, model_url, run_string, var,
-                                      var_url, date_string, run_string, f_time, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
-            if set(urls_to_check).issubset(urls_on_server):
-                data['status'].append('all files available')
-                data['avail_tsteps'].append(len(urls_to_check))
-                data['missing_tsteps'].append(0)
-            else:
-                intersection = set(urls_to_check).intersection(
-                    set(urls_on_server))
-                data['status'].append('incomplete')
-                data['avail_tsteps'].append(len(intersection))
-                data['missing_tsteps'].append(len(f_times) - len(intersection))
+    steps = matrix.groupby(level='variable', sort=False).all()
+    for var, avail in steps.iterrows():
+        data['run'].append(run)
+        data['variable'].append(var)
+        data['status'].append('all files available' if avail.all() else 'incomplete')
+        data['avail_tsteps'].append(int(avail.sum()))
+        data['missing_tsteps'].append(int((~avail).sum()))
 
-    if vars_3d is not None:
-        for var in vars_3d:
-            if var not in var_3d_list:
-                raise ValueError('accepted 3d variables are %s' % var_3d_list)
-            data['variable'].append(var)
-            data['run'].append('%s%s' % (date_string, run_string))
-            urls_to_check = []
-            for plev in levels_3d:
-                for f_time in f_times:
-                    var_url = "icon-d2-eps_germany_icosahedral_pressure-level"
-                    urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_%s_%s.grib2.bz2" %
-                                         (base_url, model_url, run_string, var,
-                                          var_url, date_string, run_string, f_time, plev, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
-            if set(urls_to_check).issubset(urls_on_server):
-                data['status'].append('all files available')
-                data['avail_tsteps'].append(len(urls_to_check))
-                data['missing_tsteps'].append(0)
-            else:
-                intersection = set(urls_to_check).intersection(
-                    set(urls_on_server))
-                data['status'].append('incomplete')
-                data['avail_tsteps'].append(len(intersection))
-                data['missing_tsteps'].append(len(f_times) - len(intersection))
-
-    df = pd.DataFrame(data)
-
-    return df
+    return pd.DataFrame(data)
+
+
+def find_file_name(vars_2d=None,
+                   vars_3d=None,
+                   levels_3d=None,
+                   base_url="https://opendata.dwd.de/weather/nwp",
+                   model_url="icon-d2-eps/grib",
+                   date_string=None,
+                   run_string=None):
+    run = '%s%s' % (date_string, run_string)
+    matrix = get_availability([run], vars_2d, vars_3d, levels_3d,
+                              base_url, model_url)[run]
+
+    return summarize(run, matrix)
+
+
+def read_last_processed(filename=last_processed_file):
+    if filename and os.path.isfile(filename):
+        with open(filename) as f:
+            return f.read().strip()
 
 
 def get_most_recent_run(run=None, vars_2d=None, vars_3d=['t'],
-                        levels_3d=['850']):
+                        levels_3d=['850'], last_processed=None):
+    """Most recent complete run among the ones of today and yesterday.
+    Runs not newer than last_processed (YYYYMMDDHH) are not checked: if none
+    of the newer ones is complete last_processed is returned."""
     today_string = datetime.now().strftime('%Y%m%d')
     yesterday_string = (datetime.today() -
                         timedelta(days=1)).strftime('%Y%m%d')
     if run is None:
-        runs = ['00', '03', '06', '09', '12', '15', '18', '21']
+        runs = all_runs
     else:
         runs = [run]
-    temp = []
-    for date_string in [yesterday_string, today_string]:
-        for run_string in runs:
-            try:
-                temp.append(find_file_name(vars_2d=vars_2d,
-                                           vars_3d=vars_3d,
-                                           levels_3d=levels_3d,
-                                           date_string=date_string,
-                                           run_string=run_string))
-            except:
-                continue
-
-    final = pd.concat(temp)
-    sel_run = final.loc[final.status == 'all files available', 'run'].max()
+    candidates = [date_string + run_string for date_string in [yesterday_string, today_string]
+                  for run_string in runs]
+    if last_processed:
+        candidates = [c for c in candidates if c > last_processed]
+    if not candidates:
+        return pd.DataFrame(), last_processed
+    matrices = get_availability(candidates, vars_2d=vars_2d,
+                                vars_3d=vars_3d, levels_3d=levels_3d)
+    final = pd.concat([summarize(run, matrix) for run, matrix in matrices.items()])
+    complete = final.groupby('run').status.apply(lambda s: (s == 'all files available').all())
+    sel_run = complete[complete].index.max()
+    if pd.isnull(sel_run) and last_processed:
+        sel_run = last_processed
+
     return final, sel_run
 
 
 if __name__ == "__main__":
-    final, sel_run = get_most_recent_run(run=args.run, vars_2d=args.vars_2d,
-                        vars_3d=args.vars_3d, levels_3d=args.levels_3d)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to search for, otherwise defaults to all runs available for the model',
+                        required=False, default=None)
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be checked',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checked',
+                        required=False, default=['t'], nargs='+')
+    parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
+                        required=False, default=['850'], nargs='+')
+    parser.add_argument('--last_processed', help='Runs older than the one in this file are not checked',
+                        required=False, default=last_processed_file)
+
+    args = parser.parse_args()
+
+    try:
+        final, sel_run = get_most_recent_run(run=args.run, vars_2d=args.vars_2d,
+                                             vars_3d=args.vars_3d, levels_3d=args.levels_3d,
+                                             last_processed=read_last_processed(args.last_processed))
+    except ListingError as e:
+        print('ERROR: %s' % e, file=sys.stderr)
+        sys.exit(1)
     print(sel_run)
@@ -1,37 +1,124 @@
+import collections
+import numpy as np
 import metpy.calc as mpcalc
 import xarray as xr
-from metpy.units import units
 import utils
+import thermo
+
+
+# Mean radius of the earth (m), as in metpy.constants.earth_avg_radius
+earth_radius = 6371008.7714
+# Geometry of the lat/lon grids already used, see grid_metrics
+_grid_metrics = {}
+
+
+def grid_metrics(lat, lon):
+    """Coordinates (radians) and map factors of a lat/lon grid, computed once
+    for every grid and kept in memory. The spacing is a scalar for regular grids."""
+    lat, lon = np.asarray(lat, dtype='float64'), np.asarray(lon, dtype='float64')
+    key = (len(lat), lat[0], lat[-1], len(lon), lon[0], lon[-1])
+    if key not in _grid_metrics:
+        phi, lam = np.radians(lat), np.radians(lon)
+        _grid_metrics[key] = {
+            'phi': phi[1] - phi[0] if np.allclose(np.diff(phi), phi[1] - phi[0]) else phi,
+            'lambda': lam[1] - lam[0] if np.allclose(np.diff(lam), lam[1] - lam[0]) else lam,
+            # d/dx = rdx * d/dlambda, d/dy = rdy * d/dphi
+            'rdx': (1. / (earth_radius * np.cos(phi)))[:, None],
+            'rdy': 1. / earth_radius,
+            # Curvature term of the spherical divergence, vorticity and deformation, tan(phi) / R
+            # computed as metpy from the differences of the map factor 1 / cos(phi)
+            'tan_r': (np.cos(phi) * np.gradient(1. / np.cos(phi), phi, edge_order=2) / earth_radius)[:, None],
+        }
+
+    return _grid_metrics[key]
+
+
+def ddx(values, metrics):
+    """d/dx (1/m) of values (..., lat, lon), centred in the interior and
+    second order one-sided at the borders (as metpy)"""
+    return np.gradient(values, metrics['lambda'], axis=-1, edge_order=2) * metrics['rdx']
+
+
+def ddy(values, metrics):
+    """d/dy (1/m) of values (..., lat, lon), centred in the interior and
+    second order one-sided at the borders (as metpy)"""
+    return np.gradient(values, metrics['phi'], axis=-2, edge_order=2) * metrics['rdy']
+
+
+def kinematics(u, v, metrics, scalar=None,
+               fields=('divergence', 'vorticity', 'stretching', 'shearing')):
+    """Divergence, vorticity, stretching and shearing deformation (1/s) of the wind
+    (u, v) on the sphere and, if scalar is given, its horizontal advection
+    (units of scalar per second). Every derivative is computed once and only
+    if one of fields needs it. The derivatives are computed in float64: in float32
+    the one-sided differences at the borders of a field with a large offset
+    (e.g. a temperature in K) lose most of their digits, only the results are float32."""
+    derivatives = {}
+
+    def d(name):
+        if name not in derivatives:
+            var, axis = name[1], name[-1]
+            values = np.asarray({'u': u, 'v': v, 's': scalar}[var], dtype='float64')
+            derivatives[name] = (ddx if axis == 'x' else ddy)(values, metrics)
+        return derivatives[name]
+
+    tan_r = metrics['tan_r']
+    formulas = {
+        'divergence': lambda: d('dudx') + d('dvdy') - v * tan_r,
+        'vorticity': lambda: d('dvdx') - d('dudy') + u * tan_r,
+        'stretching': lambda: d('dudx') - d('dvdy') - v * tan_r,
+        'shearing': lambda: d('dvdx') + d('dudy') + u * tan_r,
+        'advection': lambda: - (u * d('dsdx') + v * d('dsdy')),
+    }
+    if scalar is not None and 'advection' not in fields:
+        fields = tuple(fields) + ('advection',)
+
+    return {name: formulas[name]().astype('float32') for name in fields}
+
+
+def _wind_kinematics(dset, uvar, vvar, fields, svar=None):
+    """kinematics of the wind dset[uvar], dset[vvar] (and of dset[svar]) with
+    lat and lon as last dimensions. Also returns u to build the results."""
+    u = dset[uvar].transpose(..., 'lat', 'lon')
+    v = dset[vvar].transpose(..., 'lat', 'lon').values
+    scalar = dset[svar].transpose(..., 'lat', 'lon').values if svar else None
+    metrics = grid_metrics(dset['lat'].values, dset['lon'].values)
+
+    return kinematics(u.values, v, metrics, scalar, fields), u
 
 
 def compute_convergence(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
-    conv = - mpcalc.divergence(u=dset[uvar],
-                               v=dset[vvar],
-                               dx=dx[None, :, :],
-                               dy=dy[None, :, :]).metpy.dequantify()
-    conv = xr.DataArray(conv.values,
-                        coords=dset[uvar].coords,
-                        attrs={'standard_name': 'convergence',
-                               'units': conv.units},
-                        name='conv')
+    fields, u = _wind_kinematics(dset, uvar, vvar, ['divergence'])
+    dset['conv'] = u.copy(data=-fields['divergence'])
+    dset['conv'].attrs = {'standard_name': 'convergence', 'units': '1 / second'}
 
-    return xr.merge([dset, conv])
+    return dset
 
 
 def compute_vorticity(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
-    vort = mpcalc.vorticity(u=dset[uvar],
-                            v=dset[vvar],
-                            dx=dx[None, :, :],
-                            dy=dy[None, :, :]).metpy.dequantify()
-    vort = xr.DataArray(vort.values,
-                        coords=dset[uvar].coords,
-                        attrs={'standard_name': 'vorticity',
-                               'units': vort.units},
-                        name='vort')
+    fields, u = _wind_kinematics(dset, uvar, vvar, ['vorticity'])
+    dset['vort'] = u.copy(data=fields['vorticity'])
+    dset['vort'].attrs = {'standard_name': 'vorticity', 'units': '1 / second'}
 
-    return xr.merge([dset, vort])
+    return dset
+
+
+def compute_deformation(dset, uvar='10u', vvar='10v'):
+    fields, u = _wind_kinematics(dset, uvar, vvar, ['stretching', 'shearing'])
+    dset['deformation'] = u.copy(data=np.hypot(fields['stretching'], fields['shearing']))
+    dset['deformation'].attrs = {'standard_name': 'total deformation', 'units': '1 / second'}
+
+    return dset
+
+
+def compute_advection(dset, var, uvar='10u', vvar='10v'):
+    fields, u = _wind_kinematics(dset, uvar, vvar, ['advection'], var)
+    name = var + '_advection'
+    dset[name] = u.copy(data=fields['advection'])
+    dset[name].attrs = {'standard_name': 'advection of %s' % var,
+                        'units': '%s / second' % dset[var].attrs.get('units', '1')}
+
+    return dset
 
 
 def compute_geopot_height(dset, zvar='z', level=None):
@@ -50,19 +137,22 @@ def compute_geopot_height(dset, zvar='z', level=None):
 
 
 def compute_thetae(dset, tvar='t', rvar='r'):
-    rh = mpcalc.dewpoint_from_relative_humidity(dset['t'],
-                                                dset['r'] / 100.)
-    theta_e = mpcalc.equivalent_potential_temperature(850 * units.hPa,
-                                                      dset['t'],
-                                                      rh)
-    theta_e = theta_e.metpy.convert_units('degC').metpy.dequantify()
-    theta_e = xr.DataArray(theta_e.values,
-                           coords= dset['t'].coords,
-                           attrs={'standard_name': 'Equivalent potential temperature',
-                                  'units': theta_e.units},
-                            name='theta_e')
+    """Equivalent potential temperature (degC) of the temperature tvar (K) and
+    relative humidity rvar (%) at their pressure levels (plev in Pa), which
+    can be a single level or a dimension"""
+    t = dset[tvar]
+    plev = t['plev']
+    if 'plev' in t.dims:
+        p = plev.values.reshape([-1 if dim == 'plev' else 1 for dim in t.dims])
+    else:
+        p = plev.values
+    theta_e = thermo.thermo_fields(p, t.values, dset[rvar].transpose(*t.dims).values,
+                                   wet_bulb=False)['theta_e'] - thermo.zero_degc
+    dset['theta_e'] = t.copy(data=theta_e)
+    dset['theta_e'].attrs = {'standard_name': 'Equivalent potential temperature',
+                             'units': 'degree_Celsius'}
 
-    return xr.merge([dset, theta_e])
+    return dset
 
 
 def compute_snow_change(dset, snowvar='sde'):
@@ -108,6 +198,16 @@ def compute_wind_speed(dset, uvar='u', vvar='v'):
     return xr.merge([dset, wind])
 
 
+def accumulation_rate(acc, dim='time'):
+    """Rate (per hour) of the accumulated acc over the step ending at every
+    time, i.e. a backward difference which is exact for the hourly totals
+    (NaN at the first step). Lazy arrays are not loaded."""
+    hours = acc[dim].diff(dim) / np.timedelta64(1, 'h')
+    rate = acc.diff(dim, label='upper') / hours
+
+    return rate.reindex({dim: acc[dim]})
+
+
 def compute_rate(dset):
     '''Given an accumulated variable compute the step rate'''
     try:
@@ -119,15 +219,62 @@ def compute_rate(dset):
     except:
         snow_acc = dset['SNOW_GSP']
 
-    rain = rain_acc.load().differentiate(coord="time", datetime_unit="h")
-    snow = snow_acc.load().differentiate(coord="time", datetime_unit="h")
-
-    rain = xr.DataArray(rain, name='rain_rate')
-    snow = xr.DataArray(snow, name='snow_rate')
+    rain = xr.DataArray(accumulation_rate(rain_acc), name='rain_rate')
+    snow = xr.DataArray(accumulation_rate(snow_acc), name='snow_rate')
 
     return xr.merge([dset, rain, snow])
 
 
+def deaccumulate(dset, sums, intervals, rates=False):
+    """Totals (or rates per hour with rates=True) of accumulated fields over
+    intervals ending at every time step, in one pass over time: every step is
+    read once and only the accumulations still needed by the longest interval
+    are kept. sums maps every output to the arrays summed into it (those not
+    in dset are skipped), intervals maps the suffix of the output names to
+    the length of the interval in hours (None for one step). Intervals that
+    are not a multiple of the time step are skipped, steps where an interval
+    does not fit yet are NaN.
+    Yields the time index (as a list) and the float32 fields of every step."""
+    hours = np.diff(dset['time'].values) / np.timedelta64(1, 'h')
+    if not len(hours) or not np.allclose(hours, hours[0]):
+        raise ValueError('The time steps must be regular to de-accumulate')
+    step = hours[0]
+    lags = {}
+    for suffix, length in intervals.items():
+        lag = 1. if length is None else length / step
+        if lag >= 1 and np.isclose(lag, round(lag)):
+            lags[suffix] = int(round(lag))
+    sources = {output: [a for a in arrays if a in dset] for output, arrays in sums.items()}
+    sources = {output: arrays for output, arrays in sources.items() if arrays}
+    if not lags or not sources:
+        return
+    history = {output: collections.deque(maxlen=max(lags.values()) + 1) for output in sources}
+    for itime in range(dset.sizes['time']):
+        fields = {}
+        for output, arrays in sources.items():
+            template = dset[arrays[0]].isel(time=[itime])
+            acc = sum(dset[a].isel(time=itime).values.astype('float64') for a in arrays)
+            history[output].append(acc.astype('float32'))
+            for suffix, lag in lags.items():
+                if len(history[output]) > lag:
+                    total = acc - history[output][-1 - lag]
+                    # Rounding of the accumulations can give tiny negative totals
+                    np.maximum(total, 0., out=total)
+                    if rates:
+                        total /= lag * step
+                else:
+                    total = np.full(acc.shape, np.nan)
+                units = template.attrs.get('units', 'kg m**-2')
+                long_name = template.attrs.get('long_name', output)
+                fields['%s_%s' % (output, suffix)] = template.copy(
+                    data=total[None].astype('float32'))
+                fields['%s_%s' % (output, suffix)].attrs = {
+                    'standard_name': '%s rate' % long_name if rates else
+                                     '%s in %s' % (long_name, suffix),
+                    'units': '%s h**-1' % units if rates else units}
+        yield [itime], fields
+
+
 def compute_soil_moisture_sat(dset, projection):
     proj_options = utils.proj_defs[projection]
     saturation = xr.open_dataset(utils.soil_saturation_file)['soil_saturation']
@@ -0,0 +1,229 @@
+import os
+import json
+import fcntl
+import hashlib
+import argparse
+import numpy as np
+import xarray as xr
+import zarr
+import computations
+import run_store
+import utils
+
+# Fields derived from the ingested variables (e.g. the geopotential height) are computed
+# once per run on the whole domain and written in the run store next to the variables,
+# so that all scripts and projections read them as any other variable, e.g.
+#   derived.get('geop', plev=50000, projection='it')
+# Every derivation declares
+#   inputs: DWD variables it is computed from
+#   function, kwargs: function of computations.py computing it
+#   outputs: fields written in the store (variables returned by the function)
+#   units: units to which arrays are converted before (optional)
+#   levels: pressure levels (Pa) computed, None for all the levels of the store
+#   per_step: whether every time step can be computed alone (less memory) or the
+#             function needs the whole time series
+#   stream: the function is a generator reading the inputs one step at a time and
+#           yielding the fields of every step (see computations.deaccumulate)
+#   time: run_store.fine_dim to compute on the 15 minutes steps (inputs <var>_fine),
+#         the outputs are written with all these steps (optional)
+# The fields are recomputed when the run or the chunks of the inputs change.
+registry = {
+    'geop': {'inputs': ['fi'], 'function': 'compute_geopot_height', 'outputs': ['geop'],
+             'kwargs': {'zvar': 'z'}, 'levels': None, 'per_step': True},
+    'theta_e': {'inputs': ['t', 'relhum'], 'function': 'compute_thetae', 'outputs': ['theta_e'],
+                'levels': None, 'per_step': True},
+    'snow_increment': {'inputs': ['h_snow'], 'units': {'sde': 'cm'},
+                       'function': 'compute_snow_change', 'outputs': ['snow_increment'],
+                       'per_step': False},
+}
+# Totals of the accumulated precipitation over the intervals (hours) ending at every
+# step, e.g. tot_prec_24h, and over the 15 minutes steps
+precipitation_intervals = {'1h': 1, '3h': 3, '6h': 6, '12h': 12, '24h': 24}
+registry['tot_prec_intervals'] = {
+    'inputs': ['tot_prec'], 'function': 'deaccumulate', 'stream': True,
+    'kwargs': {'sums': {'tot_prec': ['tp']}, 'intervals': precipitation_intervals},
+    'outputs': ['tot_prec_%s' % interval for interval in precipitation_intervals]}
+registry['tot_prec_15min'] = {
+    'inputs': ['tot_prec' + run_store.fine_suffix], 'function': 'deaccumulate', 'stream': True,
+    'time': run_store.fine_dim,
+    'kwargs': {'sums': {'tot_prec': ['tp']}, 'intervals': {'15min': 0.25}},
+    'outputs': ['tot_prec_15min']}
+# Rates (kg m-2 h-1) of grid-scale (and convective, if ingested) rain and snow over every step
+registry['precipitation_rates'] = {
+    'inputs': ['rain_gsp', 'snow_gsp'], 'function': 'deaccumulate', 'stream': True,
+    'kwargs': {'sums': {'rain': ['RAIN_GSP', 'RAIN_CON'], 'snow': ['SNOW_GSP', 'SNOW_CON']},
+               'intervals': {'rate': None}, 'rates': True},
+    'outputs': ['rain_rate', 'snow_rate']}
+# The same over the 15 minutes steps (meteograms)
+registry['precipitation_rates_15min'] = {
+    'inputs': ['rain_gsp' + run_store.fine_suffix, 'snow_gsp' + run_store.fine_suffix],
+    'function': 'deaccumulate', 'stream': True, 'time': run_store.fine_dim,
+    'kwargs': {'sums': {'rain': ['RAIN_GSP', 'RAIN_CON'], 'snow': ['SNOW_GSP', 'SNOW_CON']},
+               'intervals': {'rate_15min': 0.25}, 'rates': True},
+    'outputs': ['rain_rate_15min', 'snow_rate_15min']}
+# Only one process computes the derived fields of a store at a time
+lock_file = 'derived.lock'
+# Keys of the derivations written in a store, see derived_key
+keys_file = 'derived.json'
+
+
+def derivation(name):
+    """Name of the derivation writing the field name"""
+    for key, entry in registry.items():
+        if name in entry['outputs']:
+            return key
+    raise KeyError('%s is not a derived field' % name)
+
+
+def _inputs_hash(path, array):
+    """Hash of the chunks (name, size, modification time) of an array of the store at path"""
+    digest = hashlib.sha1()
+    with os.scandir(os.path.join(path, array)) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            stat = entry.stat()
+            digest.update(('%s %d %d\n' % (entry.name, stat.st_size, stat.st_mtime_ns)).encode())
+
+    return digest.hexdigest()
+
+
+def derived_key(path, name):
+    """Key of the derivation name in the store at path: it changes with
+    the run, the derivation and the chunks of any of its inputs"""
+    entry = registry[name]
+    group = zarr.open_group(path, mode='r')
+    catalog = group.attrs['catalog']
+    description = {'run': group.attrs['run'],
+                   'derivation': {k: v for k, v in entry.items() if k != 'inputs'},
+                   'inputs': {var: _inputs_hash(path, catalog[var]['array'])
+                              for var in entry['inputs']}}
+
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def compute(dset, name):
+    """Yield the time indices of dset (which contains the inputs of the
+    derivation name) and the fields {output: DataArray} computed on them"""
+    entry = registry[name]
+    function = getattr(computations, entry['function'])
+    if entry.get('stream'):
+        yield from function(dset, **entry.get('kwargs', {}))
+        return
+    steps = [[itime] for itime in range(dset.sizes['time'])] if entry['per_step'] \
+        else [list(range(dset.sizes['time']))]
+    for itimes in steps:
+        source = dset.isel(time=itimes).load()
+        for array, unit in entry.get('units', {}).items():
+            source[array] = source[array].metpy.convert_units(unit).metpy.dequantify()
+        result = function(source, **entry.get('kwargs', {}))
+        yield itimes, {output: result[output] for output in entry['outputs']}
+
+
+def read_keys(path):
+    """Keys of the derivations already written in the store at path"""
+    filename = os.path.join(path, keys_file)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write(path, name, key):
+    """Compute the fields of the derivation name on the whole domain of the
+    store at path and write them there (replacing outdated ones) with its key"""
+    entry = registry[name]
+    group = zarr.open_group(path, mode='a')
+    dset, _ = run_store.open_dataset(path, entry['inputs'])
+    dset = run_store.fine_to_time(dset)
+    dims = ('time', 'plev', 'lat', 'lon') if 'plev' in dset.dims else ('time', 'lat', 'lon')
+    store_dims = tuple(entry.get('time', 'time') if dim == 'time' else dim for dim in dims)
+    if entry.get('levels') and 'plev' in dims:
+        dset = dset.sel(plev=entry['levels'])
+    for output in entry['outputs']:
+        if output in group:
+            del group[output]
+    arrays = {}
+    for itimes, fields in compute(dset, name):
+        for output, field in fields.items():
+            field = field.transpose(*dims)
+            if output not in arrays:
+                attrs = {'long_name': field.attrs.get('standard_name', output),
+                         'units': field.attrs.get('units')}
+                arrays[output] = run_store.require_variable(group, output, output, attrs, store_dims)
+            arr, values = arrays[output], run_store.pack(arrays[output], field.values)
+            if 'plev' in dims:
+                ilevels = np.searchsorted(-group['plev'][:], -field['plev'].values)
+                arr.set_orthogonal_selection((itimes, ilevels), values)
+            else:
+                arr[itimes[0]:itimes[-1] + 1] = values
+    # Readers only trust the fields once they are complete
+    keys = read_keys(path)
+    keys[name] = key
+    with open(os.path.join(path, keys_file + '.tmp'), 'w') as f:
+        json.dump(keys, f)
+    os.replace(os.path.join(path, keys_file + '.tmp'), os.path.join(path, keys_file))
+    run_store.consolidate(path)
+    run_store.open_store(path, refresh=True)
+
+
+def ensure(path, name):
+    """Make sure that the derived field name (or all the fields of the
+    derivation name) are up to date in the store at path, computing them if
+    needed. Returns whether they were computed."""
+    if name not in registry:
+        name = derivation(name)
+    with open(os.path.join(path, lock_file), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            key = derived_key(path, name)
+            if read_keys(path).get(name) == key:
+                if not set(registry[name]['outputs']) & run_store.stored_variables(path):
+                    run_store.open_store(path, refresh=True)
+                return False
+            utils.print_message('Computing %s in %s' % (name, path))
+            write(path, name, key)
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get(name, plev=None, projection=None, freq='1H'):
+    """Derived field name (DataArray) of the current run, at the pressure
+    levels plev (Pa) and over projection as in utils.read_dataset. It is
+    computed once in the run store, or on the fly (without caching) if its
+    inputs are not in the store."""
+    entry = registry[derivation(name)]
+    store = run_store.find_latest_store(utils.folder)
+    if store and set(entry['inputs']) <= run_store.stored_variables(store):
+        ensure(store, name)
+        if name not in run_store.stored_variables(store):
+            raise ValueError('%s cannot be derived with the time steps of %s' % (name, store))
+        return utils.read_dataset(variables=[name], level=plev, projection=projection,
+                                  freq=freq)[name]
+    if entry.get('time') == run_store.fine_dim:
+        # All the steps of the files
+        inputs = [var[:-len(run_store.fine_suffix)] for var in entry['inputs']]
+        dset = utils.read_dataset(variables=inputs, level=plev, projection=projection, freq=None)
+    else:
+        dset = utils.read_dataset(variables=entry['inputs'], level=plev, projection=projection)
+    steps = [fields[name] for _, fields in compute(dset, derivation(name))]
+    if not steps:
+        raise ValueError('%s cannot be derived with the time steps of the files' % name)
+
+    return xr.concat(steps, dim='time')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--names', help='Derivations to compute',
+                        required=False, default=list(registry), nargs='+', choices=list(registry))
+    parser.add_argument('-f', '--folder', help='Folder with the run stores',
+                        required=False, default=utils.folder)
+    args = parser.parse_args()
+
+    path = run_store.find_latest_store(args.folder)
+    stored = run_store.stored_variables(path)
+    for name in args.names:
+        if set(registry[name]['inputs']) <= stored:
+            ensure(path, name)
+        else:
+            utils.print_message('Skipping %s, inputs not in %s' % (name, path))
@@ -0,0 +1,52 @@
+# Domains of the projections plotted, in a module without dependencies so that
+# the ingest can crop the run store without importing the plotting stack
+proj_defs = {
+    'nord':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4,
+        'llcrnrlat': 50,
+        'urcrnrlon': 12,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'it':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 5.5,
+        'llcrnrlat': 43.5,
+        'urcrnrlon': 14.5,
+        'urcrnrlat': 48,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'de':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4.5,
+        'llcrnrlat': 46.5,
+        'urcrnrlon': 16,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'north_sea':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 0,
+        'llcrnrlat': 50,
+        'urcrnrlon': 10,
+        'urcrnrlat': 58,
+        'resolution': 'i',
+    },
+    'domain':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': -3.9,
+        'llcrnrlat': 43.2,
+        'urcrnrlon': 20.3,
+        'urcrnrlat': 58,
+        'resolution': 'i',
+    },
+}
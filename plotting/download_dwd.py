@@ -0,0 +1,199 @@
+import asyncio
+import bz2
+import os
+import re
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+
+# Can be pointed to a local HTTP server serving the same <run>/<variable>/<file>.grib2.bz2
+# tree to test the download, see tests/dwd_stand_in.py
+if 'DWD_BASE_URL' in os.environ:
+    base_url = os.environ['DWD_BASE_URL']
+else:
+    base_url = 'https://opendata.dwd.de/weather/nwp/icon-d2/grib'
+# Maximum number of open (keep-alive) connections for every host
+concurrency_per_host = 10
+# Threads used to decompress the bz2 streams while the bytes arrive
+decompress_threads = 4
+chunk_size = 2 ** 16
+retries = 3
+# Seconds waited before the second attempt to download a file, doubled at every attempt
+retry_wait = 5
+levels_3d = ['950', '850', '700', '500']
+
+
+class DownloadError(Exception):
+    """Some files could not be downloaded after all the attempts"""
+
+
+def print_message(message):
+    """Formatted print"""
+    print(os.path.basename(sys.argv[0])+' : '+message)
+
+
+def variable_url(var, run_string):
+    """Url of the server folder containing all files of one variable"""
+    return '%s/%s/%s/' % (base_url, run_string[-2:], var)
+
+
+def filename_regex_2d(var, run_string):
+    """Regex matching the 2d files of var, forecast step as first group"""
+    return r'icon-d2_germany_regular-lat-lon_single-level_%s_(\d{3})_2d_%s\.grib2\.bz2' % (
+        run_string, re.escape(var))
+
+
+def filename_regex_3d(var, run_string, levels=levels_3d):
+    """Regex matching the pressure level files of var, forecast step and
+    level as groups"""
+    return r'icon-d2_germany_regular-lat-lon_pressure-level_%s_(\d{3})_(%s)_%s\.grib2\.bz2' % (
+        run_string, '|'.join(levels), re.escape(var))
+
+
+def filename_regex_invariant(var, run_string):
+    """Regex matching the time-invariant file of var, forecast step as first group"""
+    return r'icon-d2_germany_regular-lat-lon_time-invariant_%s_(\d{3})_0_%s\.grib2\.bz2' % (
+        run_string, re.escape(var))
+
+
+def extracted_filename(url, folder='.'):
+    """Local name of the decompressed file"""
+    return os.path.join(folder, os.path.basename(url).replace('.bz2', ''))
+
+
+def get_session(concurrency=concurrency_per_host):
+    """Create a session whose connections are pooled and kept alive, so that
+    every host is contacted with at most `concurrency` connections."""
+    connector = aiohttp.TCPConnector(limit=0,
+                                     limit_per_host=concurrency,
+                                     keepalive_timeout=60,
+                                     ttl_dns_cache=600)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def list_urls(session, url, pattern):
+    """Async version of the old `listurls`: return the urls in the index
+    page at url whose filename matches pattern."""
+    async with session.get(url) as response:
+        response.raise_for_status()
+        text = await response.text()
+    regex = re.compile(pattern)
+    hrefs = re.findall(r'<a [^>]*href="([^"]+)"', text, flags=re.IGNORECASE)
+
+    return sorted(set(url + href for href in hrefs if regex.fullmatch(href)))
+
+
+def _decompress_write(decompressor, chunk, sink):
+    """Decompress a chunk and write it to sink, taking care of
+    concatenated bz2 streams. Returns the decompressor to use for the
+    next chunk."""
+    while chunk:
+        sink.write(decompressor.decompress(chunk))
+        if not decompressor.eof:
+            break
+        chunk = decompressor.unused_data
+        decompressor = bz2.BZ2Decompressor()
+
+    return decompressor
+
+
+async def fetch(session, url, executor, sink):
+    """Stream the bz2 file at url into sink (any object with a `write` method),
+    decompressing the chunks in executor as soon as they arrive."""
+    loop = asyncio.get_running_loop()
+    decompressor = bz2.BZ2Decompressor()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            decompressor = await loop.run_in_executor(executor, _decompress_write,
+                                                      decompressor, chunk, sink)
+
+
+async def get_and_extract_one(session, url, executor, folder='.'):
+    """Async version of the old `get_and_extract_one`: download and decompress
+    url into folder unless the file is already there. The file only appears
+    with its final name once it is complete. Raises DownloadError if all the
+    attempts fail."""
+    filename = extracted_filename(url, folder)
+    if os.path.isfile(filename):
+        return filename
+    for attempt in range(retries):
+        if attempt:
+            await asyncio.sleep(retry_wait * 2 ** (attempt - 1))
+        try:
+            with open(filename + '.part', 'wb') as sink:
+                await fetch(session, url, executor, sink)
+            os.replace(filename + '.part', filename)
+            return filename
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            error = e
+            print_message('WARNING: attempt %d to download %s failed (%s)' %
+                          (attempt + 1, url, e))
+    if os.path.isfile(filename + '.part'):
+        os.remove(filename + '.part')
+    raise DownloadError('could not download %s (%s)' % (url, error))
+
+
+async def download_variables(variables, run_string, var_type='2d', levels=levels_3d,
+                             folder='.', concurrency=concurrency_per_host):
+    """Download and decompress all the files of variables for the run
+    (YYYYMMDDHH) sharing one session for all of them."""
+    if var_type == '2d':
+        patterns = [filename_regex_2d(var, run_string) for var in variables]
+    else:
+        patterns = [filename_regex_3d(var, run_string, levels) for var in variables]
+    executor = ThreadPoolExecutor(decompress_threads)
+    try:
+        async with get_session(concurrency) as session:
+            listings = await asyncio.gather(*[list_urls(session, variable_url(var, run_string), pattern)
+                                              for var, pattern in zip(variables, patterns)])
+            urls = [url for listing in listings for url in listing]
+            print_message('Downloading %d files for %s' % (len(urls), ', '.join(variables)))
+            files = await asyncio.gather(*[get_and_extract_one(session, url, executor, folder)
+                                           for url in urls], return_exceptions=True)
+    finally:
+        executor.shutdown()
+    # The other files are downloaded anyway, so that a new call only fetches the missing ones
+    failed = [f for f in files if isinstance(f, Exception)]
+    if failed:
+        raise DownloadError('%d of %d files could not be downloaded: %s' %
+                            (len(failed), len(urls), '; '.join(str(e) for e in failed)))
+
+    return files
+
+
+def run_from_env():
+    """Run string as exported by copy_data.run"""
+    return '%s%s%s%s' % (os.environ['year'], os.environ['month'],
+                         os.environ['day'], os.environ['run'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--variables', help='Variables to download',
+                        required=True, nargs='+')
+    parser.add_argument('-t', '--type', help='Type of variables (2d or 3d)',
+                        required=False, default='2d', choices=['2d', '3d'])
+    parser.add_argument('-r', '--run', help='Run to download (YYYYMMDDHH), defaults to the one exported in the environment',
+                        required=False, default=None)
+    parser.add_argument('-l', '--levels', help='Pressure levels for 3d variables',
+                        required=False, default=levels_3d, nargs='+')
+    parser.add_argument('-j', '--concurrency', help='Maximum number of connections per host',
+                        required=False, default=concurrency_per_host, type=int)
+    parser.add_argument('-o', '--output', help='Folder where the files are extracted',
+                        required=False, default='.')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(download_variables(args.variables,
+                                       args.run or run_from_env(),
+                                       var_type=args.type,
+                                       levels=args.levels,
+                                       folder=args.output,
+                                       concurrency=args.concurrency))
+    except DownloadError as e:
+        # Non-zero exit, so that the steps are not merged with some of them missing
+        print_message('ERROR: %s' % e)
+        sys.exit(1)
@@ -0,0 +1,223 @@
+import os
+import bisect
+import unicodedata
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+import download_dwd
+import run_store
+
+# Local table of places used to find the coordinates of the cities (meteograms, point
+# forecasts) without calling a geocoding service. The table is built once from a GeoNames
+# dump (e.g. cities1000.txt from https://download.geonames.org/export/dump/) with
+#   python gazetteer.py build cities1000.txt
+# and loaded once per process. Names that are not in the table are looked up on Mapbox
+# (if MAPBOX_KEY is set) and the answers are kept in cities_coordinates.csv.
+plotting_folder = os.path.dirname(os.path.abspath(__file__))
+gazetteer_file = os.path.join(plotting_folder, 'gazetteer.npz')
+cache_file = os.path.join(plotting_folder, 'cities_coordinates.csv')
+mapbox_url = "https://api.mapbox.com/geocoding/v5/mapbox.places"
+# Requests sent to Mapbox at the same time
+mapbox_concurrency = 8
+mapbox_timeout = 10
+
+# Loaded table (see load) and places answered by Mapbox {key: (lon, lat)}
+_table = None
+_cache = None
+_tree = None
+
+
+def normalize(name):
+    """Key of a name: lowercase without accents and extra spaces"""
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+
+    return ' '.join(name.lower().split())
+
+
+def build(filename, output=gazetteer_file, min_population=0):
+    """Convert a GeoNames dump (tab separated, see the GeoNames readme) into
+    the compact table loaded by load. Every place is found both by its name
+    and by its ASCII name."""
+    columns = {0: 'id', 1: 'name', 2: 'asciiname', 4: 'lat', 5: 'lon', 8: 'country', 14: 'population'}
+    places = pd.read_csv(filename, sep='\t', header=None, quoting=3, usecols=list(columns),
+                         keep_default_na=False, low_memory=False).rename(columns=columns)
+    places = places[places['population'] >= min_population]
+    keys = pd.concat([places.assign(key=places['name'].map(normalize)),
+                      places.assign(key=places['asciiname'].map(normalize))])
+    keys = keys.drop_duplicates(['key', 'lat', 'lon']).sort_values(['key', 'population'],
+                                                                   ascending=[True, False])
+    np.savez(output,
+             keys=keys['key'].values.astype('U'),
+             id=keys['id'].values.astype('int64'),
+             names=keys['name'].values.astype('U'),
+             country=keys['country'].values.astype('U2'),
+             lat=keys['lat'].values.astype('float32'),
+             lon=keys['lon'].values.astype('float32'),
+             population=keys['population'].values.astype('int64'))
+
+    return len(keys)
+
+
+def load(filename=gazetteer_file):
+    """Table of places (dictionary of arrays sorted by key), read only once.
+    Empty if the table was not built."""
+    global _table
+    if _table is None:
+        if os.path.isfile(filename):
+            with np.load(filename) as data:
+                _table = {name: data[name] for name in data.files}
+        else:
+            _table = {'keys': np.array([], dtype='U'), 'id': np.array([], dtype='int64'), 'names': np.array([], dtype='U'),
+                      'country': np.array([], dtype='U2'), 'lat': np.array([], dtype='float32'),
+                      'lon': np.array([], dtype='float32'), 'population': np.array([], dtype='int64')}
+        # Keys as a list, so that bisect works on them
+        _table['key_list'] = _table['keys'].tolist()
+
+    return _table
+
+
+def load_cache(filename=cache_file):
+    """Places already answered by Mapbox {key: (lon, lat)}"""
+    global _cache
+    if _cache is None:
+        _cache = {}
+        if os.path.isfile(filename):
+            cities = pd.read_csv(filename, index_col=[0])
+            _cache = {normalize(city): (row.lon, row.lat) for city, row in cities.iterrows()}
+
+    return _cache
+
+
+def lookup(name):
+    """(lon, lat) of the most populated place called name, None if not in the table"""
+    table, key = load(), normalize(name)
+    i = bisect.bisect_left(table['key_list'], key)
+    # Places with the same key are sorted by decreasing population
+    if i < len(table['key_list']) and table['key_list'][i] == key:
+        return float(table['lon'][i]), float(table['lat'][i])
+
+
+def search(prefix, limit=10):
+    """Places (name, country, lon, lat) whose name starts with prefix, most populated first"""
+    table, key = load(), normalize(prefix)
+    start = bisect.bisect_left(table['key_list'], key)
+    stop = bisect.bisect_left(table['key_list'], key + '\uffff', lo=start)
+    # A place can match with its name and its ASCII name
+    ids, found = set(), []
+    for i in start + np.argsort(-table['population'][start:stop], kind='stable'):
+        if len(found) == limit:
+            break
+        if table['id'][i] not in ids:
+            ids.add(table['id'][i])
+            found.append(i)
+
+    return [(str(table['names'][i]), str(table['country'][i]), float(table['lon'][i]),
+             float(table['lat'][i])) for i in found]
+
+
+def _unit_vectors(lat, lon):
+    lon, lat = np.radians(lon), np.radians(lat)
+
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def nearby(lat, lon, k=5):
+    """Places (name, country, distance in km) nearest to a point, using a
+    KD-tree of the places built the first time it is needed"""
+    global _tree
+    from scipy.spatial import cKDTree
+    table = load()
+    if not len(table['keys']):
+        return []
+    if _tree is None:
+        _tree = cKDTree(_unit_vectors(table['lat'], table['lon']))
+    # Chord distances on the unit sphere, converted to km along the surface
+    distances, found = _tree.query(_unit_vectors(lat, lon), k=min(k, len(table['keys'])))
+    distances, found = np.atleast_1d(distances), np.atleast_1d(found)
+
+    return [(str(table['names'][i]), str(table['country'][i]), float(2 * 6371. * np.arcsin(d / 2)))
+            for d, i in zip(distances, found)]
+
+
+def grid_index(lats, lons, path=None):
+    """Indices (ilat, ilon) of the nearest points of the grid of the run store
+    at path (the current one by default) to every location, see run_store.points_index"""
+    path = path or run_store.find_latest_store(os.environ.get('MODEL_DATA_FOLDER', '.'))
+    index = run_store.points_index(run_store.open_store(path), lats, lons)
+
+    return index['lat'].values, index['lon'].values
+
+
+def fetch_mapbox(names, filename=cache_file):
+    """Ask Mapbox the coordinates of names (concurrently) and add them to
+    the cache. Returns {name: (lon, lat)} of those that were found: a name whose
+    request fails is only reported, so that the others are still cached."""
+    api_key = os.environ.get('MAPBOX_KEY')
+    if not api_key:
+        raise KeyError('%s not in the gazetteer and MAPBOX_KEY is not set' % ', '.join(names))
+    session = requests.Session()
+
+    def fetch(name):
+        try:
+            response = session.get('%s/%s.json' % (mapbox_url, name),
+                                   params={'access_token': api_key, 'limit': 1},
+                                   timeout=mapbox_timeout)
+            response.raise_for_status()
+            features = response.json()['features']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # Not the message of e, which contains the url with the key
+            download_dwd.print_message('Mapbox lookup of %s failed (%s)' % (name, type(e).__name__))
+            return None
+        return tuple(features[0]['center']) if features else None
+
+    with ThreadPoolExecutor(mapbox_concurrency) as executor:
+        answers = dict(zip(names, executor.map(fetch, names)))
+    found = {name: coords for name, coords in answers.items() if coords}
+    if found:
+        cache = load_cache(filename)
+        cache.update((normalize(name), coords) for name, coords in found.items())
+        new = pd.DataFrame(index=list(found), data={'lon': [c[0] for c in found.values()],
+                                                    'lat': [c[1] for c in found.values()]})
+        new.to_csv(filename, mode='a', header=not os.path.isfile(filename))
+
+    return found
+
+
+def locate(names):
+    """(lon, lat) of every name: from the Mapbox cache, the gazetteer and,
+    for the remaining ones, from Mapbox with a single batch of requests"""
+    cache = load_cache()
+    coordinates = {name: cache.get(normalize(name)) or lookup(name) for name in names}
+    missing = [name for name, coords in coordinates.items() if coords is None]
+    if missing:
+        coordinates.update(fetch_mapbox(missing))
+    not_found = [name for name in names if coordinates.get(name) is None]
+    if not_found:
+        raise KeyError('Could not find %s' % ', '.join(not_found))
+
+    return [coordinates[name] for name in names]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', help='build: create the table from a GeoNames dump, '
+                                       'search: places starting with the names, nearby: places near a point',
+                        choices=['build', 'search', 'nearby'])
+    parser.add_argument('arguments', help='GeoNames file (build), names (search) or lat lon (nearby)',
+                        nargs='+')
+    parser.add_argument('--min_population', help='Only keep places with at least this population (build)',
+                        required=False, default=0, type=int)
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        print('%d names written in %s' % (build(args.arguments[0], min_population=args.min_population),
+                                           gazetteer_file))
+    elif args.action == 'search':
+        for name in args.arguments:
+            for place in search(name):
+                print('%s (%s) %.4f %.4f' % place)
+    else:
+        for place in nearby(float(args.arguments[0]), float(args.arguments[1])):
+            print('%s (%s) %.1f km' % place)
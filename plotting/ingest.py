@@ -0,0 +1,379 @@
+import asyncio
+import io
+import os
+import re
+import sys
+import time as time_module
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import eccodes
+import download_dwd
+import run_store
+import domains
+from download_dwd import print_message
+
+if 'MODEL_DATA_FOLDER' in os.environ:
+    folder = os.environ['MODEL_DATA_FOLDER']
+else:
+    folder = '/home/ekman/ssd/guido/icon-d2/'
+# Threads used to decode the GRIB messages and write them in the store
+ingest_threads = 4
+# Seconds between two listings of the server folders when streaming a run
+poll_interval = 60
+# Give up streaming a run after these seconds
+stream_timeout = 6 * 3600
+# Attempts to download and decode a file before giving up its step
+max_attempts = 3
+
+
+class IngestError(Exception):
+    """Some steps are still missing in the store after the ingest (not published,
+    or their files given up): missing maps every variable to its missing steps"""
+    def __init__(self, path, missing):
+        super().__init__('steps missing in %s: %s' % (path, missing))
+        self.path, self.missing = path, missing
+
+
+def split_messages(data):
+    """Yield the single GRIB2 messages contained in data (bytes)"""
+    start = data.find(b'GRIB')
+    while start != -1:
+        # Section 0 of GRIB2 has the total length of the message in octets 9-16
+        length = int.from_bytes(data[start + 8:start + 16], 'big')
+        # Truncated downloads must not reach eccodes
+        if length < 16 or data[start + length - 4:start + length] != b'7777':
+            raise ValueError('truncated or corrupt GRIB2 message at byte %d' % start)
+        yield data[start:start + length]
+        start = data.find(b'GRIB', start + length)
+
+
+def decode_message(message):
+    """Decode a GRIB2 message into a dictionary with the field on a
+    regular lat-lon grid (latitude increasing) and its metadata."""
+    gid = eccodes.codes_new_from_message(message)
+    try:
+        nlon = eccodes.codes_get(gid, 'Ni')
+        nlat = eccodes.codes_get(gid, 'Nj')
+        values = eccodes.codes_get_values(gid).reshape(nlat, nlon)
+        if eccodes.codes_get(gid, 'bitmapPresent'):
+            values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+        lat_first = eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
+        lat_last = eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees')
+        lon_first = eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees')
+        lon_last = eccodes.codes_get(gid, 'longitudeOfLastGridPointInDegrees')
+        # GRIB stores longitudes in [0, 360), the domain crosses the Greenwich meridian
+        if lon_first > 180:
+            lon_first -= 360.
+        if lon_last > 180:
+            lon_last -= 360.
+        lat = np.linspace(lat_first, lat_last, nlat)
+        if lat_first > lat_last:
+            lat, values = lat[::-1], values[::-1, :]
+        field = {
+            'short_name': eccodes.codes_get(gid, 'shortName'),
+            'long_name': eccodes.codes_get(gid, 'name'),
+            'units': eccodes.codes_get(gid, 'units'),
+            'type_of_level': eccodes.codes_get(gid, 'typeOfLevel'),
+            'level': eccodes.codes_get(gid, 'level'),
+            'valid_time': pd.to_datetime('%d%04d' % (eccodes.codes_get(gid, 'validityDate'),
+                                                     eccodes.codes_get(gid, 'validityTime')),
+                                         format='%Y%m%d%H%M'),
+            'lat': lat,
+            'lon': np.linspace(lon_first, lon_last, nlon),
+            'values': values,
+        }
+    finally:
+        eccodes.codes_release(gid)
+
+    return field
+
+
+def ingest_data(path, var, run, data, var_type='2d', packing={}, crop=None,
+                levels=download_dwd.levels_3d):
+    """Decode the GRIB2 data of var and write the hourly steps in the
+    store at path. Returns the list of the (hourly) steps written.
+    The 15 minutes steps of 2D variables are written in the companion array
+    with all the steps (see run_store.require_fine_variable).
+    packing maps array names to (scale_factor, add_offset) to pack them as int16.
+    crop is an optional domain (as in domains.proj_defs) to which the store is cut.
+    Pressure level (3d) fields are written in their (step, level) slot of an
+    array with the levels (hPa) of the store."""
+    steps = []
+    for message in split_messages(data):
+        field = decode_message(message)
+        step = (field['valid_time'] - run) / pd.Timedelta('1 hour')
+        fine_step = step * run_store.steps_per_hour
+        # Only keep the hourly steps, as -seltime used to do, and the 15 minutes ones of 2D variables
+        if fine_step != int(fine_step) or not 0 <= step <= run_store.forecast_hours:
+            continue
+        if step != int(step) and var_type != '2d':
+            continue
+        lat, lon = field['lat'], field['lon']
+        if crop:
+            window = run_store.index_window(lat, lon, crop)
+            lat, lon = lat[slice(*window['lat'])], lon[slice(*window['lon'])]
+        group = run_store.open_group(path, run, lat, lon, domains.proj_defs)
+        # Cut the field to the grid of the store, which may have been created by another ingest
+        ilat, ilon = run_store.grid_window(group, field['lat'], field['lon'])
+        field['values'] = field['values'][ilat, ilon]
+        attrs = {'long_name': field['long_name'], 'units': field['units']}
+        name = run_store.array_name(var, field['short_name'])
+        if var_type == 'invariant':
+            arr = run_store.require_variable(group, name, var, attrs, dims=('lat', 'lon'),
+                                             packing=packing.get(name))
+            run_store.write_step(arr, None, field['values'])
+        elif var_type == '3d':
+            plev = run_store.require_levels(group, levels)
+            ilevel = np.flatnonzero(np.isclose(plev, field['level'] * 100.))
+            if ilevel.size == 0:
+                print_message('WARNING: level %s of %s is not in the store, skipping' %
+                              (field['level'], var))
+                continue
+            arr = run_store.require_variable(group, name, var, attrs,
+                                             dims=('time', 'plev', 'lat', 'lon'),
+                                             packing=packing.get(name))
+            run_store.write_step(arr, int(step), field['values'], int(ilevel[0]))
+        else:
+            if step == int(step):
+                arr = run_store.require_variable(group, name, var, attrs,
+                                                 packing=packing.get(name))
+                run_store.write_step(arr, int(step), field['values'])
+            # Checked after writing the hourly step, which is copied if the array is created meanwhile
+            if step != int(step) or name + run_store.fine_suffix in group:
+                arr, created = run_store.require_fine_variable(group, name, var, attrs,
+                                                               packing=packing.get(name))
+                run_store.write_step(arr, int(fine_step), field['values'])
+                if created:
+                    run_store.consolidate(path)
+            if step != int(step):
+                continue
+        steps.append(int(step))
+
+    return steps
+
+
+async def ingest_one(session, url, var, run, path, executor, var_type='2d', packing={},
+                     crop=None, levels=download_dwd.levels_3d):
+    """Download, decompress and decode url straight into the store without
+    writing any intermediate file. Returns the steps written (an empty list if
+    the file has none to keep) or None if the download or the decoding failed."""
+    sink = io.BytesIO()
+    try:
+        await download_dwd.fetch(session, url, executor, sink)
+    except Exception as e:
+        print_message('WARNING: could not download %s (%s)' % (url, e))
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, ingest_data, path, var, run,
+                                          sink.getvalue(), var_type, packing, crop, levels)
+    except Exception as e:
+        print_message('WARNING: could not ingest %s (%s)' % (url, e))
+        return None
+
+
+async def stream_run(variables, run_string, folder=folder, var_type='2d', wait=True,
+                     poll_interval=poll_interval, timeout=stream_timeout,
+                     concurrency=download_dwd.concurrency_per_host, packing={},
+                     crop_projections=None, levels=download_dwd.levels_3d, points=False):
+    """Ingest every step of variables as soon as it appears on the server.
+    If wait is False only the files already available are ingested.
+    Steps that are already in the store are not downloaded again.
+    If crop_projections is given only the smallest box covering those
+    projections of domains.proj_defs is kept.
+    For 3d variables every level of a step is a separate file, all of them
+    are ingested concurrently and the step is marked as ready once all
+    levels are in the store.
+    If points is True every variable is also copied in the point-major
+    companion store (see run_store.write_points) once all its steps are in.
+    Raises IngestError at the end if any step is missing, so that the callers
+    (scheduler, cron) see that the run is incomplete."""
+    run = pd.to_datetime(run_string, format='%Y%m%d%H')
+    path = run_store.store_path(folder, run_string)
+    if var_type == 'invariant':
+        patterns = {var: re.compile(download_dwd.filename_regex_invariant(var, run_string))
+                    for var in variables}
+        steps = {0}
+    elif var_type == '3d':
+        patterns = {var: re.compile(download_dwd.filename_regex_3d(var, run_string, levels))
+                    for var in variables}
+        steps = set(range(run_store.forecast_hours + 1))
+    else:
+        patterns = {var: re.compile(download_dwd.filename_regex_2d(var, run_string))
+                    for var in variables}
+        steps = set(range(run_store.forecast_hours + 1))
+    if crop_projections:
+        crop = run_store.union_domain([domains.proj_defs[p] for p in crop_projections])
+    else:
+        crop = None
+    run_store.set_current(folder, run_string)
+    # Files already processed (or being processed) for every variable
+    seen = {var: set() for var in variables}
+    # Steps (forecast hours) that we still need for every variable
+    ready = run_store.ready_steps(path)
+    missing = {var: steps - ready.get(var, set()) for var in variables}
+    # Levels still to be written for every missing step of 3d variables
+    pending = {var: {step: set(levels) for step in missing[var]} for var in variables}
+    # Variables that are already in the catalog of the store
+    cataloged = set(ready)
+    # Copies of the complete variables in the point-major store
+    copies = {}
+    # Failed attempts for every file
+    attempts = {}
+    # Steps whose files were given up for every variable
+    given_up = {var: set() for var in variables}
+
+    def steps_done(var, level, steps):
+        """Mark steps of var as ready, for 3d variables only once all levels are written"""
+        if steps and var not in cataloged:
+            # Make the new array visible to the readers
+            run_store.consolidate(path)
+            cataloged.add(var)
+        for step in steps:
+            if level is not None:
+                pending[var][step].discard(level)
+                if pending[var][step]:
+                    continue
+            run_store.mark_ready(path, var, step)
+            missing[var].discard(step)
+            print_message('Step %d of %s is ready' % (step, var))
+        if points and not missing[var] and var not in copies:
+            copies[var] = asyncio.get_running_loop().run_in_executor(executor, run_store.write_points,
+                                                                     path, var)
+
+    def file_done(var, url, step, level, steps):
+        """Handle the result of a file: the steps written, [] if it has no steps
+        to keep or None if it failed, in which case it is tried again at the next
+        listings (returns True). The step of a file that failed max_attempts times
+        or has no steps is not waited for anymore (it stays missing in the store)."""
+        if steps is None:
+            attempts[url] = attempts.get(url, 0) + 1
+            if attempts[url] < max_attempts:
+                print_message('WARNING: could not ingest %s (attempt %d of %d)' %
+                              (url, attempts[url], max_attempts))
+                seen[var].discard(url)
+                return True
+            print_message('WARNING: giving up %s after %d attempts' % (url, attempts[url]))
+        elif not steps:
+            print_message('WARNING: no steps to ingest in %s' % url)
+        else:
+            steps_done(var, level, steps)
+            return False
+        missing[var].discard(step)
+        given_up[var].add(step)
+        return False
+
+    start = time_module.time()
+    executor = ThreadPoolExecutor(ingest_threads)
+    tasks = {}
+    try:
+        async with download_dwd.get_session(concurrency) as session:
+            while any(missing.values()):
+                listings = await asyncio.gather(*[download_dwd.list_urls(session,
+                                                                         download_dwd.variable_url(var, run_string),
+                                                                         patterns[var].pattern)
+                                                  for var in variables], return_exceptions=True)
+                for var, listing in zip(variables, listings):
+                    if isinstance(listing, Exception):
+                        print_message('WARNING: could not list the files of %s (%s)' % (var, listing))
+                        continue
+                    for url in listing:
+                        match = patterns[var].fullmatch(os.path.basename(url))
+                        step = int(match.group(1))
+                        level = match.group(2) if var_type == '3d' else None
+                        if url in seen[var] or step not in missing[var]:
+                            continue
+                        if level is not None and level not in pending[var][step]:
+                            continue
+                        seen[var].add(url)
+                        tasks[asyncio.ensure_future(ingest_one(session, url, var, run,
+                                                               path, executor, var_type,
+                                                               packing, crop, levels))] = (var, url, step, level)
+                if not wait:
+                    # Only the files already published, the failed ones are tried again
+                    # (with a new listing) up to max_attempts times
+                    retried = False
+                    if tasks:
+                        await asyncio.wait(list(tasks))
+                        for task, info in tasks.items():
+                            retried = file_done(*info, task.result()) or retried
+                        tasks.clear()
+                    if not retried:
+                        break
+                    continue
+                if time_module.time() - start > timeout:
+                    print_message('WARNING: giving up, steps still missing %s' %
+                                  {var: sorted(steps) for var, steps in missing.items() if steps})
+                    break
+                if not tasks:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                # Process the downloads while waiting for the next listing
+                done, _ = await asyncio.wait(list(tasks), timeout=poll_interval)
+                for task in done:
+                    file_done(*tasks.pop(task), task.result())
+            if tasks:
+                await asyncio.wait(list(tasks))
+                for task, (var, url, step, level) in tasks.items():
+                    file_done(var, url, step, level, task.result())
+            # Variables that were already complete in the store
+            for var in variables:
+                if var in cataloged:
+                    steps_done(var, None, [])
+            if copies:
+                await asyncio.gather(*copies.values())
+                print_message('Copied %s in the point-major store' % ', '.join(copies))
+    finally:
+        executor.shutdown()
+    if os.path.isdir(path):
+        run_store.consolidate(path)
+    incomplete = {var: sorted(missing[var] | given_up[var]) for var in variables
+                  if missing[var] | given_up[var]}
+    if incomplete:
+        raise IngestError(path, incomplete)
+
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--variables', help='Variables to ingest',
+                        required=True, nargs='+')
+    parser.add_argument('-t', '--type', help='Type of variables (2d, 3d or invariant)',
+                        required=False, default='2d', choices=['2d', '3d', 'invariant'])
+    parser.add_argument('-r', '--run', help='Run to ingest (YYYYMMDDHH), defaults to the one exported in the environment',
+                        required=False, default=None)
+    parser.add_argument('-l', '--levels', help='Pressure levels (hPa) for 3d variables',
+                        required=False, default=download_dwd.levels_3d, nargs='+')
+    parser.add_argument('-s', '--stream', help='Keep polling the server and ingest every step as soon as it is published',
+                        required=False, action='store_true')
+    parser.add_argument('-p', '--poll', help='Seconds between two listings of the server when streaming',
+                        required=False, default=poll_interval, type=int)
+    parser.add_argument('--pack', help='Pack the fields in run_store.default_packing as 16 bit integers',
+                        required=False, action='store_true')
+    parser.add_argument('--points', help='Also write the point-major store used for meteograms and time series',
+                        required=False, action='store_true')
+    parser.add_argument('-c', '--crop', help='Only keep the box covering these projections (e.g. de it nord)',
+                        required=False, default=None, nargs='+', choices=list(domains.proj_defs))
+    parser.add_argument('-o', '--output', help='Folder where the run store is written',
+                        required=False, default=folder)
+    args = parser.parse_args()
+
+    try:
+        path = asyncio.run(stream_run(args.variables,
+                                      args.run or download_dwd.run_from_env(),
+                                      folder=args.output,
+                                      var_type=args.type,
+                                      wait=args.stream,
+                                      poll_interval=args.poll,
+                                      packing=run_store.default_packing if args.pack else {},
+                                      crop_projections=args.crop,
+                                      levels=args.levels,
+                                      points=args.points))
+    except IngestError as e:
+        # Non-zero exit, so that the scheduler (or cron) knows the run is incomplete
+        print_message('ERROR: %s' % e)
+        sys.exit(1)
+    print_message('Run store written in %s' % path)
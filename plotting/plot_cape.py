@@ -1,6 +1,5 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
@@ -47,7 +46,7 @@ def main():
     # additional maps adjustment for this map
     m.arcgisimage(service='World_Shaded_Relief', xpixels=1500)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat'])
 
     # All the arguments that need to be passed to the plotting function
     # we pass only arrays to avoid the pickle problem when unpacking in multiprocessing
@@ -61,8 +60,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
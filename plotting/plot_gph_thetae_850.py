@@ -1,10 +1,8 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-from computations import compute_thetae
-import metpy.calc as mpcalc
+import derived
 
 debug = False
 if not debug:
@@ -31,11 +29,8 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['t', 'relhum', 'pmsl'],
-                        level=85000,
-                        projection=projection)
-
-    dset = compute_thetae(dset)
+    dset = utils.read_dataset(variables=['pmsl'], projection=projection)
+    dset['theta_e'] = derived.get('theta_e', plev=85000, projection=projection).drop_vars('plev')
 
     cmap = plt.get_cmap('nipy_spectral')
 
@@ -45,15 +40,20 @@ def main():
     # Get coordinates from dataset
     m, x, y = utils.get_projection(dset, projection, labels=True)
 
-    dset = dset.drop(['lon', 'lat', 't', 'r']).load()
+    dset = dset.drop(['lon', 'lat'])
     dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset['prmsl'] = utils.smooth_field(dset['prmsl'], n=9, passes=10)
 
     levels_temp = np.arange(-10, 80, .5)
-    levels_mslp = np.arange(dset.prmsl.min().astype("int"),
-                            dset.prmsl.max().astype("int"), 4)
+    # prmsl of the whole run is already in memory (smoothed)
+    levels_mslp = utils.levels_range(dset['prmsl'], 4)
+
+    # H/L centres of all the time steps at once, the frames only draw them
+    maxima = utils.find_extrema(dset['prmsl'], 'max', 150)
+    minima = utils.find_extrema(dset['prmsl'], 'min', 150)
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax, cmap=cmap,
+    args = dict(maxima=maxima, minima=minima, x=x, y=y, ax=ax, cmap=cmap,
                 levels_temp=levels_temp,
                 levels_mslp=levels_mslp, time=dset.time)
 
@@ -64,8 +64,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes 
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
@@ -73,7 +72,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
@@ -93,10 +91,10 @@ def plot_files(dss, **args):
         labels = args['ax'].clabel(
             c, c.levels, inline=True, fmt='%4.0f', fontsize=6)
 
-        maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                       'max', 150, symbol='H', color='royalblue', random=True)
-        minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                       'min', 150, symbol='L', color='coral', random=True)
+        maxlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['maxima'][time],
+                                       symbol='H', color='royalblue')
+        minlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['minima'][time],
+                                       symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(
@@ -2,11 +2,10 @@ import seaborn as sns
 from matplotlib.colors import from_levels_and_colors
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-from computations import compute_snow_change
+import derived
 
 debug = False
 if not debug:
@@ -32,13 +31,11 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['h_snow', 'snowlmt'],
+    dset = utils.read_dataset(variables=['snowlmt'],
                               projection=projection)
-    dset['sde'] = dset['sde'].metpy.convert_units('cm').metpy.dequantify()
     dset['SNOWLMT'] = dset['SNOWLMT'].metpy.convert_units(
         'm').metpy.dequantify()
-
-    dset = compute_snow_change(dset)
+    dset['snow_increment'] = derived.get('snow_increment', projection=projection)
 
     levels_hsnow = (-50, -40, -30, -20, -10, -5, -2.5, -2, -1, -0.5,
                     0, 0.5, 1, 2, 2.5, 5, 10, 20, 30, 40, 50)
@@ -57,7 +54,7 @@ def main():
     #m.fillcontinents(color='lightgray',lake_color='whitesmoke', zorder=0)
     m.arcgisimage(service='Canvas/World_Dark_Gray_Base', xpixels=800)
 
-    dset = dset.drop(['lon', 'lat', 'sde']).load()
+    dset = dset.drop(['lon', 'lat'])
 
     # All the arguments that need to be passed to the plotting function
     args = dict(m=m, x=x, y=y, ax=ax, cmap=cmap, norm=norm,
@@ -71,8 +68,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
@@ -7,11 +7,14 @@ import numpy as np
 import pandas as pd
 import os
 import utils
+import run_store
+import derived
+import gazetteer
 import sys
 import matplotlib.dates as mdates
 from matplotlib.dates import DateFormatter
 from matplotlib import gridspec
-from matplotlib.offsetbox import annotationBbox, OffsetImage
+from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 from tqdm.contrib.concurrent import process_map
 import time
 import sys
@@ -26,52 +29,65 @@ else:
     cities = sys.argv[1:]
 
 
+# Units of the arrays drawn on the meteograms
+units_meteogram = {'t': 'degC', '2t': 'degC', '2d': 'degC', 'VMAX_10M': 'kph', 'prmsl': 'hPa'}
+
+
 def main():
     dset = utils.read_dataset(variables=['t_2m', 'td_2m', 't', 'vmax_10m',
-                                    'pmsl', 'HSURF', 'ww', 'relhum', 'u', 'v', 'clc'])
-    dset_prec = utils.read_dataset(variables=['rain_gsp', 'rain_con', 'snow_gsp', 'snow_con',], freq=None).rename_dims({'time':'time_fine'}).rename({'time':'time_fine'})
+                                    'pmsl', 'HSURF', 'ww', 'relhum', 'u', 'v', 'clc'],
+                              points=True)
+    dset_prec = utils.read_dataset(variables=['rain_gsp', 'snow_gsp'], freq=None)
+    # Rates over every 15 minutes step, computed once in the run store
+    dset_prec['rain_rate_15min'] = derived.get('rain_rate_15min', freq=None)
+    dset_prec['snow_rate_15min'] = derived.get('snow_rate_15min', freq=None)
+    dset_prec = dset_prec.rename_dims({'time':'time_fine'}).rename({'time':'time_fine'})
     dset = dset.merge(dset_prec)
-    # Subset dataset on cities and create iterator
-    it = []
-    for city in cities:
-        lon, lat = get_city_coordinates(city)
-        d = dset.sel(lon=lon, lat=lat, method='nearest').copy()
-        d.attrs['city'] = city
-        it.append(d)
-        del d
-    process_map(plot, it, max_workers=utils.processes, chunksize=2)
-
-
-def plot(dset_city):
-    city = dset_city.attrs['city']
+    # Select the nearest grid points of all cities at once, only their tiles are read
+    coordinates = gazetteer.locate(cities)
+    index = run_store.points_index(dset, [lat for _, lat in coordinates],
+                                   [lon for lon, _ in coordinates])
+    points = dset.isel(**index).load()
+    process_map(plot, city_bundles(points, cities), max_workers=utils.processes,
+                chunksize=2, total=len(cities))
+
+
+def city_bundles(points, cities):
+    """Yield the numpy arrays drawn on the meteogram of every city, converting
+    the units once for all cities"""
+    time_hourly, run, _ = utils.get_time_run_cum(points)
+    time_hourly = pd.DatetimeIndex(time_hourly)
+    time_prec = pd.DatetimeIndex(points['time_fine'].to_pandas())
+    plevs = points['t'].metpy.vertical.metpy.convert_units('hPa').metpy.dequantify().values
+    for name, unit in units_meteogram.items():
+        points[name] = points[name].metpy.convert_units(unit).metpy.dequantify()
+    points['rain'], points['snow'] = points['rain_rate_15min'], points['snow_rate_15min']
+    arrays = {name: points[name].transpose('point', ...).values
+              for name in ['t', 'r', 'u', 'v', '2t', '2d', 'VMAX_10M', 'prmsl', 'WW',
+                           'RAIN_GSP', 'SNOW_GSP', 'rain', 'snow', 'HSURF', 'lat', 'lon']}
+    for i, city in enumerate(cities):
+        bundle = {name: values[i] for name, values in arrays.items()}
+        bundle.update(city=city, run=run, time=time_hourly, time_prec=time_prec, plevs=plevs)
+        yield bundle
+
+
+def plot(bundle):
+    city = bundle['city']
     utils.print_message('Producing meteogram for %s' % city)
-    time_hourly, run, cum_hour = utils.get_time_run_cum(dset_city)
-    time_prec = dset_city['time_fine'].to_pandas()
-    t = dset_city['t'].load()
-    t = t.metpy.convert_units('degC').metpy.dequantify()
-    rh = dset_city['r'].load()
-    t2m = dset_city['2t'].load()
-    t2m = t2m.metpy.convert_units('degC').metpy.dequantify()
-    td2m = dset_city['2d'].load()
-    td2m = td2m.metpy.convert_units('degC').metpy.dequantify()
-    vmax_10m = dset_city['VMAX_10M'].load()
-    vmax_10m = vmax_10m.metpy.convert_units('kph').metpy.dequantify()
-    pmsl = dset_city['prmsl'].load()
-    pmsl = pmsl.metpy.convert_units('hPa').metpy.dequantify()
-    plevs = dset_city['t'].metpy.vertical.metpy.convert_units('hPa').metpy.dequantify()
-
-    rain_acc = dset_city['RAIN_GSP']
-    snow_acc = dset_city['SNOW_GSP']
-    rain = rain_acc.differentiate(coord="time_fine", datetime_unit="h")
-    snow = snow_acc.differentiate(coord="time_fine", datetime_unit="h")
-
-    weather_icons = utils.get_weather_icons(dset_city['WW'], time_hourly)
+    time_hourly, run, time_prec = bundle['time'], bundle['run'], bundle['time_prec']
+    t, rh, plevs = bundle['t'], bundle['r'], bundle['plevs']
+    t2m, td2m = bundle['2t'], bundle['2d']
+    vmax_10m, pmsl = bundle['VMAX_10M'], bundle['prmsl']
+    rain_acc, snow_acc = bundle['RAIN_GSP'], bundle['SNOW_GSP']
+    rain, snow = bundle['rain'], bundle['snow']
+
+    weather_icons = utils.get_weather_icons(bundle['WW'], time_hourly)
 
     fig = plt.figure(figsize=(10, 12))
     gs = gridspec.GridSpec(4, 1, height_ratios=[3, 1, 1, 1])
 
     ax0 = plt.subplot(gs[0])
-    cs = ax0.contourf(pd.to_datetime(dset_city.time.values), plevs, t.T, extend='both',
+    cs = ax0.contourf(time_hourly, plevs, t.T, extend='both',
                       cmap=utils.get_colormap("temp"), levels=np.arange(-70, 40, 2.5))
     ax0.axes.get_xaxis().set_ticklabels([])
     ax0.invert_yaxis()
@@ -81,16 +97,14 @@ def plot(dset_city):
     cbar_ax = fig.add_axes([0.92, 0.55, 0.02, 0.3])
     cs2 = ax0.contour(time_hourly, plevs, rh.T,
                       levels=np.linspace(0, 100, 5), colors='white', alpha=0.7)
-    dset_winds = dset_city.sel(time=pd.date_range(
-        dset_city.time[0].values, dset_city.time[-1].values, freq='3H'))
-    v = ax0.barbs(pd.to_datetime(dset_winds.time.values),
-                  plevs, dset_winds['u'].T, dset_winds['v'].T,
+    winds = np.asarray((time_hourly - time_hourly[0]) % pd.Timedelta('3H') == pd.Timedelta(0))
+    v = ax0.barbs(time_hourly[winds], plevs, bundle['u'][winds].T, bundle['v'][winds].T,
                   alpha=0.3, length=5.5)
     ax0.xaxis.set_major_locator(mdates.HourLocator(interval=6))
     ax0.grid(True, alpha=0.5)
     _ = utils.annotation_run(ax0, run)
     _ = utils.annotation(ax0, 'RH, $T$ and winds @(%3.1fN, %3.1fE, %d m)' %
-                                     (dset_city.lat, dset_city.lon, dset_city.HSURF),
+                                     (bundle['lat'], bundle['lon'], bundle['HSURF']),
                         loc='upper left')
     _ = utils.annotation(ax0, city, loc='upper center')
 
@@ -107,7 +121,7 @@ def plot(dset_city):
 
     for dt, weather_icon, dewp in zip(time_hourly, weather_icons, t2m):
         imagebox = OffsetImage(weather_icon, zoom=.025)
-        ab = utils.annotationBbox(
+        ab = AnnotationBbox(
             imagebox, (mdates.date2num(dt), dewp), frameon=False)
         ax1.add_artist(ab)
 
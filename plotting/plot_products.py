@@ -0,0 +1,215 @@
+import matplotlib.pyplot as plt
+from matplotlib.colorbar import make_axes
+import numpy as np
+import xarray as xr
+from functools import partial
+import argparse
+import utils
+import derived
+import run_store
+from products import products, values_density
+
+debug = False
+if not debug:
+    import matplotlib
+    matplotlib.use('Agg')
+
+# Engine rendering the products described in products.py. All products of a projection
+# are rendered together: the variables they need are read once, converted once and
+# every derived or smoothed field is computed once and shared by all products using it.
+# Options of the colorbar below the map of the products that have one
+colorbar_options = {'orientation': 'horizontal', 'pad': 0.03, 'fraction': 0.04}
+
+
+def field_name(layer, var='var'):
+    """Name of the field drawn by a layer, including level and smoothing"""
+    name = layer[var]
+    if layer.get('plev'):
+        name += '@%d' % layer['plev']
+    if layer.get('smooth'):
+        name += '~%d_%d' % tuple(layer['smooth'])
+
+    return name
+
+
+def layer_fields(spec):
+    """Fields (name, var, plev, smooth) drawn by the layers of a product"""
+    fields = []
+    for layer in spec['layers']:
+        for var in ['u', 'v'] if layer['type'] == 'quiver' else ['var']:
+            fields.append((field_name(layer, var), layer[var], layer.get('plev'), layer.get('smooth')))
+
+    return fields
+
+
+def read_products(names, projection):
+    """Read the variables of all products once and compute the fields they
+    draw. Returns a dataset with one (time, lat, lon) variable per field."""
+    specs = [products[name] for name in names]
+    variables, levels, units, derived_fields = [], set(), {}, {}
+    for spec in specs:
+        variables += [v for v in spec['variables'] if v not in variables]
+        levels.update(layer['plev'] for layer in spec['layers'] if layer.get('plev'))
+        for array, unit in spec.get('units', {}).items():
+            if units.setdefault(array, unit) != unit:
+                raise ValueError('%s is converted to %s and %s by different products' %
+                                 (array, units[array], unit))
+        derived_fields.update((d['name'], d) for d in spec.get('derived', []))
+    # Variables with and without pressure levels are read with two calls
+    variables_3d = [v for v in variables if v in run_store.variables_3d]
+    variables_2d = [v for v in variables if v not in variables_3d]
+    dsets = []
+    if variables_2d:
+        dsets.append(utils.read_dataset(variables=variables_2d, projection=projection))
+    if variables_3d:
+        dsets.append(utils.read_dataset(variables=variables_3d, level=sorted(levels),
+                                        projection=projection))
+    dset = xr.merge(dsets)
+    run = dset['run']
+    for array, unit in units.items():
+        dset[array] = dset[array].metpy.convert_units(unit).metpy.dequantify()
+    fields = {}
+    for name, d in derived_fields.items():
+        fields[name] = derived.get(d['field'], plev=d.get('plev'), projection=projection)
+    for spec in specs:
+        for name, var, plev, smooth in layer_fields(spec):
+            if name in fields:
+                continue
+            data = fields[var] if var in fields else dset[var]
+            if plev:
+                data = data.sel(plev=plev, method='nearest').drop_vars('plev')
+            if smooth:
+                data = utils.smooth_field(data, n=smooth[0], passes=smooth[1])
+            fields[name] = data
+    fields = xr.Dataset({name: field.reset_coords(drop=True) for name, field in fields.items()})
+    fields['run'] = run
+
+    return fields
+
+
+def prepare(name, projection, fields):
+    """Figure (shared with the workers), background and levels of one product"""
+    spec = products[name]
+    fig = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
+    ax = plt.gca()
+    m, x, y = utils.get_projection(fields, projection, labels=True)
+    if spec.get('background') == 'relief':
+        m.arcgisimage(service='World_Shaded_Relief', xpixels=1500)
+    if spec.get('colorbar') and any(layer['type'] == 'contourf' for layer in spec['layers']):
+        # The colorbar shrinks the map, its axes are added now so that the value labels
+        # are placed on the final map
+        make_axes(ax, **dict(colorbar_options, fraction=spec.get('colorbar_fraction', colorbar_options['fraction'])))
+    layers = []
+    for layer in spec['layers']:
+        layer = dict(layer)
+        if isinstance(layer.get('levels'), dict):
+            # One field read once for all the steps (smoothed fields are already in memory)
+            layer['levels'] = utils.levels_range(fields[field_name(layer)], layer['levels']['step'])
+        if 'cmap' in layer:
+            if layer.pop('norm', False):
+                layer['cmap'], layer['norm'] = utils.get_colormap_norm(layer['cmap'], layer['levels'])
+            else:
+                layer['cmap'] = utils.get_colormap(layer['cmap'])
+        if layer['type'] == 'maxmin':
+            # H/L centres of all the time steps at once, the frames only draw them
+            data = fields[field_name(layer)]
+            layer['maxima'] = utils.find_extrema(data, 'max', layer['size'])
+            layer['minima'] = utils.find_extrema(data, 'min', layer['size'])
+        if layer['type'] == 'values':
+            # Values written on the map of all the time steps at once, the frames only draw them
+            layer['labels'] = utils.value_labels(ax, projection, fields[field_name(layer)],
+                                                 layer['levels'], cmap=layer['cmap'],
+                                                 density=values_density.get(projection, 22))
+        layers.append(layer)
+
+    return dict(name=name, projection=projection, x=x, y=y, figure=utils.share_figure(fig),
+                layers=layers, annotation=spec.get('annotation'), colorbar=spec.get('colorbar'))
+
+
+def setup_renderer(args, fig):
+    """FrameRenderer with the layers of one product on its figure, kept by every
+    worker for all its frames"""
+    ax = fig.axes[0]
+    colorbar, filled = None, [i for i, layer in enumerate(args['layers']) if layer['type'] == 'contourf']
+    if filled and args['colorbar']:
+        def colorbar(artists):
+            fig.colorbar(artists[filled[0]], cax=fig.axes[1], label=args['colorbar'],
+                         orientation=colorbar_options['orientation'])
+    renderer = utils.FrameRenderer(ax, args['x'], args['y'], args['annotation'], colorbar=colorbar)
+    for layer in args['layers']:
+        options = {k: v for k, v in layer.items()
+                   if k not in ('type', 'var', 'u', 'v', 'plev', 'smooth', 'clabel', 'label_stroke',
+                                'highlight', 'size', 'density', 'maxima', 'minima', 'labels')}
+        if layer['type'] == 'contourf':
+            renderer.contourf(field_name(layer), **options)
+        elif layer['type'] == 'contour':
+            renderer.contour(field_name(layer), clabel=layer.get('clabel'),
+                             clabel_size=7 if layer.get('label_stroke') else 6,
+                             label_stroke=layer.get('label_stroke', False),
+                             highlight=layer.get('highlight'), **options)
+        elif layer['type'] == 'maxmin':
+            renderer.extrema(layer['maxima'], layer['minima'])
+        elif layer['type'] == 'quiver':
+            renderer.quiver(field_name(layer, 'u'), field_name(layer, 'v'), layer['density'], **options)
+        elif layer['type'] == 'values':
+            renderer.values(layer['labels'])
+        else:
+            raise ValueError('Unknown layer type %s' % layer['type'])
+
+    return renderer
+
+
+def plot_files(dss, args):
+    renderer = utils.frame_renderer(args['figure'], partial(setup_renderer, args))
+    for time_sel in dss.time:
+        data = dss.sel(time=time_sel)
+        _, _, cum_hour = utils.get_time_run_cum(data)
+        # Build the name of the output image
+        filename = utils.subfolder_images[args['projection']] + \
+            '/' + args['name'] + '_%s.png' % cum_hour
+
+        renderer.draw(data)
+
+        if debug:
+            plt.show(block=True)
+        else:
+            renderer.save(filename)
+
+
+def plot_chunk(chunk):
+    plot_files(*chunk)
+
+
+def main(names, projections):
+    """Render all products for every projection, the chunks of all products
+    of a projection are rendered by one Pool"""
+    for projection in projections:
+        fields = read_products(names, projection)
+        utils.print_message('Read %d fields for %s' % (len(fields.data_vars), projection))
+        chunks = []
+        for name in names:
+            args = prepare(name, projection, fields)
+            needed = [f for f, _, _, _ in layer_fields(products[name])]
+            dset = fields[needed + ['run']]
+            if debug:
+                plot_files(dset.isel(time=slice(0, 2)), args)
+            else:
+                chunks += [(dss, args) for dss in utils.chunks_dataset(dset, utils.chunks_size)]
+        if chunks:
+            utils.map_chunks(plot_chunk, chunks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', help='Products of products.py to render',
+                        required=False, default=list(products), nargs='+', choices=list(products))
+    parser.add_argument('--projections', help='Projections to render',
+                        required=False, default=['de'], nargs='+')
+    args = parser.parse_args()
+
+    import time
+    start_time = time.time()
+    main(args.products, args.projections)
+    elapsed_time = time.time() - start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
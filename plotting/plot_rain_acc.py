@@ -1,9 +1,7 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-import metpy.calc as mpcalc
 
 debug = False
 if not debug:
@@ -30,9 +28,12 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
+    # tot_prec is already the accumulation since the start of the run that is drawn,
+    # the totals over intervals (derived.py) are not needed here
     dset = utils.read_dataset(variables=['tot_prec', 'pmsl'],
                         projection=projection)
     dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset['prmsl'] = utils.smooth_field(dset['prmsl'], n=9, passes=10)
 
     levels_precip = list(np.arange(1, 50, 0.4)) + \
                     list(np.arange(51, 100, 2)) +\
@@ -50,13 +51,17 @@ def main():
     # additional maps adjustment for this map
     m.arcgisimage(service='World_Shaded_Relief', xpixels = 1500)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat'])
 
-    levels_mslp = np.arange(dset['prmsl'].min().astype("int"),
-                    dset['prmsl'].max().astype("int"), 4.)
+    # prmsl of the whole run is already in memory (smoothed)
+    levels_mslp = utils.levels_range(dset['prmsl'], 4.)
+
+    # H/L centres of all the time steps at once, the frames only draw them
+    maxima = utils.find_extrema(dset['prmsl'], 'max', 150)
+    minima = utils.find_extrema(dset['prmsl'], 'min', 150)
 
     # All the arguments that need to be passed to the plotting function
-    args=dict(x=x, y=y, ax=ax,
+    args=dict(maxima=maxima, minima=minima, x=x, y=y, ax=ax,
              levels_precip=levels_precip,
              levels_mslp=levels_mslp, time=dset.time,
              cmap=cmap, norm=norm)
@@ -68,15 +73,13 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
@@ -94,10 +97,10 @@ def plot_files(dss, **args):
 
         labels = args['ax'].clabel(c, c.levels, inline=True, fmt='%4.0f' , fontsize=6)
 
-        maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                        'max', 150, symbol='H', color='royalblue', random=True)
-        minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                        'min', 150, symbol='L', color='coral', random=True)
+        maxlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['maxima'][time],
+                                       symbol='H', color='royalblue')
+        minlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['minima'][time],
+                                       symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'Accumulated precipitation and MSLP [hPa]',
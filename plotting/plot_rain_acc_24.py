@@ -1,7 +1,7 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
+import derived
 import sys
 
 debug = False
@@ -29,8 +29,11 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['tot_prec'],
-                        projection=projection)
+    dset = derived.get('tot_prec_24h', projection=projection).to_dataset(name='tp')
+    # Only the totals of the days since the run, whose first step is the run
+    dset['run'] = dset['time'][0].reset_coords(drop=True)
+    hours = ((dset['time'] - dset['run']) / np.timedelta64(1, 'h')).values
+    dset = dset.isel(time=np.flatnonzero((hours > 0) & (hours % 24 == 0)))
 
     levels_precip = list(np.arange(1, 50, 0.4)) + \
                     list(np.arange(51, 100, 2)) +\
@@ -39,9 +42,6 @@ def main():
                     list(np.arange(501, 1000, 50)) + \
                     list(np.arange(1001, 2000, 100))
 
-    dset = dset.resample(time="24H",
-                         base=dset.time[0].dt.hour.item()).nearest().diff(dim='time')
-
     cmap, norm = utils.get_colormap_norm('rain_acc_wxcharts', levels=levels_precip)
 
     _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
@@ -51,7 +51,7 @@ def main():
     # additional maps adjustment for this map
     m.arcgisimage(service='World_Shaded_Relief', xpixels = 1500)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat'])
 
     # All the arguments that need to be passed to the plotting function
     args=dict(x=x, y=y, ax=ax,
@@ -65,8 +65,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
@@ -1,11 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-from computations import compute_rate
-import metpy.calc as mpcalc
+import derived
 
 debug = False
 if not debug:
@@ -31,14 +29,14 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['rain_gsp',
-                                         'snow_gsp',
-                                         'pmsl', 'clcl', 'clch'],
+    dset = utils.read_dataset(variables=['pmsl', 'clcl', 'clch'],
                               projection=projection)
     # Convert to hourly data
     dset = dset.resample(time="1H").nearest(tolerance="1H")
-    dset = compute_rate(dset)
+    dset['rain_rate'] = derived.get('rain_rate', projection=projection)
+    dset['snow_rate'] = derived.get('snow_rate', projection=projection)
     dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset['prmsl'] = utils.smooth_field(dset['prmsl'], n=9, passes=10)
 
     levels_rain = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                    5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
@@ -61,12 +59,16 @@ def main():
     # m.drawmapboundary(fill_color='whitesmoke')
     #m.fillcontinents(color='lightgray',lake_color='whitesmoke', zorder=1)
 
-    dset = dset.drop(['lon', 'lat', 'RAIN_GSP', 'SNOW_GSP']).load()
+    dset = dset.drop(['lon', 'lat'])
 
-    levels_mslp = np.arange(dset['prmsl'].min().astype("int"),
-                            dset['prmsl'].max().astype("int"), 4.)
+    # prmsl of the whole run is already in memory (smoothed)
+    levels_mslp = utils.levels_range(dset['prmsl'], 4.)
 
-    args = dict(x=x, y=y, ax=ax,
+    # H/L centres of all the time steps at once, the frames only draw them
+    maxima = utils.find_extrema(dset['prmsl'], 'max', 150)
+    minima = utils.find_extrema(dset['prmsl'], 'min', 150)
+
+    args = dict(maxima=maxima, minima=minima, x=x, y=y, ax=ax,
                 levels_mslp=levels_mslp, levels_rain=levels_rain, levels_snow=levels_snow,
                 levels_clouds=levels_clouds, time=dset.time,
                 cmap_rain=cmap_rain, cmap_snow=cmap_snow, cmap_clouds=cmap_clouds,
@@ -79,16 +81,13 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(
-            data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
@@ -113,10 +112,10 @@ def plot_files(dss, **args):
         labels = args['ax'].clabel(
             c, c.levels, inline=True, fmt='%4.0f', fontsize=6)
 
-        maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'max', 150, symbol='H', color='royalblue', random=True)
-        minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'min', 150, symbol='L', color='coral', random=True)
+        maxlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['maxima'][time],
+                                       symbol='H', color='royalblue')
+        minlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['minima'][time],
+                                       symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'],
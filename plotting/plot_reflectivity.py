@@ -1,5 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
@@ -54,8 +53,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
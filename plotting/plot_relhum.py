@@ -1,9 +1,8 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-from computations import compute_geopot_height
+import derived
 
 debug = False
 if not debug:
@@ -31,9 +30,9 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['relhum', 'fi'], level=[l * 100 for l in levels],
+    dset = utils.read_dataset(variables=['relhum'], level=[l * 100 for l in levels],
                         projection=projection)
-    dset = compute_geopot_height(dset)
+    dset['geop'] = derived.get('geop', plev=[l * 100 for l in levels], projection=projection)
     cmap = utils.get_colormap('rh')
     levels_rh = np.arange(10, 100, 5)
 
@@ -47,10 +46,14 @@ def main():
         ax = plt.gca()
         # Get coordinates from dataset
         m, x, y = utils.get_projection(dset_level, projection, labels=True)
-        dset_level = dset_level.drop(['lon', 'lat', 'z']).load()
+        dset_level = dset_level.drop(['lon', 'lat'])
+
+        # H/L centres of all the time steps at once, the frames only draw them
+        maxima = utils.find_extrema(dset_level['geop'], 'max', 100)
+        minima = utils.find_extrema(dset_level['geop'], 'min', 100)
 
         # All the arguments that need to be passed to the plotting function
-        args=dict(x=x, y=y, ax=ax, cmap=cmap, level=level,
+        args=dict(maxima=maxima, minima=minima, x=x, y=y, ax=ax, cmap=cmap, level=level,
                   levels_rh=levels_rh, levels_gph=levels_gph,
                   time=dset_level.time, projection=projection)
 
@@ -61,8 +64,7 @@ def main():
             # Parallelize the plotting by dividing into chunks and utils.processes 
             dss = utils.chunks_dataset(dset_level, utils.chunks_size)
             plot_files_param = partial(plot_files, **args)
-            p = Pool(utils.processes)
-            p.map(plot_files_param, dss)
+            utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
@@ -82,10 +84,10 @@ def plot_files(dss, **args):
 
         labels = args['ax'].clabel(c, c.levels, inline=True, fmt='%4.0f' , fontsize=6)
 
-        maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['geop'],
-                                       'max', 100, symbol='H', color='royalblue', random=True)
-        minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['geop'], 
-                                       'min', 100, symbol='L', color='coral', random=True)
+        maxlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['maxima'][time],
+                                       symbol='H', color='royalblue')
+        minlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['minima'][time],
+                                       symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'RH and Geopotential at '+str(args['level'])+' hPa' ,loc='lower left', fontsize=6)
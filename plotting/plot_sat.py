@@ -1,5 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
@@ -60,10 +59,10 @@ def main():
     # Get coordinates from dataset
     m, x, y = utils.get_projection(dset, projection, labels=True, color_borders='white')
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat'])
 
-    levels_mslp   = np.arange(dset['prmsl'].min().astype("int"),
-                              dset['prmsl'].max().astype("int"), 4.)
+    # Only prmsl is read for all the steps here (once), the workers read the other variables
+    levels_mslp = utils.levels_range(dset['prmsl'], 4.)
 
     args=dict(x=x, y=y, ax=ax,
          levels_mslp=levels_mslp, levels_rain=levels_rain, levels_snow=levels_snow,
@@ -79,8 +78,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 def plot_files(dss, **args):
@@ -1,5 +1,4 @@
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
@@ -42,13 +41,17 @@ def main():
     ax = plt.gca()
     # Get coordinates from dataset
     m, x, y = utils.get_projection(dset, projection, labels=True)
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.drop(['lon', 'lat'])
 
     levels_mslp = np.arange(np.nanmin(dset.prmsl).astype("int"),
                     np.nanmax(dset.prmsl).astype("int"), 7.)
 
+    # H/L centres of all the time steps at once, the frames only draw them
+    maxima = utils.find_extrema(dset['prmsl'], 'max', 80)
+    minima = utils.find_extrema(dset['prmsl'], 'min', 80)
+
     # All the arguments that need to be passed to the plotting function
-    args=dict(x=x, y=y, ax=ax, cmap=cmap,
+    args=dict(maxima=maxima, minima=minima, x=x, y=y, ax=ax, cmap=cmap,
              levels_temp=levels_temp, levels_mslp=levels_mslp)
 
     utils.print_message('Pre-processing finished, launching plotting scripts')
@@ -58,8 +61,7 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes 
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
 
 
 
@@ -79,10 +81,10 @@ def plot_files(dss, **args):
 
         labels = args['ax'].clabel(c, c.levels, inline=True, fmt='%4.0f' , fontsize=6)
 
-        maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                       'max', 80, symbol='H', color='royalblue', random=True)
-        minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'], 
-                                       'min', 80, symbol='L', color='coral', random=True)
+        maxlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['maxima'][time],
+                                       symbol='H', color='royalblue')
+        minlabels = utils.plot_extrema(args['ax'], args['x'], args['y'], args['minima'][time],
+                                       symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'MSLP [hPa] and temperature @850hPa [C]',
@@ -1,17 +1,9 @@
-import numpy as np
-from multiprocessing import Pool
-from functools import partial
-import utils
 import sys
+import utils
+import plot_products
 
-debug = False
-if not debug:
-    import matplotlib
-    matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
-
-# The one employed for the figure name when exported 
+# The map is described by the product 'tmin' of products.py and rendered by plot_products.py,
+# this script is kept for the callers of the old one: python plot_tmin.py [projection]
 variable_name = 'tmin'
 
 utils.print_message('Starting script to plot '+variable_name)
@@ -27,81 +19,7 @@ else:
 
 
 def main():
-    """In the main function we basically read the files and prepare the variables to be plotted.
-    This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['tmin_2m'], projection=projection)
-    dset['TMIN_2M'] = dset['TMIN_2M'].metpy.convert_units('degC').metpy.dequantify()
-
-    levels_t2m = np.arange(-25, 40, 1)
-
-    cmap = utils.get_colormap("temp")
-
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-
-    ax  = plt.gca()
-    m, x, y = utils.get_projection(dset, projection, labels=True)
-    
-    dset = dset.load()
-
-    # All the arguments that need to be passed to the plotting function
-    args=dict(x=x, y=y, ax=ax, cmap=cmap,
-             levels_t2m=levels_t2m,
-             time=dset.time)
-
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(0, 2)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
-
-
-def plot_files(dss, **args):
-    first = True
-    for time_sel in dss.time:
-        data = dss.sel(time=time_sel)
-        time, run, cum_hour = utils.get_time_run_cum(data)
-        # Build the name of the output image
-        filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
-
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['TMIN_2M'],
-                                 extend='both',
-                                 cmap=args['cmap'],
-                                 levels=args['levels_t2m'])
-
-        # plot every -th element
-        if projection=="nord":
-            density = 9
-        elif projection=="it":
-            density = 11
-        elif projection=="de":
-            density = 15
-        vals = utils.add_vals_on_map(args['ax'], projection,
-                               data['TMIN_2M'], args['levels_t2m'],
-                               cmap=args['cmap'],
-                               density=density)
-
-        an_fc = utils.annotation_forecast(args['ax'], time)
-        an_var = utils.annotation(args['ax'], 'Minimum 2m Temperature in previous 6 hours',
-                            loc='lower left', fontsize=6)
-        an_run = utils.annotation_run(args['ax'], run)
-        
-
-        if first:
-            plt.colorbar(cs, orientation='horizontal', label='Temperature [C]', pad=0.03, fraction=0.04)
-        
-        if debug:
-            plt.show(block=True)
-        else:
-            plt.savefig(filename, **utils.options_savefig)        
-
-        utils.remove_collections([cs, an_fc, an_var, an_run, vals])
-
-        first = False
+    plot_products.main([variable_name], [projection])
 
 
 if __name__ == "__main__":
@@ -1,10 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
 from functools import partial
 import utils
 import sys
-from computations import compute_snow_change
+import derived
 import xarray as xr
 
 debug = False
@@ -31,15 +30,14 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['rain_gsp', 'h_snow', 'snowlmt'],
+    dset = utils.read_dataset(variables=['rain_gsp', 'snowlmt'],
                               projection=projection)
     dset = dset.resample(time="1H").nearest(tolerance="1H")
 
     rain = (dset['RAIN_GSP'] - dset['RAIN_GSP'][0, :, :])
     rain = xr.DataArray(rain, name='rain_increment')
 
-    dset['sde'] = dset['sde'].metpy.convert_units('cm').metpy.dequantify()
-    dset = compute_snow_change(dset)
+    dset['snow_increment'] = derived.get('snow_increment', projection=projection)
 
     dset = xr.merge([dset, rain])
     dset['SNOWLMT'] = dset['SNOWLMT'].metpy.convert_units(
@@ -60,13 +58,19 @@ def main():
     m, x, y = utils.get_projection(dset, projection, labels=True)
     m.arcgisimage(service='Canvas/World_Dark_Gray_Base', xpixels=1000)
 
-    dset = dset.drop(['RAIN_GSP', 'sde']).load()
+    dset = dset.drop(['RAIN_GSP'])
 
-    # All the arguments that need to be passed to the plotting function
-    args = dict(m=m, x=x, y=y, ax=ax,
+    # Values of new snow written on the map of all the time steps at once, the frames only draw them
+    labels = utils.value_labels(ax, projection,
+                                dset['snow_increment'].where(dset['snow_increment'] >= 1),
+                                levels_snow, cmap=cmap_snow, norm=norm_snow, density=10)
+
+    # All the arguments that need to be passed to the plotting function, the figure
+    # is sent once to every worker instead of with every chunk
+    args = dict(figure=utils.share_figure(ax.figure), x=x, y=y,
                 levels_snowlmt=levels_snowlmt, levels_rain=levels_rain,
                 levels_snow=levels_snow,
-                norm_snow=norm_snow,
+                norm_snow=norm_snow, labels=labels,
                 cmap_rain=cmap_rain, cmap_snow=cmap_snow, norm_rain=norm_rain)
 
     utils.print_message('Pre-processing finished, launching plotting scripts')
@@ -76,63 +80,48 @@ def main():
         # Parallelize the plotting by dividing into chunks and utils.processes
         dss = utils.chunks_dataset(dset, utils.chunks_size)
         plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        utils.map_chunks(plot_files_param, dss)
+
+
+def add_colorbars(ax, artists):
+    ax_cbar, ax_cbar_2 = utils.divide_axis_for_cbar(ax, pad=-3)
+    ax.figure.colorbar(artists[1], cax=ax_cbar, orientation='horizontal', label='Snow')
+    ax.figure.colorbar(artists[0], cax=ax_cbar_2, orientation='horizontal', label='Rain')
+
+
+def setup_renderer(fig, **args):
+    """Layers of the figure kept by every worker for all its frames"""
+    ax = fig.axes[0]
+    renderer = utils.FrameRenderer(ax, args['x'], args['y'],
+                                   'New snow and accumulated rain (since run start)',
+                                   colorbar=partial(add_colorbars, ax))
+    renderer.contourf('rain_increment', extend='max', cmap=args['cmap_rain'], norm=args['norm_rain'],
+                      levels=args['levels_rain'], alpha=0.5, antialiased=True)
+    renderer.contourf('snow_increment', extend='max', cmap=args['cmap_snow'], norm=args['norm_snow'],
+                      levels=args['levels_snow'], antialiased=True)
+    renderer.contour('SNOWLMT', clabel='%4.0f', clabel_size=5, levels=args['levels_snowlmt'],
+                     colors='red', linewidths=0.5)
+    renderer.values(args['labels'])
+
+    return renderer
 
 
 def plot_files(dss, **args):
     # Using args we don't have to change the prototype function if we want to add other parameters!
-    first = True
+    renderer = utils.frame_renderer(args['figure'], partial(setup_renderer, **args))
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        time, run, cum_hour = utils.get_time_run_cum(data)
+        _, _, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs_rain = args['ax'].contourf(args['x'], args['y'], data['rain_increment'],
-                                      extend='max', cmap=args['cmap_rain'], norm=args['norm_rain'],
-                                      levels=args['levels_rain'], alpha=0.5, antialiased=True)
-        cs_snow = args['ax'].contourf(args['x'], args['y'], data['snow_increment'],
-                                      extend='max', cmap=args['cmap_snow'], norm=args['norm_snow'],
-                                      levels=args['levels_snow'], antialiased=True)
-
-        c = args['ax'].contour(args['x'], args['y'], data['SNOWLMT'], levels=args['levels_snowlmt'],
-                               colors='red', linewidths=0.5)
-
-        labels = args['ax'].clabel(
-            c, c.levels, inline=True, fmt='%4.0f', fontsize=5)
-
-        vals = utils.add_vals_on_map(args['ax'],
-                                     projection,
-                                     data['snow_increment'].where(
-                                         data['snow_increment'] >= 1),
-                                     args['levels_snow'],
-                                     cmap=args['cmap_snow'],
-                                     norm=args['norm_snow'],
-                                     density=10)
-
-        an_fc = utils.annotation_forecast(args['ax'], time)
-        an_var = utils.annotation(args['ax'], 'New snow and accumulated rain (since run start)',
-                                  loc='lower left', fontsize=6)
-        an_run = utils.annotation_run(args['ax'], run)
-
-        if first:
-            ax_cbar, ax_cbar_2 = utils.divide_axis_for_cbar(args['ax'], pad=-3)
-            cbar_snow = plt.gcf().colorbar(cs_snow, cax=ax_cbar, orientation='horizontal',
-                                           label='Snow')
-            cbar_rain = plt.gcf().colorbar(cs_rain, cax=ax_cbar_2, orientation='horizontal',
-                                           label='Rain')
+        renderer.draw(data)
 
         if debug:
             plt.show(block=True)
         else:
-            plt.savefig(filename, **utils.options_savefig)
-
-        utils.remove_collections(
-            [cs_rain, cs_snow, c, labels, an_fc, an_var, an_run, vals])
-
-        first = False
+            renderer.save(filename)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,251 @@
+import os
+import io
+import json
+import threading
+import argparse
+import functools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import zarr
+import run_store
+from download_dwd import print_message
+
+# HTTP service answering point forecasts from the current run store, e.g.
+#   GET /point?lat=53.55&lon=9.99&vars=t_2m,tot_prec[&method=bilinear][&format=arrow]
+# The values are read from the point-major store when the variable is there (one tile),
+# otherwise from the run store. Answers are kept in a LRU cache keyed by grid point and
+# the server switches to a new run once all its variables are complete.
+if 'MODEL_DATA_FOLDER' in os.environ:
+    folder = os.environ['MODEL_DATA_FOLDER']
+else:
+    folder = '/home/ekman/ssd/guido/icon-d2/'
+port = 8090
+# Answers kept in memory
+cache_size = 4096
+# Seconds between two checks for a new run
+reload_interval = 30
+default_variables = ['t_2m']
+
+
+def points_catalog(path):
+    """Catalog of the arrays already complete in the point-major companion of
+    the store at path (see run_store.write_points), empty if there is none"""
+    points_path = run_store.points_path(path)
+    if not os.path.isfile(os.path.join(points_path, '.zmetadata')):
+        return {}
+
+    return zarr.open_consolidated(points_path, mode='r').attrs.get('catalog', {})
+
+
+class RunData():
+    """Arrays of the run store at path (and of its point-major companion) opened for point queries.
+    Only the hourly steps are served."""
+    def __init__(self, path):
+        self.path = path
+        group = zarr.open_group(path, mode='r')
+        # An array of the point-major store is being copied until it is in its catalog
+        self.points_catalog = points_catalog(path)
+        points = zarr.open_consolidated(run_store.points_path(path), mode='r') if self.points_catalog else None
+        self.run = pd.to_datetime(group.attrs['run'], format='%Y%m%d%H')
+        self.catalog = {var: entry for var, entry in group.attrs['catalog'].items()
+                        if not var.endswith(run_store.fine_suffix)}
+        self.lat, self.lon = group['lat'][:], group['lon'][:]
+        self.time = [(self.run + pd.Timedelta(hours=int(h))).strftime('%Y-%m-%dT%H:%MZ')
+                     for h in group['time'][:]]
+        self.plev = group['plev'][:] if 'plev' in group else None
+        self.arrays = {}
+        for var, entry in self.catalog.items():
+            name = entry['array']
+            self.arrays[var] = points[name] if self.points_catalog.get(var, {}).get('array') == name else group[name]
+
+    def check(self, lat, lon):
+        if not (self.lat[0] <= lat <= self.lat[-1] and self.lon[0] <= lon <= self.lon[-1]):
+            raise ValueError('(%s, %s) is outside of the domain' % (lat, lon))
+
+    def index(self, lat, lon, method='nearest'):
+        """Grid points and weights used to answer (lat, lon): a (lat, lon) slice
+        of the grid and the weights of its points"""
+        self.check(lat, lon)
+        if method == 'nearest':
+            ilat = int(run_store.nearest_index(self.lat, lat)[0])
+            ilon = int(run_store.nearest_index(self.lon, lon)[0])
+            return (slice(ilat, ilat + 1), slice(ilon, ilon + 1)), np.ones((1, 1))
+        if method == 'bilinear':
+            ilat = int(np.clip(np.searchsorted(self.lat, lat) - 1, 0, len(self.lat) - 2))
+            ilon = int(np.clip(np.searchsorted(self.lon, lon) - 1, 0, len(self.lon) - 2))
+            wlat = (lat - self.lat[ilat]) / (self.lat[ilat + 1] - self.lat[ilat])
+            wlon = (lon - self.lon[ilon]) / (self.lon[ilon + 1] - self.lon[ilon])
+            return ((slice(ilat, ilat + 2), slice(ilon, ilon + 2)),
+                    np.outer([1 - wlat, wlat], [1 - wlon, wlon]))
+        raise ValueError('Unknown method %s' % method)
+
+    def values(self, var, window, weights):
+        """Values of var (time[, plev]) at the grid points of window combined with weights"""
+        if var not in self.arrays:
+            raise ValueError('%s is not in run %s' % (var, self.run.strftime('%Y%m%d%H')))
+        arr = self.arrays[var]
+        values = arr[(Ellipsis,) + window].astype('float64')
+        if arr.dtype == np.int16:
+            values[values == run_store.int16_fill_value] = np.nan
+            values = values * arr.attrs['scale_factor'] + arr.attrs['add_offset']
+
+        return (values * weights).sum(axis=(-2, -1))
+
+
+def load_run(folder=folder):
+    """RunData of the current run in folder, None if there is no store"""
+    path = run_store.find_latest_store(folder)
+    if path and os.path.isfile(os.path.join(path, '.zmetadata')):
+        return RunData(path)
+
+
+def complete(path, variables=()):
+    """Whether all steps of the variables of the store at path (at least of variables) are ready.
+    The 15 minutes steps are ready with the hourly ones of their variable."""
+    catalog = zarr.open_group(path, mode='r').attrs.get('catalog', {})
+    if not set(variables) <= set(catalog):
+        return False
+    steps = set(range(run_store.forecast_hours + 1))
+    ready = run_store.ready_steps(path)
+    ready = {var: ready.get(var[:-len(run_store.fine_suffix)] if var.endswith(run_store.fine_suffix)
+                            else var, set()) for var in catalog}
+
+    return all(steps <= ready[var] or (entry['dims'] == ['lat', 'lon'] and 0 in ready[var])
+               for var, entry in catalog.items())
+
+
+@functools.lru_cache(maxsize=cache_size)
+def answer(data, lat, lon, variables, method, fmt):
+    """Body and content type of the answer to a query on data"""
+    window, weights = data.index(lat, lon, method)
+    values = {var: data.values(var, window, weights) for var in variables}
+    if fmt == 'arrow':
+        return arrow_table(data, values), 'application/vnd.apache.arrow.stream'
+    result = {'run': data.run.strftime('%Y%m%d%H'), 'method': method,
+              'lat': float(data.lat[window[0]].mean()), 'lon': float(data.lon[window[1]].mean()),
+              'time': data.time, 'variables': {}}
+    for var, v in values.items():
+        entry = data.catalog[var]
+        result['variables'][var] = {'units': entry['units'],
+                                    'values': np.where(np.isnan(v), None, np.round(v, 3)).tolist()}
+        if entry['levels']:
+            result['variables'][var]['levels'] = entry['levels']
+
+    return json.dumps(result).encode(), 'application/json'
+
+
+def arrow_table(data, values):
+    """Arrow IPC stream with one row per time step and one column per variable
+    (and level), pyarrow is only needed for this format"""
+    import pyarrow as pa
+    columns = {'time': pa.array(pd.to_datetime(data.time).tz_localize(None))}
+    for var, v in values.items():
+        if v.ndim == 0:
+            columns[var] = pa.array(np.full(len(data.time), v))
+        elif v.ndim == 1:
+            columns[var] = pa.array(v)
+        else:
+            for ilevel, level in enumerate(data.catalog[var]['levels']):
+                columns['%s@%d' % (var, level / 100)] = pa.array(v[:, ilevel])
+    table = pa.table(columns)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/point':
+            return self.reply(404, {'error': 'Only /point is served'})
+        data = self.server.data
+        if data is None:
+            return self.reply(503, {'error': 'No run available yet'})
+        query = parse_qs(url.query)
+        try:
+            lat, lon = float(query['lat'][0]), float(query['lon'][0])
+            variables = tuple(v.lower() for v in
+                              ','.join(query.get('vars', default_variables)).split(','))
+            method = query.get('method', ['nearest'])[0]
+            fmt = query.get('format', ['json'])[0]
+            data.check(lat, lon)
+            if method == 'nearest':
+                # All queries answered by the same grid point share the cache entry
+                lat = float(data.lat[run_store.nearest_index(data.lat, lat)[0]])
+                lon = float(data.lon[run_store.nearest_index(data.lon, lon)[0]])
+            body, content_type = answer(data, lat, lon, variables, method, fmt)
+        except (KeyError, ValueError, ImportError) as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(200, body, content_type)
+
+    def reply(self, code, body, content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def watch(server, folder=folder, interval=reload_interval):
+    """Switch the server to the current run of folder once it is complete, and
+    reopen it when more of its variables are complete in the point-major store"""
+    while not server.stopped.wait(interval):
+        path = run_store.find_latest_store(folder)
+        current = server.data.path if server.data else None
+        if not path:
+            continue
+        try:
+            if path == current:
+                if set(points_catalog(path)) == set(server.data.points_catalog):
+                    continue
+            elif not complete(path, server.data.catalog if server.data else ()):
+                continue
+            # The queries already running keep using the old run
+            server.data = RunData(path)
+            answer.cache_clear()
+            print_message('Switched to %s' % path)
+        except Exception as e:
+            print_message('WARNING: could not open %s (%s)' % (path, e))
+
+
+def make_server(folder=folder, host='localhost', port=port, interval=reload_interval):
+    """Server (not started yet) answering from the runs of folder"""
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.data = load_run(folder)
+    server.stopped = threading.Event()
+    threading.Thread(target=watch, args=(server, folder, interval), daemon=True).start()
+
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--folder', help='Folder with the run stores',
+                        required=False, default=folder)
+    parser.add_argument('--host', help='Address to listen on',
+                        required=False, default='localhost')
+    parser.add_argument('-p', '--port', help='Port to listen on',
+                        required=False, default=port, type=int)
+    parser.add_argument('-i', '--interval', help='Seconds between two checks for a new run',
+                        required=False, default=reload_interval, type=int)
+    args = parser.parse_args()
+
+    server = make_server(args.folder, args.host, args.port, args.interval)
+    print_message('Listening on %s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    finally:
+        server.stopped.set()
+        server.server_close()
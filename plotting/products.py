@@ -0,0 +1,128 @@
+import numpy as np
+
+# Declarative description of the maps rendered by plot_products.py.
+# Every product has
+#   variables: DWD variables read (as in utils.read_dataset)
+#   units: units to which arrays are converted (once for all products)
+#   derived: fields of the registry of derived.py (computed once per run in the store),
+#            {'name', 'field' (name in the registry), 'plev' (optional)}
+#   layers: drawn in this order, every one with a 'type'
+#       contourf/contour: 'var', 'levels' (array or {'step': ...} to span the run min/max),
+#                         'plev', 'smooth' (n, passes), 'cmap', 'norm', 'clabel' (format),
+#                         'highlight' (index of the line drawn thicker) and matplotlib options
+#       maxmin: H/L labels of 'var' with 'size' as in utils.find_extrema
+#       quiver: vectors of 'u' and 'v' every 'density' points
+#       values: values of 'var' on the map as in utils.value_labels
+#   background: 'relief' to draw the ArcGIS shaded relief
+#   annotation: text in the lower left corner
+#   colorbar: label of the colorbar of the first contourf
+#   colorbar_fraction: fraction of the figure taken by the colorbar (default in plot_products.py)
+# The name of every product is the prefix of its images, as variable_name in the scripts.
+mslp_contours = {'type': 'contour', 'var': 'prmsl', 'smooth': (9, 10), 'clabel': '%4.0f',
+                 'colors': 'white', 'linewidths': 1.}
+mslp_extrema = {'type': 'maxmin', 'var': 'prmsl', 'smooth': (9, 10), 'size': 100}
+
+products = {
+    'winds10m': {
+        'variables': ['vmax_10m', 'pmsl', 'u_10m', 'v_10m'],
+        'units': {'VMAX_10M': 'kph', 'prmsl': 'hPa'},
+        'layers': [
+            {'type': 'contourf', 'var': 'VMAX_10M', 'levels': np.linspace(0, 255., 178),
+             'cmap': 'winds_wxcharts', 'norm': True, 'extend': 'max'},
+            dict(mslp_contours, levels={'step': 4.}, colors='red'),
+            mslp_extrema,
+            {'type': 'quiver', 'u': '10u', 'v': '10v', 'density': 15, 'alpha': 0.5, 'color': 'gray'},
+        ],
+        'background': 'relief',
+        'annotation': '10m Winds direction and max. wind gust',
+        'colorbar': 'Wind [km/h]',
+        'colorbar_fraction': 0.035,
+    },
+    't_v_pres': {
+        'variables': ['u_10m', 'v_10m', 't_2m', 'pmsl'],
+        'units': {'2t': 'degC', 'prmsl': 'hPa'},
+        'layers': [
+            {'type': 'contourf', 'var': '2t', 'levels': np.arange(-25, 45, 1), 'cmap': 'temp',
+             'extend': 'both'},
+            {'type': 'contour', 'var': '2t', 'levels': np.arange(-25, 45, 1)[::5], 'clabel': '%2.0f',
+             'linewidths': 0.3, 'colors': 'gray', 'alpha': 0.7},
+            dict(mslp_contours, levels={'step': 3.}),
+            dict(mslp_extrema, size=170),
+            {'type': 'quiver', 'u': '10u', 'v': '10v', 'density': 15, 'alpha': 0.8, 'color': 'gray'},
+        ],
+        'annotation': 'MSLP [hPa], Winds@10m and Temperature@2m',
+        'colorbar': 'Temperature [C]',
+    },
+    'gph_500_mslp': {
+        'variables': ['pmsl'],
+        'units': {'prmsl': 'hPa'},
+        'derived': [{'name': 'geop_500', 'field': 'geop', 'plev': 50000}],
+        'layers': [
+            {'type': 'contourf', 'var': 'geop_500', 'levels': np.arange(5000., 6000., 40.),
+             'cmap': 'gph', 'extend': 'both'},
+            dict(mslp_contours, levels={'step': 4.}, linewidths=1.5),
+            mslp_extrema,
+        ],
+        'annotation': 'Geopotential height @500hPa [m] and MSLP (hPa)',
+        'colorbar': 'Geopotential height [m]',
+    },
+    'gph_t_850': {
+        'variables': ['t'],
+        'units': {'t': 'degC'},
+        'derived': [{'name': 'geop_500', 'field': 'geop', 'plev': 50000}],
+        'layers': [
+            {'type': 'contourf', 'var': 't', 'plev': 85000, 'levels': np.arange(-34., 36., 2.),
+             'cmap': 'temp_meteociel', 'extend': 'both'},
+            {'type': 'contour', 'var': 't', 'plev': 85000, 'levels': np.arange(-32., 34., 4.),
+             'clabel': '%4.0f', 'label_stroke': True, 'highlight': 8,
+             'colors': 'gray', 'linestyles': 'solid', 'linewidths': 0.3},
+            {'type': 'contour', 'var': 'geop_500', 'levels': np.arange(4700., 6000., 50.),
+             'clabel': '%4.0f', 'colors': 'white', 'linewidths': 1.},
+            {'type': 'maxmin', 'var': 'geop_500', 'size': 80},
+        ],
+        'annotation': 'Geopotential height @500hPa [m] and temperature @850hPa [C]',
+        'colorbar': 'Temperature',
+    },
+    'gph_t_500': {
+        'variables': ['t'],
+        'units': {'t': 'degC'},
+        'derived': [{'name': 'geop_500', 'field': 'geop', 'plev': 50000}],
+        'layers': [
+            {'type': 'contourf', 'var': 't', 'plev': 50000, 'levels': np.arange(-58, 12, 2),
+             'cmap': 'temp_meteociel', 'extend': 'both'},
+            {'type': 'contour', 'var': 't', 'plev': 50000, 'levels': np.arange(-56., 10., 4.),
+             'clabel': '%4.0f', 'label_stroke': True, 'highlight': 7,
+             'colors': 'gray', 'linestyles': 'solid', 'linewidths': 0.3},
+            {'type': 'contour', 'var': 'geop_500', 'levels': np.arange(4700., 6000., 50.),
+             'clabel': '%4.0f', 'colors': 'white', 'linewidths': 1.},
+            {'type': 'maxmin', 'var': 'geop_500', 'size': 100},
+        ],
+        'annotation': 'Geopotential height @500hPa [m] and temperature @500hPa',
+        'colorbar': 'Temperature [C]',
+    },
+    'tmax': {
+        'variables': ['tmax_2m'],
+        'units': {'TMAX_2M': 'degC'},
+        'layers': [
+            {'type': 'contourf', 'var': 'TMAX_2M', 'levels': np.arange(-25, 50, 1), 'cmap': 'temp',
+             'extend': 'both'},
+            {'type': 'values', 'var': 'TMAX_2M', 'levels': np.arange(-25, 50, 1), 'cmap': 'temp'},
+        ],
+        'annotation': 'Maximum 2m Temperature in previous 6 hours',
+        'colorbar': 'Temperature [C]',
+    },
+    'tmin': {
+        'variables': ['tmin_2m'],
+        'units': {'TMIN_2M': 'degC'},
+        'layers': [
+            {'type': 'contourf', 'var': 'TMIN_2M', 'levels': np.arange(-25, 40, 1), 'cmap': 'temp',
+             'extend': 'both'},
+            {'type': 'values', 'var': 'TMIN_2M', 'levels': np.arange(-25, 40, 1), 'cmap': 'temp'},
+        ],
+        'annotation': 'Minimum 2m Temperature in previous 6 hours',
+        'colorbar': 'Temperature [C]',
+    },
+}
+
+# Points skipped between two values written on the map by the 'values' layers
+values_density = {'nord': 9, 'it': 11, 'de': 15}
@@ -0,0 +1,282 @@
+import ast
+import os
+import sys
+import json
+import queue
+import socket
+import threading
+import importlib
+import argparse
+import multiprocessing
+import socketserver
+import time as time_module
+import matplotlib.pyplot as plt
+import utils
+
+# Long running process that renders the products of one run. All modules are imported
+# and every dataset is opened only once, here; the main of every job (product, projection,
+# steps) runs in this process and submits its time chunks to one pool of workers shared
+# by all jobs, started once with the server.
+# Jobs are received on a unix socket or given on the command line.
+socket_file = os.path.join(utils.folder, 'render.sock')
+# Jobs with chunks in the worker pool at the same time
+max_jobs = 3
+# Processes of the shared worker pool
+workers = utils.processes * max_jobs
+scripts_folder = os.path.dirname(os.path.abspath(__file__))
+
+# Modules of the plotting scripts already imported
+products = {}
+
+
+def load_product(script):
+    """Import a plotting script (e.g. plot_cape.py) once. The scripts take the
+    projection from the command line when they are imported, it is then set for every job."""
+    name = os.path.splitext(os.path.basename(script))[0]
+    if name not in products:
+        argv = sys.argv
+        sys.argv = [script]
+        try:
+            products[name] = importlib.import_module(name)
+        finally:
+            sys.argv = argv
+
+    return products[name]
+
+
+def read_arguments(script):
+    """Arguments of the calls to utils.read_dataset in a plotting script,
+    skipping those that are not literals (except projection)"""
+    with open(os.path.join(scripts_folder, script)) as f:
+        tree = ast.parse(f.read())
+    calls = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == 'read_dataset'):
+            try:
+                calls.append({k.arg: ast.literal_eval(k.value) for k in node.keywords
+                              if k.arg != 'projection'})
+            except ValueError:
+                continue
+
+    return calls
+
+
+def warm(script, projection):
+    """Open (once) the datasets used by script for projection in this process.
+    The products of products.py open theirs when they are rendered."""
+    if not script.endswith('.py'):
+        return
+    for kwargs in read_arguments(script):
+        try:
+            utils.read_dataset(projection=projection, **kwargs)
+        except Exception as e:
+            utils.print_message('WARNING: could not read %s for %s (%s)' % (kwargs, script, e))
+
+
+def render(job):
+    """Run the main of the script (or product of products.py) of job for its
+    projection in this process: the chunks are only submitted to the shared
+    worker pool, see finish"""
+    utils.selected_steps = job.steps
+    try:
+        if job.script.endswith('.py'):
+            module = load_product(job.script)
+            module.projection = job.projection
+            module.main()
+        else:
+            load_product('plot_products.py').main([job.script], [job.projection])
+    except (Exception, SystemExit) as e:
+        utils.print_message('WARNING: %s failed (%r)' % (job.describe(), e))
+        job.exitcode = 1
+    finally:
+        utils.selected_steps = None
+        # The figures of main are pickled in the chunks already
+        plt.close('all')
+        job.submitted = utils.submitted_chunks[:]
+        del utils.submitted_chunks[:]
+
+
+def finish(job):
+    """Collect the results of the chunks of job and remove the files shared with the workers"""
+    for result, folders in job.submitted:
+        try:
+            result.get()
+        except Exception as e:
+            utils.print_message('WARNING: %s failed in a worker (%r)' % (job.describe(), e))
+            job.exitcode = 1
+        utils.remove_shared(folders)
+    if job.exitcode is None:
+        job.exitcode = 0
+    utils.print_message('Finished %s (code %s)' % (job.describe(), job.exitcode))
+    job.done.set()
+
+
+class Job():
+    def __init__(self, script, projection, steps=None):
+        self.script = script
+        self.projection = projection
+        self.steps = steps
+        self.done = threading.Event()
+        self.exitcode = None
+        self.submitted = []
+
+    def describe(self):
+        return '%s %s%s' % (self.script, self.projection,
+                            ' steps %s' % self.steps if self.steps is not None else '')
+
+
+def run_jobs(jobs, max_jobs=max_jobs, stop=None):
+    """Render jobs (a queue.Queue of Job, None ends) with at most max_jobs
+    having chunks in the shared worker pool at the same time. Runs in the
+    main thread, where the scripts draw their figures."""
+    running = []
+    while True:
+        for job in list(running):
+            if all(result.ready() for result, _ in job.submitted):
+                finish(job)
+                running.remove(job)
+        if len(running) >= max_jobs:
+            time_module.sleep(0.2)
+            continue
+        try:
+            job = jobs.get(timeout=0.2)
+        except queue.Empty:
+            if stop is not None and stop.is_set() and not running:
+                return
+            continue
+        if job is None:
+            if stop is not None:
+                stop.set()
+            continue
+        warm(job.script, job.projection)
+        utils.print_message('Started %s' % job.describe())
+        render(job)
+        running.append(job)
+
+
+def start_workers(processes=workers):
+    """Start the worker pool shared by all jobs, forked once from this process"""
+    utils.worker_pool = multiprocessing.get_context('fork').Pool(processes)
+
+
+def stop_workers():
+    utils.worker_pool.close()
+    utils.worker_pool.join()
+    utils.worker_pool = None
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Every line is a JSON request
+    {"products": ["plot_cape.py", "winds10m"], "projections": ["de"], "steps": [0, 1]}
+    or {"command": "stop"}. The answer (one line) is sent when the jobs are done."""
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            if request.get('command') == 'stop':
+                self.server.jobs.put(None)
+                self.wfile.write(b'{"status": "stopping"}\n')
+                return
+            jobs = [Job(product, projection, request.get('steps'))
+                    for product in request['products']
+                    for projection in request.get('projections', ['de'])]
+            for job in jobs:
+                self.server.jobs.put(job)
+            for job in jobs:
+                job.done.wait()
+            failed = [job.describe() for job in jobs if job.exitcode != 0]
+            answer = {'status': 'failed' if failed else 'ok', 'failed': failed}
+            self.wfile.write((json.dumps(answer) + '\n').encode())
+
+
+def serve(socket_file=socket_file, max_jobs=max_jobs, preload=(), processes=workers):
+    """Render the jobs received on socket_file until a stop command.
+    preload is a list of (script, projection) to import and read in advance."""
+    utils.dataset_cache = {}
+    for script, projection in preload:
+        load_product(script)
+        warm(script, projection)
+    # Before any thread is started, the workers find the preloaded modules in memory
+    start_workers(processes)
+    if os.path.exists(socket_file):
+        os.remove(socket_file)
+    server = socketserver.ThreadingUnixStreamServer(socket_file, RequestHandler)
+    server.daemon_threads = True
+    server.jobs = queue.Queue()
+    stop = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    utils.print_message('Listening on %s' % socket_file)
+    try:
+        run_jobs(server.jobs, max_jobs, stop)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_file)
+        stop_workers()
+
+
+def submit(products, projections, steps=None, socket_file=socket_file):
+    """Send jobs to a running server and wait for them to be rendered"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_file)
+        request = {'products': products, 'projections': projections}
+        if steps is not None:
+            request['steps'] = steps
+        client.sendall((json.dumps(request) + '\n').encode())
+        answer = client.makefile().readline()
+
+    return json.loads(answer)
+
+
+def render_all(products, projections, steps=None, max_jobs=max_jobs, processes=workers):
+    """Render the jobs without a server, still reading every dataset once"""
+    utils.dataset_cache = {}
+    jobs = queue.Queue()
+    all_jobs = [Job(product, projection, steps) for product in products
+                for projection in projections]
+    for job in all_jobs:
+        jobs.put(job)
+    jobs.put(None)
+    start_workers(processes)
+    try:
+        run_jobs(jobs, max_jobs, threading.Event())
+    finally:
+        stop_workers()
+
+    return [job.describe() for job in all_jobs if job.exitcode != 0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', help='serve: wait for jobs on the socket, submit: send jobs to the server, '
+                                       'render: render the jobs without a server',
+                        choices=['serve', 'submit', 'render', 'stop'])
+    parser.add_argument('--products', help='Plotting scripts (e.g. plot_cape.py) or products of products.py',
+                        required=False, default=[], nargs='+')
+    parser.add_argument('--projections', help='Projections to render',
+                        required=False, default=['de'], nargs='+')
+    parser.add_argument('--steps', help='Forecast hours to render (default all)',
+                        required=False, default=None, nargs='+', type=int)
+    parser.add_argument('-j', '--jobs', help='Jobs rendered at the same time',
+                        required=False, default=max_jobs, type=int)
+    parser.add_argument('-w', '--workers', help='Processes of the shared worker pool',
+                        required=False, default=workers, type=int)
+    parser.add_argument('--socket', help='Unix socket of the server',
+                        required=False, default=socket_file)
+    args = parser.parse_args()
+
+    if args.action == 'serve':
+        serve(args.socket, args.jobs,
+              preload=[(p, proj) for p in args.products for proj in args.projections],
+              processes=args.workers)
+    elif args.action == 'submit':
+        print(json.dumps(submit(args.products, args.projections, args.steps, args.socket)))
+    elif args.action == 'stop':
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(args.socket)
+            client.sendall(b'{"command": "stop"}\n')
+            print(client.makefile().readline().strip())
+    else:
+        failed = render_all(args.products, args.projections, args.steps, args.jobs, args.workers)
+        if failed:
+            utils.print_message('Failed jobs: %s' % ', '.join(failed))
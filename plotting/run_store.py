@@ -0,0 +1,506 @@
+import os
+import json
+import fcntl
+import contextlib
+import time as time_module
+import threading
+from glob import glob
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+
+# Every run is stored in a zarr group <folder>/icon-d2_<run>.zarr with one array
+# for every variable and the shared coordinates time, lat, lon.
+# The plotting scripts read one time step at a time over the whole domain and every
+# step is written independently, so every chunk is one (time=1, lat, lon) slice.
+# Pressure level variables have an additional plev dimension (Pa) and every
+# (step, level) is again its own chunk.
+forecast_hours = 48
+store_name = 'icon-d2_%s.zarr'
+ready_file = 'ready.jsonl'
+# Run currently being ingested/plotted in the data folder, so that readers don't
+# need to look for stores
+current_file = 'current_run.txt'
+# Lossless compression of every chunk
+compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+# Optional packing of the fields into 16 bit integers with CF scale_factor and add_offset
+# (scale_factor is the precision that is kept), used by the ingest with --pack.
+# Variables that are not packed are stored as float32.
+int16_fill_value = -32768
+default_packing = {
+    '2t': (0.01, 273.15),
+    '2d': (0.01, 273.15),
+    'TMAX_2M': (0.01, 273.15),
+    'TMIN_2M': (0.01, 273.15),
+    't': (0.01, 250.),
+    'prmsl': (1., 100000.),
+    '10u': (0.01, 0.),
+    '10v': (0.01, 0.),
+    'VMAX_10M': (0.01, 300.),
+    'u': (0.01, 0.),
+    'v': (0.01, 0.),
+    'z': (1., 30000.),
+    'r': (0.01, 50.),
+}
+
+# Names of the arrays in the store given the name of the variable on the DWD server.
+# These are the names that cdo used to produce and that are used in the plotting scripts.
+# Variables not in this dictionary get the shortName decoded from the GRIB message.
+short_names = {
+    't_2m': '2t',
+    'td_2m': '2d',
+    'u_10m': '10u',
+    'v_10m': '10v',
+    'pmsl': 'prmsl',
+    'vmax_10m': 'VMAX_10M',
+    'tmax_2m': 'TMAX_2M',
+    'tmin_2m': 'TMIN_2M',
+    'h_snow': 'sde',
+    'snowlmt': 'SNOWLMT',
+    'tot_prec': 'tp',
+    'rain_gsp': 'RAIN_GSP',
+    'rain_con': 'RAIN_CON',
+    'snow_gsp': 'SNOW_GSP',
+    'snow_con': 'SNOW_CON',
+    'cape_ml': 'CAPE_ML',
+    'cin_ml': 'CIN_ML',
+    'clcl': 'CLCL',
+    'clcm': 'CLCM',
+    'clch': 'CLCH',
+    'clct': 'CLCT',
+    'ww': 'WW',
+    'dbz_cmax': 'DBZ_CMAX',
+    'synmsg_bt_cl_ir10.8': 'SYNMSG_BT_CL_IR10.8',
+    'w_so': 'W_SO',
+    'hsurf': 'HSURF',
+    't': 't',
+    'fi': 'z',
+    'relhum': 'r',
+    'u': 'u',
+    'v': 'v',
+}
+
+# 2D variables with 15 minutes steps (e.g. the precipitation) also have a companion array
+# <array>_fine (DWD variable <var>_fine in the catalog) with all their steps along time_fine
+# (minutes since the run), the hourly array keeps the steps read by the maps
+fine_suffix = '_fine'
+fine_dim = 'time_fine'
+steps_per_hour = 4
+
+# DWD variables on pressure levels
+variables_3d = ['clc', 'fi', 'omega', 'p', 'qv', 'relhum', 't', 'tke', 'u', 'v', 'w']
+
+# Companion store of a run with the same arrays chunked for time series: every chunk
+# is a tile of points_tile x points_tile grid points with all time steps (and levels),
+# so that the values at a few points are read from the few tiles containing them.
+points_name = 'icon-d2_%s_points.zarr'
+points_tile = 16
+# Maximum memory (bytes) of the block of rows copied at once from the run store
+points_block_memory = 256 * 2**20
+
+# Creation of arrays and attributes is not atomic, and the store is written by several
+# processes (the ingests of 2d, 3d and invariant variables, derived.write): see locked
+_lock = threading.Lock()
+lock_file = 'store.lock'
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold the lock of the store at path, shared by the threads of this process
+    and (through a file lock) by the other processes writing the store"""
+    with _lock:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, lock_file), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store_path(folder, run_string):
+    """Path of the store for a run (YYYYMMDDHH)"""
+    return os.path.join(folder, store_name % run_string)
+
+
+def set_current(folder, run_string):
+    """Make run_string the run read by default in folder"""
+    filename = os.path.join(folder, current_file)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(run_string + '\n')
+    os.replace(filename + '.tmp', filename)
+
+
+def find_latest_store(folder):
+    """Path of the store of the current run in folder, otherwise of the most
+    recent one. None if there is no store."""
+    filename = os.path.join(folder, current_file)
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            path = store_path(folder, f.read().strip())
+        if os.path.isdir(path):
+            return path
+    stores = sorted(glob(os.path.join(folder, store_name % ('[0-9]' * 10))))
+    if stores:
+        return stores[-1]
+
+
+def array_name(var, short_name=None):
+    """Name of the array in the store for the DWD variable var"""
+    if var in short_names:
+        return short_names[var]
+    if short_name and short_name != 'unknown':
+        return short_name
+    return var.upper()
+
+
+def _coordinate(group, name, values, attrs):
+    arr = group.create_dataset(name, data=values, chunks=values.shape,
+                               fill_value=None, overwrite=True)
+    arr.attrs.update(attrs)
+    arr.attrs['_ARRAY_DIMENSIONS'] = [name]
+
+
+def index_window(lat, lon, domain):
+    """Integer [start, stop) indices of the increasing lat and lon covering domain
+    (an entry of domains.proj_defs), i.e. the same points that are selected by
+    sel(lat=slice(llcrnrlat, urcrnrlat), lon=slice(llcrnrlon, urcrnrlon))."""
+    return {'lat': [int(np.searchsorted(lat, domain['llcrnrlat'], 'left')),
+                    int(np.searchsorted(lat, domain['urcrnrlat'], 'right'))],
+            'lon': [int(np.searchsorted(lon, domain['llcrnrlon'], 'left')),
+                    int(np.searchsorted(lon, domain['urcrnrlon'], 'right'))]}
+
+
+def union_domain(domains):
+    """Bounding box of a list of domains (entries of domains.proj_defs)"""
+    return {'llcrnrlat': min(d['llcrnrlat'] for d in domains),
+            'urcrnrlat': max(d['urcrnrlat'] for d in domains),
+            'llcrnrlon': min(d['llcrnrlon'] for d in domains),
+            'urcrnrlon': max(d['urcrnrlon'] for d in domains)}
+
+
+def grid_window(group, lat, lon):
+    """Slices of lat and lon (of a decoded field) covering the grid of the store"""
+    lat_store, lon_store = group['lat'][:], group['lon'][:]
+    window = index_window(lat, lon, {'llcrnrlat': lat_store[0] - 1e-6,
+                                     'urcrnrlat': lat_store[-1] + 1e-6,
+                                     'llcrnrlon': lon_store[0] - 1e-6,
+                                     'urcrnrlon': lon_store[-1] + 1e-6})
+
+    return slice(*window['lat']), slice(*window['lon'])
+
+
+def open_group(path, run, lat, lon, domains={}):
+    """Open the store at path creating the coordinates if needed.
+    run is a pandas Timestamp, lat and lon are 1-D increasing arrays.
+    The index windows of domains (domains.proj_defs) on this grid are saved
+    so that readers can subset them with isel."""
+    with locked(path):
+        group = zarr.open_group(path, mode='a')
+        if 'time' not in group:
+            _coordinate(group, 'time', np.arange(forecast_hours + 1, dtype='int32'),
+                        {'standard_name': 'time', 'axis': 'T',
+                         'units': 'hours since %s' % run.strftime('%Y-%m-%d %H:%M:%S'),
+                         'calendar': 'proleptic_gregorian'})
+            _coordinate(group, 'lat', np.asarray(lat, dtype='float64'),
+                        {'standard_name': 'latitude', 'long_name': 'latitude',
+                         'units': 'degrees_north', 'axis': 'Y'})
+            _coordinate(group, 'lon', np.asarray(lon, dtype='float64'),
+                        {'standard_name': 'longitude', 'long_name': 'longitude',
+                         'units': 'degrees_east', 'axis': 'X'})
+            group.attrs['run'] = run.strftime('%Y%m%d%H')
+            group.attrs['windows'] = {name: index_window(lat, lon, domain)
+                                      for name, domain in domains.items()}
+
+    return group
+
+
+def require_levels(group, levels):
+    """Return the pressure levels (Pa) of the store, creating the plev
+    coordinate from levels (hPa) if needed. The levels of the first pressure
+    level variable are used for all the others."""
+    with locked(group.store.path):
+        if 'plev' not in group:
+            _coordinate(group, 'plev',
+                        np.array(sorted((float(l) * 100. for l in levels), reverse=True)),
+                        {'standard_name': 'air_pressure', 'long_name': 'pressure',
+                         'units': 'Pa', 'positive': 'down', 'axis': 'Z'})
+
+        return group['plev'][:]
+
+
+def require_variable(group, name, var, attrs, dims=('time', 'lat', 'lon'), packing=None):
+    """Return the array name, creating it (filled with NaN) if it is not in the
+    store yet. var is the DWD name of the variable. Time-invariant fields
+    are stored with dims ('lat', 'lon'), pressure level fields with
+    ('time', 'plev', 'lat', 'lon'). packing is an optional tuple
+    (scale_factor, add_offset) to store the field as 16 bit integers."""
+    with locked(group.store.path):
+        if name in group:
+            return group[name]
+
+        return _create_variable(group, name, var, attrs, dims, packing)
+
+
+def _create_variable(group, name, var, attrs, dims, packing):
+    """Create the array of require_variable, the lock of the store must be held"""
+    shape = tuple(group[dim].shape[0] for dim in dims)
+    chunks = tuple(1 if dim in ('time', fine_dim, 'plev') else size for dim, size in zip(dims, shape))
+    if packing:
+        arr = group.create_dataset(name, shape=shape, chunks=chunks, dtype='int16',
+                                   fill_value=int16_fill_value, compressor=compressor)
+        arr.attrs['scale_factor'], arr.attrs['add_offset'] = packing
+    else:
+        arr = group.create_dataset(name, shape=shape, chunks=chunks, dtype='float32',
+                                   fill_value=np.nan, compressor=compressor)
+    arr.attrs.update(attrs)
+    arr.attrs['dwd_name'] = var
+    arr.attrs['_ARRAY_DIMENSIONS'] = list(dims)
+
+    return arr
+
+
+def require_fine_variable(group, name, var, attrs, packing=None):
+    """Return the array with the 15 minutes steps of the 2D variable var whose
+    hourly array is name, creating it (and the time_fine coordinate) if needed
+    with the steps already written in the hourly array. Returns the array and
+    whether it was created: the check and the creation are done under the lock
+    of the store, so that only one of the concurrent ingests creates it."""
+    fine_name = name + fine_suffix
+    with locked(group.store.path):
+        if fine_name in group:
+            return group[fine_name], False
+        if fine_dim not in group:
+            units = group['time'].attrs['units'].replace('hours', 'minutes')
+            _coordinate(group, fine_dim,
+                        np.arange(forecast_hours * steps_per_hour + 1, dtype='int32') * (60 // steps_per_hour),
+                        dict(group['time'].attrs.asdict(), units=units))
+        arr = _create_variable(group, fine_name, var + fine_suffix, attrs, (fine_dim, 'lat', 'lon'),
+                               packing)
+        # Steps written before the first 15 minutes step arrived (e.g. the initial one)
+        if name in group:
+            hourly = group[name]
+            for itime in range(hourly.shape[0]):
+                values = hourly[itime]
+                if not np.all(values == hourly.fill_value) and not np.all(np.isnan(values)):
+                    arr[itime * steps_per_hour] = values
+
+    return arr, True
+
+
+def pack(arr, values):
+    """Convert values to the type stored in arr, applying the packing if any"""
+    if arr.dtype != np.int16:
+        return values.astype('float32')
+    packed = np.round((values - arr.attrs['add_offset']) / arr.attrs['scale_factor'])
+    packed = np.clip(packed, int16_fill_value + 1, np.iinfo(np.int16).max)
+
+    return np.where(np.isnan(values), int16_fill_value, packed).astype('int16')
+
+
+def write_step(arr, itime, values, ilevel=None):
+    """Write one time step (and level if ilevel is given) in its own chunk,
+    itime is None for time-invariant fields"""
+    if itime is None:
+        arr[:] = pack(arr, values)
+    elif ilevel is None:
+        arr[itime] = pack(arr, values)
+    else:
+        arr[itime, ilevel] = pack(arr, values)
+
+
+def mark_ready(path, var, step):
+    """Tell downstream processes that step of var has been written.
+    Every event is one short line appended to a log, which is atomic."""
+    line = json.dumps({'variable': var, 'step': int(step),
+                       'time': pd.Timestamp.utcnow().strftime('%Y-%m-%dT%H:%M:%S')})
+    with open(os.path.join(path, ready_file), 'a') as f:
+        f.write(line + '\n')
+
+
+def ready_steps(path):
+    """Dictionary with the set of the steps already written for every variable"""
+    steps = {}
+    filename = os.path.join(path, ready_file)
+    if not os.path.isfile(filename):
+        return steps
+    with open(filename) as f:
+        for line in f:
+            if line.endswith('\n'):
+                event = json.loads(line)
+                steps.setdefault(event['variable'], set()).add(event['step'])
+
+    return steps
+
+
+def wait_for_steps(path, variables, steps=range(forecast_hours + 1),
+                   poll_interval=10, timeout=None):
+    """Block until all steps of variables are ready in the store at path.
+    Returns False if timeout (seconds) expires before."""
+    start = time_module.time()
+    while True:
+        available = ready_steps(path)
+        if all(set(steps).issubset(available.get(var, set())) for var in variables):
+            return True
+        if timeout is not None and time_module.time() - start > timeout:
+            return False
+        time_module.sleep(poll_interval)
+
+
+def consolidate(path):
+    """Write the catalog of the store, mapping every DWD variable (lowercase) to
+    its array, dimensions, levels and units, and consolidate the metadata of
+    all arrays in a single object, so that readers open the store with one read.
+    The catalog is rebuilt from the arrays on disk under the lock of the store,
+    so that no writer drops the arrays created meanwhile by another process."""
+    with locked(path):
+        group = zarr.open_group(path, mode='a')
+        catalog = {}
+        for name, arr in group.arrays():
+            if 'dwd_name' not in arr.attrs:
+                continue
+            dims = arr.attrs['_ARRAY_DIMENSIONS']
+            catalog[arr.attrs['dwd_name'].lower()] = {
+                'array': name,
+                'dims': dims,
+                'levels': group['plev'][:].tolist() if 'plev' in dims else None,
+                'units': arr.attrs.get('units'),
+                'long_name': arr.attrs.get('long_name'),
+            }
+        group.attrs['catalog'] = catalog
+        zarr.consolidate_metadata(group.store)
+
+    return catalog
+
+
+def fine_to_time(dset):
+    """Put the arrays with 15 minutes steps of dset on the time dimension with the
+    name of their hourly array (e.g. RAIN_GSP_fine as RAIN_GSP), the hourly arrays
+    of dset are NaN between the hours"""
+    fine = [name for name in dset.data_vars if fine_dim in dset[name].dims]
+    if not fine:
+        return dset
+    names = {name: name[:-len(fine_suffix)] for name in fine if name.endswith(fine_suffix)}
+    fine_dset = dset[fine].rename(names).rename({fine_dim: 'time'})
+    hourly = dset.drop_vars(fine + [fine_dim])
+    if not hourly.data_vars:
+        return fine_dset
+
+    return xr.merge([hourly, fine_dset])
+
+
+def points_path(path):
+    """Path of the point-major companion of the store at path"""
+    return path[:-len('.zarr')] + '_points.zarr' if path.endswith('.zarr') else path + '_points'
+
+
+def write_points(path, var, tile=points_tile, block_memory=points_block_memory):
+    """Copy the (complete) DWD variable var of the store at path, and its 15 minutes
+    steps if any, into its point-major companion, creating the coordinates if needed.
+    The rows are copied in blocks, so that every chunk of the run store is decompressed
+    only a few times. Returns the path of the companion."""
+    source = zarr.open_group(path, mode='r')
+    catalog = source.attrs['catalog']
+    target_path = points_path(path)
+    for dwd_name in [var.lower(), var.lower() + fine_suffix]:
+        if dwd_name not in catalog:
+            continue
+        name = catalog[dwd_name]['array']
+        arr = source[name]
+        dims = arr.attrs['_ARRAY_DIMENSIONS']
+        with locked(target_path):
+            group = zarr.open_group(target_path, mode='a')
+            for coord in ['time', fine_dim, 'plev', 'lat', 'lon']:
+                if coord in source and coord not in group:
+                    _coordinate(group, coord, source[coord][:], source[coord].attrs.asdict())
+            group.attrs.update({k: v for k, v in source.attrs.asdict().items() if k != 'catalog'})
+            chunks = tuple(tile if dim in ('lat', 'lon') else size for dim, size in zip(dims, arr.shape))
+            # Written under a temporary name and without the dwd_name, so that the
+            # catalog (see consolidate) only ever lists complete arrays
+            target = group.create_dataset(name + '.tmp', shape=arr.shape, chunks=chunks, dtype=arr.dtype,
+                                          fill_value=arr.fill_value, compressor=compressor,
+                                          overwrite=True)
+        ilat = dims.index('lat')
+        row_bytes = arr.nbytes // arr.shape[ilat]
+        rows = max(tile, block_memory // row_bytes // tile * tile)
+        for start in range(0, arr.shape[ilat], rows):
+            block = tuple(slice(start, start + rows) if dim == 'lat' else slice(None) for dim in dims)
+            target[block] = arr[block]
+        with locked(target_path):
+            target.attrs.update(arr.attrs.asdict())
+            if name in group:
+                del group[name]
+            group.move(name + '.tmp', name)
+    consolidate(target_path)
+
+    return target_path
+
+
+def nearest_index(coord, values):
+    """Indices of the points of the increasing 1-D coord nearest to values"""
+    coord, values = np.asarray(coord), np.atleast_1d(np.asarray(values, dtype='float64'))
+    right = np.clip(np.searchsorted(coord, values), 1, len(coord) - 1)
+    left = right - 1
+
+    return np.where(values - coord[left] <= coord[right] - values, left, right)
+
+
+def points_index(dset, lats, lons):
+    """Nearest grid point of every (lat, lon) as integer DataArrays along a
+    'point' dimension, which select all points at once with dset.isel"""
+    index = {'lat': nearest_index(dset['lat'].values, lats),
+             'lon': nearest_index(dset['lon'].values, lons)}
+
+    return {dim: xr.DataArray(values, dims='point') for dim, values in index.items()}
+
+
+# Stores already opened by this process
+_datasets = {}
+
+
+def open_store(path, refresh=False):
+    """Open the whole store at path as a lazy dataset using the consolidated
+    metadata, again only when the metadata changed (e.g. another process
+    consolidated a new array) or with refresh."""
+    # The store may not be consolidated yet while the first variable is ingested
+    metadata = os.path.join(path, '.zmetadata')
+    mtime = os.stat(metadata).st_mtime_ns if os.path.isfile(metadata) else None
+    if refresh or path not in _datasets or _datasets[path][0] != mtime:
+        _datasets[path] = (mtime, xr.open_zarr(path, consolidated=mtime is not None))
+
+    return _datasets[path][1]
+
+
+def get_catalog(path):
+    """Catalog of the store at path, see consolidate"""
+    return open_store(path).attrs.get('catalog', {})
+
+
+def get_windows(path):
+    """Index windows of the projections in the store at path, see open_group"""
+    return open_store(path).attrs.get('windows', {})
+
+
+def stored_variables(path):
+    """Set of the DWD variables (lowercase) that are in the store at path"""
+    return set(get_catalog(path))
+
+
+def open_dataset(path, variables):
+    """Open the arrays of the DWD variables (case insensitive) from the store
+    at path through its catalog. Returns the dataset and the run as Timestamp."""
+    store = open_store(path)
+    catalog = store.attrs['catalog']
+    names = [catalog[var.lower()]['array'] for var in variables
+             if var.lower() in catalog]
+    dset = store[names]
+    dset.attrs = {}
+    # Packed variables are unpacked by xarray as float64
+    for name in names:
+        if dset[name].dtype == np.float64:
+            dset[name] = dset[name].astype('float32')
+    run = pd.to_datetime(store.attrs['run'], format='%Y%m%d%H')
+
+    return dset, run
@@ -0,0 +1,263 @@
+import ast
+import asyncio
+import os
+import sys
+import time as time_module
+import argparse
+from glob import glob
+import derived
+import download_dwd
+import run_store
+import utils
+from products import products
+
+# Runs the ingest, plotting and upload of one run as a graph of tasks instead of three
+# barriers: every plot script starts as soon as the variables it reads are in the run
+# store, and its images are uploaded as soon as it is done.
+# Every task uses some units of the resources below and is only started when they are free.
+# Streaming ingests hold a network unit for all their life (hours), the uploads have their own
+# connections so that the images of the first scripts are not uploaded only after the ingests.
+resource_limits = {
+    'network': 3,
+    'upload': 2,
+    'cpu': os.cpu_count() or 4,
+    'memory': 16,
+}
+# Memory (GB) used by one plotting script (default) and by the ones reading 3-D variables
+plot_memory = 2
+plot_memory_3d = 4
+# Seconds between two checks of the ready events in the run store
+poll_interval = 10
+# Pressure level and time-invariant variables, all the others are ingested as 2-D
+variables_3d = run_store.variables_3d
+variables_invariant = ['hsurf']
+# Remote folder of the images of every projection
+upload_folders = {
+    'de': 'icon_d2',
+    'it': 'icon_d2/it',
+    'nord': 'icon_d2/nord',
+}
+default_scripts = ['plot_cape.py', 'plot_hsnow.py', 'plot_rain_clouds.py', 'plot_rain_acc.py',
+                   'plot_sat.py', 'plot_winter.py']
+# Products of products.py, rendered by plot_products.py
+default_products = list(products)
+default_projections = ['de', 'it', 'nord']
+scripts_folder = os.path.dirname(os.path.abspath(__file__))
+
+
+def derived_inputs(name):
+    """DWD variables ingested for the derived field name: the 15 minutes
+    steps (<var>_fine) are ingested with the hourly ones of var"""
+    return [var[:-len(run_store.fine_suffix)] if var.endswith(run_store.fine_suffix) else var
+            for var in derived.registry[derived.derivation(name)]['inputs']]
+
+
+def script_info(script):
+    """Variables passed to utils.read_dataset (and inputs of the fields read
+    with derived.get) and name of the output images (variable_name) of a
+    plotting script, read from its source, or of a product of products.py
+    (a name without .py)"""
+    if not script.endswith('.py'):
+        variables = list(products[script]['variables'])
+        for field in products[script].get('derived', []):
+            inputs = derived_inputs(field['field'])
+            variables += [v for v in inputs if v not in variables]
+        return variables, script
+    with open(os.path.join(scripts_folder, script)) as f:
+        tree = ast.parse(f.read())
+    variables, name = [], None
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == 'read_dataset'):
+            for keyword in node.keywords:
+                if keyword.arg == 'variables':
+                    variables += [v for v in ast.literal_eval(keyword.value) if v not in variables]
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+              and node.func.attr == 'get' and getattr(node.func.value, 'id', None) == 'derived'):
+            inputs = derived_inputs(ast.literal_eval(node.args[0]))
+            variables += [v for v in inputs if v not in variables]
+        elif (isinstance(node, ast.Assign) and len(node.targets) == 1
+              and getattr(node.targets[0], 'id', None) == 'variable_name'):
+            name = ast.literal_eval(node.value)
+
+    return variables, name
+
+
+class Task():
+    """A command to run once its input variables are ready and the resources
+    in cost are available. on_success returns the tasks to add after it."""
+    def __init__(self, name, command, cost, inputs=(), on_success=None):
+        self.name = name
+        self.command = command
+        self.cost = cost
+        self.inputs = set(inputs)
+        self.on_success = on_success
+
+
+def complete_variables(path):
+    """Variables (lowercase) of the store at path whose forecast steps are all ready"""
+    steps = set(range(run_store.forecast_hours + 1))
+
+    return {var.lower() for var, ready in run_store.ready_steps(path).items()
+            if steps.issubset(ready) or (var.lower() in variables_invariant and 0 in ready)}
+
+
+def ingest_tasks(variables, crop_projections=None, pack=False, points=False):
+    """One streaming ingest for every type (2d, 3d, invariant) of variables"""
+    variables = [v.lower() for v in variables]
+    tasks = []
+    for var_type, names in [('2d', [v for v in variables
+                                    if v not in variables_3d + variables_invariant]),
+                            ('3d', [v for v in variables if v in variables_3d]),
+                            ('invariant', [v for v in variables if v in variables_invariant])]:
+        if not names:
+            continue
+        command = [sys.executable, os.path.join(scripts_folder, 'ingest.py'),
+                   '--stream', '--type', var_type, '--variables'] + names
+        if crop_projections:
+            command += ['--crop'] + list(crop_projections)
+        if pack:
+            command += ['--pack']
+        if points:
+            command += ['--points']
+        tasks.append(Task('ingest %s' % var_type, command, {'network': 1, 'cpu': 1}))
+
+    return tasks
+
+
+def upload_task(name, projection, bookmark):
+    """Upload (and remove) the images of a product in its own remote folder,
+    e.g. icon_d2/it/cape_cin"""
+    def task():
+        files = sorted(glob(os.path.join(utils.subfolder_images[projection], name + '_*.png')))
+        if not files:
+            return []
+        command = ['ncftpput', '-R', '-v', '-DD', '-m', bookmark,
+                   upload_folders.get(projection, upload_folders['de']) + '/' + name] + files
+        return [Task('upload %s %s' % (name, projection), command, {'upload': 1})]
+
+    return task
+
+
+def plot_command(script, projection):
+    """Command plotting a script (or a product of products.py) for projection"""
+    if not script.endswith('.py'):
+        return [sys.executable, os.path.join(scripts_folder, 'plot_products.py'),
+                '--products', script, '--projections', projection]
+    return [sys.executable, os.path.join(scripts_folder, script), projection]
+
+
+def plot_tasks(scripts, projections, upload=False, bookmark=None):
+    """One task for every script (or product) and projection, depending on
+    the variables the script reads"""
+    tasks = []
+    for script in scripts:
+        variables, name = script_info(script)
+        memory = plot_memory_3d if set(variables) & set(variables_3d) else plot_memory
+        for projection in projections:
+            on_success = upload_task(name, projection, bookmark) if upload and name else None
+            tasks.append(Task('%s %s' % (script, projection), plot_command(script, projection),
+                              {'cpu': utils.processes, 'memory': memory},
+                              inputs=[v.lower() for v in variables], on_success=on_success))
+
+    return tasks
+
+
+def fits(cost, used, limits):
+    """Whether a task with cost can start. A task that is larger than a
+    limit can still run alone."""
+    return all(used[r] + c <= limits[r] or used[r] == 0 for r, c in cost.items())
+
+
+async def run_tasks(tasks, path, limits=resource_limits, poll_interval=poll_interval):
+    """Run tasks as soon as their inputs are in the store at path and the
+    resources are available. Tasks waiting for inputs are started anyway once
+    no ingest is running anymore. Returns the names of the failed tasks."""
+    pending, running, failed = list(tasks), {}, []
+    used = {r: 0 for r in limits}
+    start = time_module.time()
+    while pending or running:
+        ingesting = any(t.name.startswith('ingest') for t in pending + list(running.values()))
+        complete = complete_variables(path) if os.path.isdir(path) else set()
+        for task in list(pending):
+            inputs_ready = task.inputs.issubset(complete) or not ingesting
+            if inputs_ready and fits(task.cost, used, limits):
+                pending.remove(task)
+                for r, c in task.cost.items():
+                    used[r] += c
+                utils.print_message('Starting %s' % task.name)
+                process = await asyncio.create_subprocess_exec(*task.command)
+                running[asyncio.ensure_future(process.wait())] = task
+        if not running:
+            await asyncio.sleep(poll_interval)
+            continue
+        done, _ = await asyncio.wait(list(running), timeout=poll_interval,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            task = running.pop(future)
+            for r, c in task.cost.items():
+                used[r] -= c
+            if future.result() != 0:
+                utils.print_message('WARNING: %s failed with code %d' % (task.name, future.result()))
+                failed.append(task.name)
+                continue
+            utils.print_message('Finished %s after %d s' % (task.name, time_module.time() - start))
+            if task.on_success:
+                pending += task.on_success()
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scripts', help='Plotting scripts to run',
+                        required=False, default=default_scripts, nargs='+')
+    parser.add_argument('--products', help='Products of products.py to render',
+                        required=False, default=default_products, nargs='*', choices=list(products))
+    parser.add_argument('-p', '--projections', help='Projections to plot',
+                        required=False, default=default_projections, nargs='+')
+    parser.add_argument('-r', '--run', help='Run (YYYYMMDDHH), defaults to the one exported in the environment',
+                        required=False, default=None)
+    parser.add_argument('--download', help='Ingest the variables read by the scripts',
+                        required=False, action='store_true')
+    parser.add_argument('--plot', help='Run the plotting scripts',
+                        required=False, action='store_true')
+    parser.add_argument('--upload', help='Upload the images of every script when it is done',
+                        required=False, action='store_true')
+    parser.add_argument('--pack', help='Pack the fields as 16 bit integers in the store',
+                        required=False, action='store_true')
+    parser.add_argument('--variables', help='Variables to ingest instead of the ones read by the scripts',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('--points', help='Also write the point-major store used by the meteograms',
+                        required=False, action='store_true')
+    parser.add_argument('--network', help='Maximum number of ingests (downloads) at the same time',
+                        required=False, default=resource_limits['network'], type=int)
+    parser.add_argument('--uploads', help='Maximum number of uploads at the same time',
+                        required=False, default=resource_limits['upload'], type=int)
+    parser.add_argument('--cpu', help='Maximum number of cores used at the same time',
+                        required=False, default=resource_limits['cpu'], type=int)
+    parser.add_argument('--memory', help='Maximum memory (GB) used at the same time',
+                        required=False, default=resource_limits['memory'], type=int)
+    args = parser.parse_args()
+
+    run_string = args.run or download_dwd.run_from_env()
+    scripts = args.scripts + args.products
+    tasks = []
+    if args.download:
+        variables = list(args.variables or [])
+        # The meteograms read the point-major store, ingest their variables too
+        for script in [] if args.variables else scripts + (['plot_meteogram.py'] if args.points else []):
+            variables += [v for v in script_info(script)[0] if v not in variables]
+        crop = os.environ['CROP_PROJECTIONS'].split() if os.environ.get('CROP_PROJECTIONS') else None
+        tasks += ingest_tasks(variables, crop_projections=crop, pack=args.pack,
+                              points=args.points)
+    if args.plot:
+        tasks += plot_tasks(scripts, args.projections, upload=args.upload,
+                            bookmark=os.environ.get('NCFTP_BOOKMARK'))
+    failed = asyncio.run(run_tasks(tasks, run_store.store_path(utils.folder, run_string),
+                                   limits={'network': args.network, 'upload': args.uploads,
+                                           'cpu': args.cpu, 'memory': args.memory}))
+    if failed:
+        utils.print_message('Failed tasks: %s' % ', '.join(failed))
+        # The run is not marked as processed (see copy_data.run) and is tried again
+        sys.exit(1)
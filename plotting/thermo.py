@@ -0,0 +1,196 @@
+import numpy as np
+
+# Thermodynamic fields computed with plain float32 numpy arrays of any shape, e.g. the
+# whole (time, plev, lat, lon) run, without units: temperatures in K, pressures in Pa,
+# relative humidity in %, mixing ratios in kg/kg. The formulas and constants are the
+# ones of metpy (compared in tests/test_thermo.py), which is much slower on large arrays.
+# Constants as in metpy.constants
+T0 = 273.16
+zero_degc = 273.15
+sat_pressure_0c = 611.2
+Rd = 287.04749097718457
+Rv = 461.52311572606084
+Cp_d = 1004.6662184201462
+Cp_l = 4219.4
+Cp_v = 1860.078011865639
+Lv = 2500840.
+epsilon = Rd / Rv
+kappa = Rd / Cp_d
+P0 = 100000.
+# Points processed at once by thermo_fields
+block_size = 65536
+# Steps of the integration along the moist adiabat in wet_bulb_temperature
+wet_bulb_steps = 4
+
+
+def _float32(*arrays):
+    return [np.asarray(a, dtype='float32') for a in arrays]
+
+
+# Saturation vapor pressure over liquid water (Ambaum 2020) written as
+# sat_pressure_0c * exp(_es_b - _es_c / t - _es_a * log(t / T0))
+_es_a = (Cp_l - Cp_v) / Rv
+_es_b = (Lv / T0 + Cp_l - Cp_v) / Rv
+_es_c = (Lv + (Cp_l - Cp_v) * T0) / Rv
+
+
+def _log_saturation_ratio(t):
+    """log(saturation_vapor_pressure(t) / sat_pressure_0c)"""
+    val = np.log(t * (1. / T0))
+    val *= -_es_a
+    val -= _es_c / t
+    val += _es_b
+
+    return val
+
+
+def saturation_vapor_pressure(t):
+    """Saturation vapor pressure (Pa) over liquid water (Ambaum 2020)"""
+    es = np.exp(_log_saturation_ratio(t))
+    es *= sat_pressure_0c
+
+    return es
+
+
+def _dewpoint(val):
+    """Dewpoint (K) of the vapor pressure sat_pressure_0c * exp(val) (Bolton 1980, as metpy)"""
+    td = 243.5 * val
+    td /= 17.67 - val
+    td += zero_degc
+
+    return td
+
+
+def dewpoint(e):
+    """Dewpoint (K) of the vapor pressure e (Pa)"""
+    return _dewpoint(np.log(e / sat_pressure_0c))
+
+
+def dewpoint_from_relative_humidity(t, rh):
+    t, rh = _float32(t, rh)
+    # log(e / sat_pressure_0c) without computing e
+    val = np.log(rh * 0.01)
+    val += _log_saturation_ratio(t)
+
+    return _dewpoint(val)
+
+
+def mixing_ratio(e, p):
+    """Mixing ratio (kg/kg) of the vapor pressure e at pressure p"""
+    return epsilon * e / (p - e)
+
+
+def saturation_mixing_ratio(p, t):
+    return mixing_ratio(saturation_vapor_pressure(t), p)
+
+
+def potential_temperature(p, t):
+    p, t = _float32(p, t)
+
+    return t * (P0 / p) ** kappa
+
+
+def equivalent_potential_temperature(p, t, td):
+    """Equivalent potential temperature (K) from temperature and dewpoint (Bolton 1980),
+    written as t * exp(...) to compute a single power"""
+    p, t, td = _float32(p, t, td)
+    e = saturation_vapor_pressure(td)
+    p_dry = p - e
+    r = e
+    r /= p_dry
+    r *= epsilon
+    log_t = np.log(t)
+    t_l = np.log(td)
+    t_l -= log_t
+    t_l *= -1. / 800.
+    t_l += 1. / (td - 56.)
+    np.reciprocal(t_l, out=t_l)
+    t_l += 56.
+    # log(th_l / t)
+    x = np.log(p_dry)
+    x -= np.log(P0)
+    x *= -kappa
+    x += 0.28 * r * (log_t - np.log(t_l))
+    # Moisture term
+    np.reciprocal(t_l, out=t_l)
+    t_l *= 3036.
+    t_l -= 1.78
+    t_l *= r
+    t_l *= 1. + 0.448 * r
+    x += t_l
+    np.exp(x, out=x)
+    x *= t
+
+    return x
+
+
+def lcl(p, t, td):
+    """Pressure (Pa) and temperature (K) of the lifting condensation level (Bolton 1980)"""
+    p, t, td = _float32(p, t, td)
+    t_lcl = 56. + 1. / (1. / (td - 56.) + np.log(t / td) / 800.)
+
+    return p * (t_lcl / t) ** (1. / kappa), t_lcl
+
+
+def _moist_lapse(p, t):
+    """dT/dp (K/Pa) along the pseudo-adiabat, as in metpy.calc.moist_lapse"""
+    rs = saturation_mixing_ratio(p, t)
+
+    return (Rd * t + Lv * rs) / (Cp_d + Lv * Lv * rs * epsilon / (Rd * t * t)) / p
+
+
+def wet_bulb_temperature(p, t, td, steps=wet_bulb_steps):
+    """Wet-bulb temperature (K): temperature of the parcel lifted to its LCL and
+    brought back to p along the moist adiabat, integrated for all points at once
+    with a fixed number of Runge-Kutta steps"""
+    p, t, td = _float32(p, t, td)
+    p_lcl, t_w = lcl(p, t, td)
+    p = np.broadcast_to(p, t_w.shape)
+    dp = (p - p_lcl) / steps
+    p_i = p_lcl
+    for _ in range(steps):
+        k1 = _moist_lapse(p_i, t_w)
+        k2 = _moist_lapse(p_i + dp / 2, t_w + dp / 2 * k1)
+        k3 = _moist_lapse(p_i + dp / 2, t_w + dp / 2 * k2)
+        k4 = _moist_lapse(p_i + dp, t_w + dp * k3)
+        t_w = t_w + dp / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        p_i = p_i + dp
+
+    return t_w
+
+
+def _fields_block(p, t, rh, wet_bulb):
+    td = dewpoint_from_relative_humidity(t, rh)
+    fields = {
+        'dewpoint': td,
+        'theta': potential_temperature(p, t),
+        'theta_e': equivalent_potential_temperature(p, t, td),
+        'mixing_ratio': mixing_ratio(saturation_vapor_pressure(td), p),
+    }
+    if wet_bulb:
+        fields['wet_bulb'] = wet_bulb_temperature(p, t, td)
+
+    return fields
+
+
+def thermo_fields(p, t, rh, wet_bulb=True, block_size=block_size):
+    """Dewpoint, potential and equivalent potential temperature, mixing ratio and
+    (optionally) wet-bulb temperature of t and rh at pressure p (broadcastable,
+    e.g. plev[:, None, None] for (time, plev, lat, lon) fields).
+    The arrays are processed in blocks of rows of about block_size points,
+    so that the intermediate results stay in the CPU cache."""
+    p, t, rh = np.broadcast_arrays(*_float32(p, t, rh))
+    if t.ndim < 2:
+        return _fields_block(p, t, rh, wet_bulb)
+    fields = None
+    rows = max(1, block_size // t.shape[-1])
+    for index in np.ndindex(t.shape[:-2]):
+        for start in range(0, t.shape[-2], rows):
+            block = index + (slice(start, start + rows),)
+            values = _fields_block(p[block], t[block], rh[block], wet_bulb)
+            if fields is None:
+                fields = {name: np.empty(t.shape, dtype='float32') for name in values}
+            for name, field in values.items():
+                fields[name][block] = field
+
+    return fields
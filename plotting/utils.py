@@ -5,20 +5,32 @@ import pandas as pd
 from matplotlib.colors import from_levels_and_colors
 import seaborn as sns
 import os
+import atexit
+import shutil
+import tempfile
+import pickle
 import matplotlib.patheffects as path_effects
 import matplotlib.cm as mplcm
+from matplotlib.artist import Artist
+from matplotlib.text import Text
 import sys
 from glob import glob
 import xarray as xr
+from xarray.core import indexing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from functools import partial
 from matplotlib.colors import BoundaryNorm
 from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 import metpy
+import metpy.calc as mpcalc
 import re
 from matplotlib.image import imread as read_png
-import requests
-import json
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+import run_store
+from domains import proj_defs
+import gazetteer
 
 import warnings
 warnings.filterwarnings(
@@ -26,8 +38,8 @@ warnings.filterwarnings(
     message='The unit of the quantity is stripped.'
 )
 
-apiKey = os.environ['MAPBOX_KEY']
-apiURL_places = "https://api.mapbox.com/geocoding/v5/mapbox.places"
+# Only needed for the Mapbox backgrounds and to geocode places missing from the gazetteer
+apiKey = os.environ.get('MAPBOX_KEY')
 
 if 'MODEL_DATA_FOLDER' in os.environ:
     folder = os.environ['MODEL_DATA_FOLDER']
@@ -36,6 +48,24 @@ else:
 folder_images = folder
 chunks_size = 10
 processes = 4
+# Datasets already opened by this process, keyed by the arguments of read_dataset.
+# None (default) disables the cache, it is enabled by the render server which opens
+# every dataset once for all its jobs (see render_server.py)
+dataset_cache = None
+_cache_state = None
+# Forecast hours plotted by chunks_dataset, None for all of them
+selected_steps = None
+# Folder (in memory if possible) of the files used to share the time chunks with the
+# Pool workers, see chunks_dataset
+shared_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Pool of the plotting workers shared by all the products rendered by this process
+# (see render_server.py). None (default) starts a Pool for every map_chunks.
+worker_pool = None
+# Chunks submitted to worker_pool as (AsyncResult, shared folders), collected by the caller
+submitted_chunks = []
+# Folders of the files shared with the workers not handed to map_chunks yet, removed
+# (if any are left) when the process exits normally
+_shared_folders = []
 figsize_x = 11
 figsize_y = 9
 invariant_file = folder+'hsurf_*.nc'
@@ -110,64 +140,13 @@ WMO_GLYPH_LOOKUP_PNG = {
     '95': '25',
 }
 
-proj_defs = {
-    'nord':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4,
-        'llcrnrlat': 50,
-        'urcrnrlon': 12,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'it':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 5.5,
-        'llcrnrlat': 43.5,
-        'urcrnrlon': 14.5,
-        'urcrnrlat': 48,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'de':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4.5,
-        'llcrnrlat': 46.5,
-        'urcrnrlon': 16,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'north_sea':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 0,
-        'llcrnrlat': 50,
-        'urcrnrlon': 10,
-        'urcrnrlat': 58,
-        'resolution': 'i',
-    },
-    'domain':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': -3.9,
-        'llcrnrlat': 43.2,
-        'urcrnrlon': 20.3,
-        'urcrnrlat': 58,
-        'resolution': 'i',
-    },
-}
-
 
 def get_weather_icons(ww, time):
     """
     Get the path to a png given the weather representation 
     """
     weather = []
-    for w in ww.values:
+    for w in np.asarray(ww):
         if w.astype(int).astype(str) in WMO_GLYPH_LOOKUP_PNG:
             weather.append(WMO_GLYPH_LOOKUP_PNG[w.astype(int).astype(str)])
         else:
@@ -192,8 +171,107 @@ def get_weather_icons(ww, time):
 
 
 def read_dataset(variables=['T_2M', 'TD_2M'], level=None, projection=None,
-                 engine='scipy', freq='1H'):
-    """Wrapper to initialize the dataset"""
+                 engine='scipy', freq='1H', points=False):
+    """Wrapper to initialize the dataset. With points=True the variables are
+    read from the point-major store (when available) to extract time series."""
+    global _cache_state
+    if dataset_cache is not None:
+        # The datasets (lazy, the data are read by the workers) are opened again when
+        # the current run, its ready steps or its arrays change
+        state = _store_state()
+        if state != _cache_state:
+            dataset_cache.clear()
+            _cache_state = state
+        key = (tuple(variables), repr(level), projection, engine, freq, points)
+        if key not in dataset_cache:
+            dataset_cache[key] = open_dataset(variables, level, projection, engine, freq, points)
+        return dataset_cache[key].copy()
+
+    return open_dataset(variables, level, projection, engine, freq, points)
+
+
+def _store_state():
+    """Store of the current run with the modification times of its ready steps
+    and of its consolidated metadata"""
+    store = run_store.find_latest_store(folder)
+    if not store:
+        return None
+    return (store,) + tuple(os.stat(path).st_mtime_ns if os.path.isfile(path) else None
+                            for path in [os.path.join(store, run_store.ready_file),
+                                         os.path.join(store, '.zmetadata')])
+
+
+def open_dataset(variables, level=None, projection=None, engine='scipy', freq='1H', points=False):
+    """Open the variables from the run store or the NETCDF files, see read_dataset"""
+    # Variables ingested into the run store (see ingest.py) are read from there,
+    # steps that are not ingested yet are NaN. The others (e.g. 3d variables
+    # still merged with cdo) come from the NETCDF files.
+    store = run_store.find_latest_store(folder)
+    if store and points:
+        # Only if all variables of the store were copied in the point-major store
+        points_store = run_store.points_path(store)
+        stored = run_store.stored_variables(store)
+        if os.path.isdir(points_store) and stored.intersection(v.lower() for v in variables) \
+                <= run_store.stored_variables(points_store):
+            store = points_store
+        else:
+            points = False
+    if store:
+        stored = run_store.stored_variables(store)
+    else:
+        stored = set()
+    in_store = [var for var in variables if var.lower() in stored]
+    in_files = [var for var in variables if var.lower() not in stored]
+    if not freq:
+        # All the steps (every 15 minutes) of the variables that have them
+        in_store = [var + run_store.fine_suffix if (var + run_store.fine_suffix).lower() in stored
+                    else var for var in in_store]
+    if in_store:
+        dset, run = run_store.open_dataset(store, in_store)
+        dset = run_store.fine_to_time(dset)
+    if in_files:
+        dset_files, run = open_netcdf_files(in_files, engine=engine)
+        if in_store:
+            # cdo and the ingest may compute the coordinates with a different rounding
+            dset_files = dset_files.reindex(lat=dset.lat, lon=dset.lon,
+                                            method='nearest', tolerance=1e-3)
+            dset = xr.merge([dset, dset_files])
+        else:
+            dset = dset_files
+    # NOTE!! The datasets are lazy (dask). The time chunks are not pickled for the
+    # multiprocessing workers: chunks_dataset writes the arrays once in memory-mapped
+    # files and the workers read views of them.
+    dset = dset.metpy.parse_cf()
+    if freq:
+        dset = dset.resample(time=freq).nearest(tolerance='1H')
+    if level:
+        dset = dset.sel(plev=level, method='nearest')
+    if projection:
+        windows = run_store.get_windows(store) if in_store else {}
+        if projection in windows:
+            # Index window precomputed at ingest on the grid of the store
+            dset = dset.isel(lat=slice(*windows[projection]['lat']),
+                             lon=slice(*windows[projection]['lon']))
+        else:
+            proj_options = proj_defs[projection]
+            dset = dset.sel(lat=slice(proj_options['llcrnrlat'],
+                                      proj_options['urcrnrlat']),
+                            lon=slice(proj_options['llcrnrlon'],
+                                      proj_options['urcrnrlon']))
+    dset['run'] = run
+
+    # The scripts read one time step at a time over the whole (subsetted) domain,
+    # which is also how the run store is chunked. Time series keep the tiles of
+    # the point-major store, so that selecting a point only reads its tile.
+    if not points:
+        dset = dset.chunk({dim: size for dim, size in {'time': 1, 'lat': -1, 'lon': -1}.items()
+                           if dim in dset.dims})
+
+    return dset
+
+
+def open_netcdf_files(variables, engine='scipy'):
+    """Open the NETCDF files (one per variable) produced by cdo"""
     # Create the regex for the files with the needed variables
     variables_search = '('+'|'.join(variables)+')'
     # Get a list of all the files in the folder
@@ -207,28 +285,8 @@ def read_dataset(variables=['T_2M', 'TD_2M'], level=None, projection=None,
     dset = xr.open_mfdataset(needed_files,
                              preprocess=preprocess,
                              engine=engine)
-    # NOTE!! Even though we use open_mfdataset, which creates a Dask array, we then
-    # load the dataset into memory since otherwise the object cannot be pickled by
-    # multiprocessing
-    dset = dset.metpy.parse_cf()
-    if freq:
-        dset = dset.resample(time=freq).nearest(tolerance='1H')
-    if level:
-        dset = dset.sel(plev=level, method='nearest')
-    if projection:
-        proj_options = proj_defs[projection]
-        dset = dset.sel(lat=slice(proj_options['llcrnrlat'],
-                                  proj_options['urcrnrlat']),
-                        lon=slice(proj_options['llcrnrlon'],
-                                  proj_options['urcrnrlon']))
-    dset['run'] = run
 
-    # chunk now based on the dimension of the dataset after the subsetting
-    dset = dset.chunk({'time': round(len(dset.time) / 10),
-                       'lat': round(len(dset.lat) / 4),
-                       'lon': round(len(dset.lon) / 4)})
-
-    return dset
+    return dset, run
 
 
 def get_time_run_cum(dset):
@@ -275,35 +333,8 @@ def get_coordinates(ds):
 
 
 def get_city_coordinates(city):
-    # First read the local cache and see if we already downloaded the city coordinates
-    if os.path.isfile(home_folder + '/plotting/cities_coordinates.csv'):
-        cities_coords = pd.read_csv(home_folder + '/plotting/cities_coordinates.csv',
-                                    index_col=[0])
-        if city in cities_coords.index:
-            return cities_coords.loc[city].lon, cities_coords.loc[city].lat
-        else:
-            # make the request and append to the file
-            url = "%s/%s.json?&access_token=%s" % (apiURL_places, city, apiKey)
-            response = requests.get(url)
-            json_data = json.loads(response.text)
-            lon, lat = json_data['features'][0]['center']
-            to_append = pd.DataFrame(index=[city],
-                                     data={'lon': lon, 'lat': lat})
-            to_append.to_csv(home_folder + '/plotting/cities_coordinates.csv',
-                             mode='a', header=False)
-
-            return lon, lat
-    else:
-        # Make request and create the file for the first time
-        url = "%s/%s.json?&access_token=%s" % (apiURL_places, city, apiKey)
-        response = requests.get(url)
-        json_data = json.loads(response.text)
-        lon, lat = json_data['features'][0]['center']
-        cities_coords = pd.DataFrame(index=[city],
-                                     data={'lon': lon, 'lat': lat})
-        cities_coords.to_csv(home_folder + '/plotting/cities_coordinates.csv')
-
-        return lon, lat
+    """(lon, lat) of city from the local gazetteer, see gazetteer.py"""
+    return gazetteer.locate([city])[0]
 
 
 def get_projection(dset, projection="de", countries=True, regions=True, labels=False, color_borders='black'):
@@ -370,34 +401,184 @@ def chunks(l, n):
 
 def chunks_dataset(ds, n):
     """Same as 'chunks' but for the time dimension in
-    a dataset"""
+    a dataset. The arrays are written once in memory-mapped files and every
+    chunk is sent to the Pool workers as a small descriptor (see SharedChunk)."""
+    if selected_steps is not None:
+        _, _, cum_hour = get_time_run_cum(ds)
+        ds = ds.isel(time=np.flatnonzero(np.isin(cum_hour, selected_steps)))
+    descriptor = share_dataset(ds)
     for i in range(0, len(ds.time), n):
-        yield ds.isel(time=slice(i, i + n))
+        yield SharedChunk(dict(descriptor, time=slice(i, i + n)))
+
+
+def map_chunks(function, chunks):
+    """Render the time chunks (see chunks_dataset) with function in the Pool
+    workers, then remove the files shared with them. With a shared worker_pool
+    the chunks are only submitted: the caller collects the results and removes
+    the files from submitted_chunks (see render_server.py)."""
+    try:
+        chunks = list(chunks)
+    finally:
+        folders = _shared_folders[:]
+        del _shared_folders[:]
+    if worker_pool is not None:
+        # The workers may have imported the plotting script for another projection
+        module = sys.modules[getattr(function, 'func', function).__module__]
+        state = {'projection': module.projection} if hasattr(module, 'projection') else {}
+        submitted_chunks.append((worker_pool.map_async(partial(_map_chunk, function, state), chunks),
+                                 folders))
+        return
+    try:
+        with Pool(processes) as p:
+            return p.map(function, chunks)
+    finally:
+        remove_shared(folders)
+
+
+def _map_chunk(function, state, chunk):
+    module = sys.modules[getattr(function, 'func', function).__module__]
+    for name, value in state.items():
+        setattr(module, name, value)
+
+    return function(chunk)
+
+
+def remove_shared(folders):
+    """Remove the folders of files shared with the workers"""
+    for folder in folders:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+atexit.register(remove_shared, _shared_folders)
+
+
+class SharedChunk():
+    """Time chunk of a dataset shared through memory-mapped files. Only the
+    descriptor (file names, dims, attrs, time slice and the small variables) is
+    pickled, and it is unpickled in the worker directly as a Dataset of views."""
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+
+    def __reduce__(self):
+        return (open_shared, (self.descriptor,))
+
+
+def share_dataset(ds):
+    """Write the numeric variables of ds with a time dimension in .npy files,
+    removed by map_chunks once the workers are done with them. Returns the
+    descriptor read by open_shared.
+    Lazy (dask) variables are not computed here: only their graph is sent and
+    the workers read them frame by frame (see FrameArray)."""
+    folder = tempfile.mkdtemp(prefix='icon-d2-', dir=shared_folder)
+    _shared_folders.append(folder)
+    arrays = {}
+    for name, var in ds.data_vars.items():
+        if 'time' in var.dims and var.dtype.kind in 'biufcM' and var.chunks is None:
+            filename = os.path.join(folder, '%d.npy' % len(arrays))
+            np.save(filename, np.ascontiguousarray(var.values))
+            arrays[name] = (filename, var.dims, var.attrs)
+
+    return {'arrays': arrays, 'rest': ds.drop_vars(list(arrays)), 'time': slice(None)}
+
+
+def open_shared(descriptor):
+    """Dataset of a time chunk whose arrays are copy-on-write views of the
+    memory-mapped files, so the data are not copied in every worker.
+    Lazy variables are read one time step at a time when they are drawn."""
+    time = descriptor['time']
+    ds = descriptor['rest'].isel(time=time)
+    for name, var in ds.data_vars.items():
+        if 'time' in var.dims and var.chunks is not None:
+            ds[name] = xr.Variable(var.dims, indexing.LazilyIndexedArray(
+                FrameArray(var.data, var.dims.index('time'))), var.attrs)
+    for name, (filename, dims, attrs) in descriptor['arrays'].items():
+        values = np.load(filename, mmap_mode='c')
+        values = values[(slice(None),) * dims.index('time') + (time,)]
+        ds[name] = xr.Variable(dims, values, attrs)
+
+    return ds
+
+
+# Thread reading in the background the next frame of the lazy variables in every worker
+_prefetcher = None
+
+
+def _compute(array):
+    return np.asarray(array.compute(scheduler='synchronous'))
+
+
+class FrameArray(xr.backends.BackendArray):
+    """Lazy (dask) array that is computed one time step (frame) at a time.
+    Every frame is read once however many layers draw it, and when a frame is
+    used the following one is read in the background while it is drawn."""
+    def __init__(self, array, time_axis):
+        self.array = array
+        self.time_axis = time_axis
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.frames = {}
+
+    def read(self, itime):
+        global _prefetcher
+        if itime not in self.frames:
+            if _prefetcher is None:
+                _prefetcher = ThreadPoolExecutor(1)
+            index = (slice(None),) * self.time_axis + (itime,)
+            self.frames[itime] = _prefetcher.submit(_compute, self.array[index])
+
+        return self.frames[itime]
+
+    def frame(self, itime):
+        values = self.read(itime).result()
+        # Forget the frames already drawn and start reading the next one
+        for old in [t for t in self.frames if t < itime - 1]:
+            del self.frames[old]
+        if itime + 1 < self.shape[self.time_axis]:
+            self.read(itime + 1)
+
+        return values
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC,
+                                                  self._getitem)
+
+    def _getitem(self, key):
+        itime, rest = key[self.time_axis], key[:self.time_axis] + key[self.time_axis + 1:]
+        if isinstance(itime, (int, np.integer)):
+            return self.frame(int(itime))[rest]
+
+        return np.stack([self.frame(t)[rest] for t in range(*itime.indices(self.shape[self.time_axis]))],
+                        axis=self.time_axis)
 
 
 # Annotation run, models
+def run_text(time):
+    """Text of the run annotation"""
+    return 'ICON-D2 Run %s' % pd.to_datetime(time).strftime('%Y%m%d %H UTC')
+
+
 def annotation_run(ax, time, loc='upper right', fontsize=8):
     """Put annotation of the run obtaining it from the
     time array passed to the function."""
-    time = pd.to_datetime(time)
-    at = AnchoredText('ICON-D2 Run %s' % time.strftime('%Y%m%d %H UTC'),
-                      prop=dict(size=fontsize), frameon=True, loc=loc)
+    at = AnchoredText(run_text(time), prop=dict(size=fontsize), frameon=True, loc=loc)
     at.patch.set_boxstyle("round,pad=0.,rounding_size=0.1")
     at.zorder = 10
     ax.add_artist(at)
     return (at)
 
 
-def annotation_forecast(ax, time, loc='upper left', fontsize=8, local=True):
-    """Put annotation of the forecast time."""
+def forecast_text(time, local=True):
+    """Text of the forecast time annotation"""
     time = pd.to_datetime(time)
     if local:  # convert to local time
         time = convert_timezone(time)
-        at = AnchoredText('Valid %s' % time.strftime('%A %d %b %Y at %H:%M (Berlin)'),
-                          prop=dict(size=fontsize), frameon=True, loc=loc)
-    else:
-        at = AnchoredText('Forecast for %s' % time.strftime('%A %d %b %Y at %H:%M UTC'),
-                          prop=dict(size=fontsize), frameon=True, loc=loc)
+        return 'Valid %s' % time.strftime('%A %d %b %Y at %H:%M (Berlin)')
+    return 'Forecast for %s' % time.strftime('%A %d %b %Y at %H:%M UTC')
+
+
+def annotation_forecast(ax, time, loc='upper left', fontsize=8, local=True):
+    """Put annotation of the forecast time."""
+    at = AnchoredText(forecast_text(time, local), prop=dict(size=fontsize), frameon=True, loc=loc)
     at.patch.set_boxstyle("round,pad=0.,rounding_size=0.1")
     at.zorder = 10
     ax.add_artist(at)
@@ -538,8 +719,278 @@ def remove_collections(elements):
             print_message('WARNING: Collection is empty')
 
 
-def plot_maxmin_points(ax, lon, lat, data, extrema, nsize, symbol, color='k',
-                       random=False):
+class FrameRenderer():
+    """Figure of a Pool worker kept for all the frames it renders. The map,
+    the colorbar and the annotation boxes are drawn with the first frame and
+    afterwards only the text of the boxes changes. Every data layer is updated
+    in place when matplotlib allows it (quiver vectors, value labels), the
+    others (contours) are removed and drawn again at every frame.
+    - annotation: text of the box in the lower left corner
+    - colorbar: function called once with the artists of the layers of the
+      first frame to add the colorbars"""
+    def __init__(self, ax, x, y, annotation, colorbar=None):
+        self.ax, self.x, self.y = ax, x, y
+        self.annotation = annotation
+        self.colorbar = colorbar
+        # (draw(data) returning the artists, update(artists, data) or None)
+        self.layers = []
+        self.artists = None
+        self.boxes = None
+
+    def add_layer(self, draw, update=None):
+        self.layers.append((draw, update))
+
+    def contourf(self, var, **options):
+        self.add_layer(lambda data: self.ax.contourf(self.x, self.y, data[var], **options))
+
+    def contour(self, var, clabel=None, clabel_size=6, label_stroke=False, highlight=None, **options):
+        """Contours of var, with labels in the clabel format and the line of index
+        highlight drawn thicker"""
+        def draw(data):
+            c = self.ax.contour(self.x, self.y, data[var], **options)
+            if highlight is not None:
+                c.collections[highlight].set_linewidth(1.5)
+            if not clabel:
+                return [c]
+            labels = self.ax.clabel(c, c.levels, inline=True, fmt=clabel, fontsize=clabel_size)
+            if label_stroke:
+                plt.setp(labels, path_effects=[path_effects.withStroke(linewidth=0.5, foreground="w")])
+            return [c, labels]
+
+        self.add_layer(draw)
+
+    def quiver(self, u, v, density, **options):
+        """Vectors of u and v every density points, only their components change between frames"""
+        every = (slice(None, None, density), slice(None, None, density))
+
+        def draw(data):
+            return self.ax.quiver(self.x[every], self.y[every], data[u].values[every],
+                                  data[v].values[every], scale=None, **options)
+
+        def update(cv, data):
+            # Scaled again for every frame, as a new quiver would be
+            cv.scale = None
+            cv.set_UVC(data[u].values[every], data[v].values[every])
+
+        self.add_layer(draw, update)
+
+    def extrema(self, maxima, minima):
+        """H/L centres found by find_extrema"""
+        def draw(data):
+            time, _, _ = get_time_run_cum(data)
+            return [plot_extrema(self.ax, self.x, self.y, maxima[time], symbol='H', color='royalblue'),
+                    plot_extrema(self.ax, self.x, self.y, minima[time], symbol='L', color='coral')]
+
+        self.add_layer(draw)
+
+    def values(self, labels):
+        """Values computed by value_labels, the same artist draws all frames"""
+        def draw(data):
+            time, _, _ = get_time_run_cum(data)
+            return plot_value_labels(self.ax, labels[time])
+
+        def update(artist, data):
+            time, _, _ = get_time_run_cum(data)
+            artist.set_labels(*labels[time])
+
+        self.add_layer(draw, update)
+
+    @staticmethod
+    def remove(artists):
+        """Remove the artists of a layer, the labels of the contours may already
+        be gone with them (matplotlib >= 3.8)"""
+        for artist in artists if isinstance(artists, list) else [artists]:
+            if isinstance(artist, list):
+                FrameRenderer.remove(artist)
+            elif not isinstance(artist, Artist):
+                # ContourSet of matplotlib < 3.8
+                for coll in artist.collections:
+                    coll.remove()
+            elif artist.axes is not None:
+                artist.remove()
+
+    @staticmethod
+    def stack(artists, i):
+        """Keep the artists of the layer i above the ones of the previous layers
+        with the same zorder, which matplotlib draws in the order they were added,
+        also when those are drawn again after them"""
+        for artist in artists if isinstance(artists, list) else [artists]:
+            if isinstance(artist, list):
+                FrameRenderer.stack(artist, i)
+            elif not isinstance(artist, Artist):
+                FrameRenderer.stack(artist.collections, i)
+            else:
+                artist.set_zorder(artist.get_zorder() + i * 1e-3)
+
+    def draw(self, data):
+        """Draw the frame of data (a single time step)"""
+        time, run, _ = get_time_run_cum(data)
+        first = self.artists is None
+        if first:
+            self.artists = [None] * len(self.layers)
+        for i, (draw, update) in enumerate(self.layers):
+            if self.artists[i] is not None and update is not None:
+                update(self.artists[i], data)
+            else:
+                if self.artists[i] is not None:
+                    self.remove(self.artists[i])
+                self.artists[i] = draw(data)
+                self.stack(self.artists[i], i)
+        if self.boxes is None:
+            self.boxes = (annotation_forecast(self.ax, time),
+                          annotation(self.ax, self.annotation, loc='lower left', fontsize=6),
+                          annotation_run(self.ax, run))
+        else:
+            self.boxes[0].txt.set_text(forecast_text(time))
+            self.boxes[2].txt.set_text(run_text(run))
+        if first and self.colorbar:
+            self.colorbar(self.artists)
+
+    def save(self, filename):
+        # Not plt.savefig: the figures unpickled with the next chunks become the current one
+        self.ax.figure.savefig(filename, **options_savefig)
+
+
+# FrameRenderers of this process, see frame_renderer
+_renderers = {}
+
+
+class SharedFigure():
+    """Figure (e.g. the map with its background) pickled once in a file shared
+    with the workers and removed by map_chunks with the chunks: only the file
+    name is sent with every chunk, see frame_renderer"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            return pickle.load(f)
+
+
+def share_figure(fig):
+    """Write fig for the workers and close it here, returns its SharedFigure"""
+    folder = tempfile.mkdtemp(prefix='icon-d2-', dir=shared_folder)
+    _shared_folders.append(folder)
+    filename = os.path.join(folder, 'figure.pickle')
+    with open(filename, 'wb') as f:
+        pickle.dump(fig, f)
+    plt.close(fig)
+
+    return SharedFigure(filename)
+
+
+def frame_renderer(figure, setup):
+    """FrameRenderer of this process for the SharedFigure figure (e.g. of a product
+    and projection): the first chunk rendered by a Pool worker loads the figure and
+    builds it with setup(fig), the next ones reuse it. The renderers of the figures
+    already removed (previous jobs of the shared workers) are closed."""
+    if figure.filename not in _renderers:
+        for filename in [f for f in _renderers if not os.path.exists(f)]:
+            plt.close(_renderers.pop(filename).ax.figure)
+        _renderers[figure.filename] = setup(figure.load())
+
+    return _renderers[figure.filename]
+
+
+def smooth_field(data, n=9, passes=1):
+    """Smooth the last two dimensions of data (e.g. a whole (time, lat, lon) run at
+    once) as metpy.calc.smooth_n_point, leaving the border unchanged. The 9-point
+    window is the product of two 1-D windows (0.25, 0.5, 0.25), so every pass is one
+    smoothing along lat and one along lon. Returns float32 values (a DataArray if
+    data is one)."""
+    values = np.array(data, dtype='float32')
+    if n != 9:
+        values = np.asarray(mpcalc.smooth_n_point(values, n=n, passes=passes), dtype='float32')
+    else:
+        # One frame at a time, so that the buffers stay in the CPU cache
+        frames = values.reshape((-1,) + values.shape[-2:])
+        rows = np.empty((frames.shape[1] - 2, frames.shape[2]), dtype='float32')
+        half = np.empty_like(rows)
+        for frame in frames:
+            inner = frame[1:-1, 1:-1]
+            for _ in range(passes):
+                np.add(frame[:-2], frame[2:], out=rows)
+                np.multiply(frame[1:-1], 2., out=half)
+                rows += half
+                np.add(rows[:, :-2], rows[:, 2:], out=inner)
+                np.multiply(rows[:, 1:-1], 2., out=half[:, 1:-1])
+                inner += half[:, 1:-1]
+                inner *= 0.0625
+
+    return data.copy(data=values) if isinstance(data, xr.DataArray) else values
+
+
+def levels_range(data, step):
+    """Levels every step spanning the values of data, e.g. the MSLP of the whole
+    run. A lazy data is read once here: only use it for one 2-D variable."""
+    values = np.asarray(data)
+
+    return np.arange(int(np.nanmin(values)), int(np.nanmax(values)), step)
+
+
+def _extrema_frames(values, extrema, nsize):
+    """(ilat, ilon, values) of the centres of every frame of values (time, lat, lon),
+    see find_extrema"""
+    from scipy.ndimage import maximum_filter, minimum_filter
+    values = np.asarray(values)
+    if extrema == 'max':
+        data_ext, sign = maximum_filter(values, size=(1, nsize, nsize), mode='nearest'), -1
+    elif extrema == 'min':
+        data_ext, sign = minimum_filter(values, size=(1, nsize, nsize), mode='nearest'), 1
+    else:
+        raise ValueError('Value for hilo must be either max or min')
+    candidates = data_ext == values
+    # Filter out points on the border
+    candidates[:, [0, -1], :] = False
+    candidates[:, :, [0, -1]] = False
+    radius = nsize // 2
+    frames = []
+    for frame, frame_candidates in zip(values, candidates):
+        ilat, ilon = np.nonzero(frame_candidates)
+        # Strongest centres first, equal ones in the order of the grid
+        order = np.argsort(sign * frame[ilat, ilon], kind='stable')
+        suppressed = np.zeros(frame.shape, dtype=bool)
+        keep = []
+        for k in order:
+            i, j = ilat[k], ilon[k]
+            if not suppressed[i, j]:
+                keep.append(k)
+                suppressed[max(i - radius, 0):i + radius + 1, max(j - radius, 0):j + radius + 1] = True
+        keep = np.array(keep, dtype=int)
+        frames.append((ilat[keep], ilon[keep], frame[ilat[keep], ilon[keep]]))
+
+    return frames
+
+
+def find_extrema(data, extrema, nsize):
+    """Centres of the maxima (extrema='max', e.g. highs) or minima of all time steps
+    of data (time, lat, lon) at once: the points equal to the max/min of the
+    nsize x nsize box around them, except the border. Centres closer than
+    nsize/2 to a stronger (or equal and earlier) one are suppressed, so that
+    plateaus give a single centre and the result is always the same.
+    Returns {time (datetime64, as given by get_time_run_cum for one step):
+    (ilat, ilon, values)}, drawn by plot_extrema."""
+    frames = _extrema_frames(data.transpose('time', ...).values, extrema, nsize)
+
+    return dict(zip(data['time'].values, frames))
+
+
+def plot_extrema(ax, lon, lat, points, symbol, color='k'):
+    """Draw symbol and the value at the points (ilat, ilon, values) found by
+    find_extrema, lon and lat are the 2D plotting coordinates"""
+    texts = []
+    for i, j, value in zip(*points):
+        texts.append(ax.text(lon[i, j], lat[i, j], symbol, color=color, size=15,
+                             clip_on=True, horizontalalignment='center', verticalalignment='center',
+                             path_effects=[path_effects.withStroke(linewidth=1, foreground="black")], zorder=8))
+        texts.append(ax.text(lon[i, j], lat[i, j], '\n' + str(value.astype('int')),
+                             color="gray", size=10, clip_on=True, fontweight='bold',
+                             horizontalalignment='center', verticalalignment='top',
+                             zorder=8))
+    return (texts)
+
+
+def plot_maxmin_points(ax, lon, lat, data, extrema, nsize, symbol, color='k'):
     """
     This function will find and plot relative maximum and minimum for a 2D grid. The function
     can be used to plot an H for maximum values (e.g., High pressure) and an L for minimum
@@ -553,77 +1004,142 @@ def plot_maxmin_points(ax, lon, lat, data, extrema, nsize, symbol, color='k',
     nsize = Size of the grid box to filter the max and min values to plot a reasonable number
     symbol = String to be placed at location of max/min value
     color = String matplotlib colorname to plot the symbol (and numerica value, if plotted)
-    plot_value = Boolean (True/False) of whether to plot the numeric value of max/min point
     The max/min symbol will be plotted on the current axes within the bounding frame
-    (e.g., clip_on=True)
+    (e.g., clip_on=True). To draw many time steps find the centres of all of them
+    at once with find_extrema and draw them with plot_extrema.
     """
-    from scipy.ndimage.filters import maximum_filter, minimum_filter
+    points = _extrema_frames(np.asarray(data)[None], extrema, nsize)[0]
+
+    return plot_extrema(ax, lon, lat, points, symbol, color=color)
+
+
+class ValueLabels(Artist):
+    """Text labels at (x, y) with their own colours drawn as a single artist:
+    one Text is moved and redrawn for every label, so that a frame adds and
+    removes one artist instead of hundreds of annotations"""
+    def __init__(self, x, y, texts, rgba, **text_options):
+        super().__init__()
+        self.x, self.y, self.texts, self.rgba = x, y, texts, rgba
+        self._text = Text(**text_options)
+
+    def set_labels(self, x, y, texts, rgba):
+        """Replace the labels, e.g. with the ones of the next time step"""
+        self.x, self.y, self.texts, self.rgba = x, y, texts, rgba
+        self.stale = True
+
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        self._text.set_figure(self.figure)
+        self._text.set_transform(self.get_transform())
+        for x, y, text, rgba in zip(self.x, self.y, self.texts, self.rgba):
+            self._text.set_position((x, y))
+            self._text.set_text(text)
+            self._text.set_color(rgba)
+            self._text.draw(renderer)
+        self.stale = False
+
+
+def _drop_overlaps(x, y, widths, height, shape):
+    """Mask of the labels (ordered as a (lat, lon) grid of shape, NaN widths
+    for the missing ones) kept when a label is dropped if its box overlaps one
+    kept before. Boxes start at (x, y) in screen space, so only the labels a
+    few rows and columns away have to be checked."""
+    valid = ~np.isnan(widths)
+    rows, cols = shape
+    dx = np.abs(np.diff(x.reshape(shape), axis=1)).min() if cols > 1 else np.inf
+    dy = np.abs(np.diff(y.reshape(shape), axis=0)).min() if rows > 1 else np.inf
+    kc = int(np.nanmax(widths, initial=0.) // dx) if dx > 0 else cols
+    kr = int(height // dy) if dy > 0 else rows
+    if kc == 0 and kr == 0:
+        return valid
+    keep = np.zeros(shape, dtype=bool)
+    x, y, widths = x.reshape(shape), y.reshape(shape), widths.reshape(shape)
+    for ilat, ilon in zip(*np.nonzero(valid.reshape(shape))):
+        window = (slice(max(ilat - kr, 0), ilat + kr + 1), slice(max(ilon - kc, 0), ilon + kc + 1))
+        near = keep[window]
+        if near.any():
+            xs, ys, ws = x[window][near], y[window][near], widths[window][near]
+            if np.any((xs < x[ilat, ilon] + widths[ilat, ilon]) & (x[ilat, ilon] < xs + ws) &
+                      (np.abs(ys - y[ilat, ilon]) < height)):
+                continue
+        keep[ilat, ilon] = True
+
+    return keep.ravel()
+
+
+def value_labels(ax, projection, var, levels, density=50, cmap='rainbow', norm=None,
+                 shift_x=0., shift_y=0., fontsize=7.5, lcolors=True):
+    """Labels with the values of var (time, lat, lon) to write on the map of
+    every time step, computed for the whole run with numpy: one point every
+    density inside the projection extents, the NaNs excluded, colours from cmap
+    (white if not lcolors) and, in the screen space of ax, without the labels
+    overlapping others. The overlaps are measured at the final position of ax,
+    so the colorbars that shrink it must already be there (see plot_products.py).
+    Returns {time: (x, y, texts, rgba)} for plot_value_labels.
+    - shift_x and shift_y apply a shifting offset to all text labels"""
+    if norm is None:
+        norm = colors.Normalize(vmin=np.min(levels), vmax=np.max(levels))
 
-    # We have to first add some random noise to the field, otherwise it will find many maxima
-    # close to each other. This is not the best solution, though...
-    if random:
-        data = np.random.normal(data, 0.2)
+    m = mplcm.ScalarMappable(norm=norm, cmap=cmap)
 
-    if (extrema == 'max'):
-        data_ext = maximum_filter(data, nsize, mode='nearest')
-    elif (extrema == 'min'):
-        data_ext = minimum_filter(data, nsize, mode='nearest')
+    proj_options = proj_defs[projection]
+    lon_min, lon_max, lat_min, lat_max = proj_options['llcrnrlon'], proj_options['urcrnrlon'],\
+        proj_options['llcrnrlat'], proj_options['urcrnrlat']
+
+    # Remove values outside of the extents
+    var = var.sel(lat=slice(lat_min + 0.15, lat_max - 0.15),
+                  lon=slice(lon_min + 0.15, lon_max - 0.15))[:, ::density, ::density]
+    shape = var.shape[1:]
+    lons, lats = np.meshgrid(var.lon.values + shift_x, var.lat.values + shift_y)
+    x, y = lons.ravel(), lats.ravel()
+    values = var.values.reshape(var.shape[0], -1)
+    missing = np.isnan(values)
+    texts = np.char.mod('%d', np.where(missing, 0, values).astype('int'))
+    if lcolors:
+        rgba = m.to_rgba(values)
     else:
-        raise ValueError('Value for hilo must be either max or min')
+        rgba = np.broadcast_to(np.array(colors.to_rgba('white')), values.shape + (4,))
+    # Bold digits are about 0.6 em wide. The aspect of the map is applied only when
+    # the figure is drawn, the labels are placed where it will be.
+    ax.apply_aspect()
+    screen = ax.transData.transform(np.column_stack([x, y]))
+    em = fontsize * ax.figure.dpi / 72.
+    widths = np.where(missing, np.nan, np.char.str_len(texts) * 0.6 * em)
 
-    mxy, mxx = np.where(data_ext == data)
-    # Filter out points on the border
-    mxx, mxy = mxx[(mxy != 0) & (mxx != 0)], mxy[(mxy != 0) & (mxx != 0)]
+    labels = {}
+    for itime, time in enumerate(var['time'].values):
+        keep = _drop_overlaps(screen[:, 0], screen[:, 1], widths[itime], em, shape)
+        labels[time] = (x[keep], y[keep], texts[itime][keep], rgba[itime][keep])
 
-    texts = []
-    for i in range(len(mxy)):
-        texts.append(ax.text(lon[mxy[i], mxx[i]], lat[mxy[i], mxx[i]], symbol, color=color, size=15,
-                             clip_on=True, horizontalalignment='center', verticalalignment='center',
-                             path_effects=[path_effects.withStroke(linewidth=1, foreground="black")], zorder=8))
-        texts.append(ax.text(lon[mxy[i], mxx[i]], lat[mxy[i], mxx[i]], '\n' + str(data[mxy[i], mxx[i]].astype('int')),
-                             color="gray", size=10, clip_on=True, fontweight='bold',
-                             horizontalalignment='center', verticalalignment='top',
-                             zorder=8))
-    return (texts)
+    return labels
+
+
+def plot_value_labels(ax, labels, fontsize=7.5):
+    """Draw the labels (x, y, texts, rgba) of a time step computed by
+    value_labels, returns the artist to remove"""
+    artist = ValueLabels(*labels, fontsize=fontsize, weight='bold',
+                         path_effects=[path_effects.withStroke(linewidth=1, foreground="white")])
+    # Above the filled contours
+    artist.set_zorder(5)
+
+    return ax.add_artist(artist)
 
 
 def add_vals_on_map(ax, projection, var, levels, density=50,
                     cmap='rainbow', norm=None, shift_x=0., shift_y=0., fontsize=7.5, lcolors=True):
     '''Given an input projection, a variable containing the values and a plot put
     the values on a map exlcuing NaNs and taking care of not going
-    outside of the map boundaries, which can happen.
+    outside of the map boundaries, which can happen. Plotting scripts should rather
+    compute the labels of all time steps at once with value_labels.
     - shift_x and shift_y apply a shifting offset to all text labels
     - colors indicate whether the colorscale cmap should be used to map the values of the array'''
+    if 'time' not in var.dims:
+        var = var.expand_dims('time')
+    labels = value_labels(ax, projection, var, levels, density=density, cmap=cmap, norm=norm,
+                          shift_x=shift_x, shift_y=shift_y, fontsize=fontsize, lcolors=lcolors)
 
-    if norm is None:
-        norm = colors.Normalize(vmin=np.min(levels), vmax=np.max(levels))
-
-    m = mplcm.ScalarMappable(norm=norm, cmap=cmap)
-
-    proj_options = proj_defs[projection]
-    lon_min, lon_max, lat_min, lat_max = proj_options['llcrnrlon'], proj_options['urcrnrlon'],\
-        proj_options['llcrnrlat'], proj_options['urcrnrlat']
-
-    # Remove values outside of the extents
-    var = var.sel(lat=slice(lat_min + 0.15, lat_max - 0.15),
-                  lon=slice(lon_min + 0.15, lon_max - 0.15))[::density, ::density]
-    lons = var.lon.values
-    lats = var.lat.values
-
-    at = []
-    for ilat, ilon in np.ndindex(var.shape):
-        if not var[ilat, ilon].isnull():
-            if lcolors:
-                at.append(ax.annotate(('%d' % var[ilat, ilon]), (lons[ilon] + shift_x, lats[ilat] + shift_y),
-                                      color=m.to_rgba(float(var[ilat, ilon])), weight='bold', fontsize=fontsize,
-                                      path_effects=[path_effects.withStroke(linewidth=1, foreground="white")], zorder=5))
-
-            else:
-                at.append(ax.annotate(('%d' % var[ilat, ilon]), (lons[ilon] + shift_x, lats[ilat] + shift_y),
-                                      color='white', weight='bold', fontsize=fontsize,
-                                      path_effects=[path_effects.withStroke(linewidth=1, foreground="white")], zorder=5))
-
-    return at
+    return plot_value_labels(ax, next(iter(labels.values())), fontsize=fontsize)
 
 
 def divide_axis_for_cbar(ax, width="45%", height="2%", pad=-2, adjust=0.05):
@@ -0,0 +1,70 @@
+import os
+import sys
+import time as time_module
+import argparse
+import numpy as np
+
+# Times the numpy implementations of plotting/ against metpy on large grids, e.g.
+#   python tests/benchmark.py thermo
+#   python tests/benchmark.py kinematics
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plotting'))
+
+import metpy.calc as mpcalc  # noqa: E402
+from metpy.units import units  # noqa: E402
+import thermo  # noqa: E402
+import computations  # noqa: E402
+from test_thermo import sample_fields  # noqa: E402
+from test_computations import sample_winds, metpy_kinematics  # noqa: E402
+
+
+def benchmark_thermo(shape=(4, 4, 746, 1215)):
+    """Seconds taken by thermo_fields and by metpy for theta-e (as in the old
+    compute_thetae) and wet-bulb temperature on a grid of shape (4 steps and
+    4 levels of the ICON-D2 domain by default)"""
+    p, t, rh = sample_fields(shape)
+    start = time_module.time()
+    thermo.thermo_fields(p, t, rh)
+    numpy_time = time_module.time() - start
+    start = time_module.time()
+    thermo.thermo_fields(p, t, rh, wet_bulb=False)
+    numpy_time_no_wet_bulb = time_module.time() - start
+    start = time_module.time()
+    t_q = units.Quantity(t, 'K')
+    td_q = mpcalc.dewpoint_from_relative_humidity(t_q, units.Quantity(rh, 'percent'))
+    mpcalc.equivalent_potential_temperature(units.Quantity(p, 'Pa'), t_q, td_q)
+    metpy_time = time_module.time() - start
+    # metpy computes the wet-bulb temperature point by point, time it on a few of them
+    points = 100
+    start = time_module.time()
+    mpcalc.wet_bulb_temperature(units.Quantity(np.broadcast_to(p, t.shape).ravel()[:points], 'Pa'),
+                                t_q.ravel()[:points], td_q.ravel()[:points])
+    metpy_wet_bulb_time = (time_module.time() - start) * t.size / points
+
+    return {'numpy (all fields)': numpy_time, 'numpy (without wet-bulb)': numpy_time_no_wet_bulb,
+            'metpy (dewpoint and theta-e)': metpy_time,
+            'metpy (wet-bulb, extrapolated)': metpy_wet_bulb_time}
+
+
+def benchmark_kinematics(shape=(10, 300, 400)):
+    """Seconds taken by computations.kinematics and by metpy for all the fields on a grid of shape"""
+    u, v, scalar, lat, lon = sample_winds(shape)
+    start = time_module.time()
+    computations.kinematics(u, v, computations.grid_metrics(lat, lon), scalar)
+    numpy_time = time_module.time() - start
+    start = time_module.time()
+    metpy_kinematics(u, v, scalar, lat, lon)
+    metpy_time = time_module.time() - start
+
+    return {'numpy (kinematics)': numpy_time, 'metpy': metpy_time}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', help='thermo: thermodynamic fields on the ICON-D2 grid, '
+                                       'kinematics: wind kinematics',
+                        choices=['thermo', 'kinematics'])
+    args = parser.parse_args()
+
+    times = benchmark_thermo() if args.action == 'thermo' else benchmark_kinematics()
+    for name, seconds in times.items():
+        print('%-30s %.2f s' % (name, seconds))
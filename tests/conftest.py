@@ -0,0 +1,55 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+# pyproj (used by metpy) must be loaded before eccodes: in the other order, with the libraries of
+# the wheels, pyproj finds no PROJ database and the interpreter crashes at exit
+import pyproj  # noqa: F401
+
+# The modules of plotting/ import each other by name, as when the scripts are run from there
+plotting_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plotting')
+sys.path.insert(0, plotting_folder)
+
+import dwd_stand_in  # noqa: E402
+import download_dwd  # noqa: E402
+import run_store  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def stand_in():
+    """Stand-in of the DWD server on the committed fixture, with download_dwd
+    pointed to it. The test can make files fail or replace them through
+    server.failures and server.contents, see dwd_stand_in.StandInHandler."""
+    server, url = dwd_stand_in.start()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(download_dwd, 'base_url', url)
+        patch.setattr(download_dwd, 'retry_wait', 0.01)
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def synthetic_store(tmp_path):
+    """Path of a small complete run store written without any download: every
+    2D variable (t_2m, tot_prec) has the value step + ilat + ilon / 1000 (and its
+    15 minutes steps the same value at step / steps_per_hour), so that readers
+    can check what they get."""
+    shape, variables = (40, 50), ('t_2m', 'tot_prec')
+    path = run_store.store_path(str(tmp_path), '2024010100')
+    lat, lon = np.linspace(47., 55., shape[0]), np.linspace(5., 15., shape[1])
+    group = run_store.open_group(path, pd.Timestamp('2024-01-01 00:00'), lat, lon)
+    grid = np.arange(shape[0])[:, None] + np.arange(shape[1])[None, :] / 1000.
+    for var in variables:
+        name = run_store.array_name(var)
+        arr = run_store.require_variable(group, name, var, {'long_name': var, 'units': '1'})
+        fine, _ = run_store.require_fine_variable(group, name, var, {'long_name': var, 'units': '1'})
+        for ifine in range(fine.shape[0]):
+            run_store.write_step(fine, ifine, grid + ifine / run_store.steps_per_hour)
+        for step in range(run_store.forecast_hours + 1):
+            run_store.write_step(arr, step, grid + step)
+            run_store.mark_ready(path, var, step)
+    run_store.consolidate(path)
+
+    return path
@@ -0,0 +1,158 @@
+import os
+import bz2
+import threading
+import argparse
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import numpy as np
+import pandas as pd
+import eccodes
+
+# Local stand-in of the DWD open data server: serves a <run hour>/<variable>/<file>.grib2.bz2
+# tree with the same index pages, so that download_dwd.py and ingest.py can be run without
+# network by pointing DWD_BASE_URL (or download_dwd.base_url) to it, e.g.
+#   python tests/dwd_stand_in.py serve &
+#   DWD_BASE_URL=http://localhost:8091 python plotting/download_dwd.py -r 2024010100 -v t_2m
+# The tests start it with the stand_in fixture of conftest.py. The fixture committed in
+# fixtures/dwd is a small grid (fixture_shape) at the corner of the ICON-D2 domain written by
+# `python tests/dwd_stand_in.py build`. tot_prec has, as on the server, the 15 minutes steps
+# of every hour in the file of the hour.
+tests_folder = os.path.dirname(os.path.abspath(__file__))
+fixture_folder = os.path.join(tests_folder, 'fixtures', 'dwd')
+fixture_run = '2024010100'
+fixture_hours = range(3)
+fixture_shape = (10, 12)
+# Variables of the fixture and the minutes (within every hour) of their steps
+fixture_variables = {'t_2m': [0], 'tot_prec': [15, 30, 45, 0]}
+# GRIB2 parameter (discipline, category, number) and fixed surface (type, value) of every variable
+parameters = {'t_2m': ((0, 0, 0), (103, 2)), 'tot_prec': ((0, 1, 52), (1, 0))}
+port = 8091
+lat_first, lon_first, resolution = 43.18, -3.94, 0.02
+
+
+def grib_message(var, run, minutes, values):
+    """GRIB2 message (bytes) of var on the regular lat-lon grid of the fixture
+    valid minutes after run (Timestamp)"""
+    (discipline, category, number), (surface, value) = parameters[var]
+    nlat, nlon = values.shape
+    gid = eccodes.codes_grib_new_from_samples('GRIB2')
+    try:
+        for key, val in [('Ni', nlon), ('Nj', nlat),
+                         ('latitudeOfFirstGridPointInDegrees', lat_first),
+                         ('latitudeOfLastGridPointInDegrees', lat_first + resolution * (nlat - 1)),
+                         ('longitudeOfFirstGridPointInDegrees', lon_first % 360),
+                         ('longitudeOfLastGridPointInDegrees', (lon_first + resolution * (nlon - 1)) % 360),
+                         ('iDirectionIncrementInDegrees', resolution),
+                         ('jDirectionIncrementInDegrees', resolution),
+                         ('jScansPositively', 1),
+                         ('dataDate', int(run.strftime('%Y%m%d'))), ('dataTime', int(run.strftime('%H%M'))),
+                         ('indicatorOfUnitOfTimeRange', 0), ('forecastTime', int(minutes)),
+                         ('discipline', discipline), ('parameterCategory', category),
+                         ('parameterNumber', number),
+                         ('typeOfFirstFixedSurface', surface), ('scaledValueOfFirstFixedSurface', value),
+                         ('scaleFactorOfFirstFixedSurface', 0)]:
+            eccodes.codes_set(gid, key, val)
+        eccodes.codes_set_values(gid, values.astype('float64').ravel())
+        return eccodes.codes_get_message(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+
+def fixture_values(var, minutes, shape=fixture_shape):
+    """Deterministic field of var after minutes: t_2m varies with the step and
+    the position, tot_prec accumulates 0.1 kg m-2 every 15 minutes on every point"""
+    ilat, ilon = np.indices(shape)
+    if var == 'tot_prec':
+        return np.full(shape, 0.1 * minutes / 15.) + 0.01 * ilat
+    return 270. + minutes / 60. + 0.1 * ilat + 0.01 * ilon
+
+
+def fixture_url_path(var, run_string, hour):
+    """Path of the file of var for hour on the server"""
+    return '%s/%s/icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_%s.grib2.bz2' % (
+        run_string[-2:], var, run_string, hour, var)
+
+
+def build(folder=fixture_folder, run_string=fixture_run, hours=fixture_hours,
+          variables=fixture_variables):
+    """Write the fixture tree in folder, returns the paths of the files"""
+    run = pd.to_datetime(run_string, format='%Y%m%d%H')
+    paths = []
+    for var, minutes in variables.items():
+        for hour in hours:
+            # The first file only has the initial step
+            steps = [hour * 60] if hour == 0 else \
+                [(hour - 1) * 60 + m if m else hour * 60 for m in minutes]
+            data = b''.join(grib_message(var, run, step, fixture_values(var, step)) for step in steps)
+            path = os.path.join(folder, fixture_url_path(var, run_string, hour))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(bz2.compress(data))
+            paths.append(path)
+
+    return paths
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    """Serves the files and index pages of the fixture folder. The server can
+    make some files fail: server.failures maps a file name to the number of
+    requests answered with 503 before the file is served (-1 for always),
+    server.contents maps a file name to the bytes served in place of the file.
+    server.requests counts the requests of every file name."""
+    def do_GET(self):
+        name = os.path.basename(self.path)
+        failures = self.server.failures
+        with self.server.lock:
+            self.server.requests[name] = self.server.requests.get(name, 0) + 1
+            left = failures.get(name, 0)
+            if left:
+                failures[name] = left - 1 if left > 0 else left
+        if left:
+            self.send_error(503, 'Failure requested for %s' % name)
+            return
+        if name in self.server.contents:
+            content = self.server.contents[name]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(folder=fixture_folder, host='localhost', port=0, failures=None, contents=None):
+    """Serve folder in a background thread (on a free port by default).
+    Returns the server and its base url."""
+    server = ThreadingHTTPServer((host, port), functools.partial(StandInHandler, directory=folder))
+    server.daemon_threads = True
+    server.failures = dict(failures or {})
+    server.contents = dict(contents or {})
+    server.requests = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://%s:%d' % (host, server.server_address[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', help='build: write the fixture, serve: serve it',
+                        choices=['build', 'serve'])
+    parser.add_argument('-f', '--folder', help='Folder of the fixture',
+                        required=False, default=fixture_folder)
+    parser.add_argument('-p', '--port', help='Port to listen on (serve)',
+                        required=False, default=port, type=int)
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        print('%d files written in %s' % (len(build(args.folder)), args.folder))
+    else:
+        server, url = start(args.folder, port=args.port)
+        print('Serving %s on %s' % (args.folder, url), flush=True)
+        try:
+            threading.Event().wait()
+        finally:
+            server.shutdown()
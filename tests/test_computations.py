@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import xarray as xr
+import metpy.calc as mpcalc
+import computations
+
+# Maximum differences from metpy relative to the largest value of every field
+# (only the rounding of the float32 results remains)
+tolerance = 1e-6
+
+
+def sample_winds(shape, seed=0):
+    """Smooth random u, v (m/s) and temperature (K) of shape (time, lat, lon) and
+    their lat, lon on a part of the ICON-D2 domain"""
+    rng = np.random.default_rng(seed)
+    lat, lon = np.linspace(43.2, 58.1, shape[1]), np.linspace(-3.9, 20.3, shape[2])
+    phi, lam = np.meshgrid(np.radians(lat), np.radians(lon), indexing='ij')
+    steps = np.arange(shape[0])[:, None, None] * 0.1
+
+    def field(scale, offset=0.):
+        waves = sum(rng.uniform(0.5, 1.) * np.sin(a * phi + b * lam + c + steps)
+                    for a, b, c in rng.uniform(2., 12., (6, 3)))
+        return (offset + scale * waves).astype('float32')
+
+    return field(10.), field(10.), field(5., 280.), lat, lon
+
+
+def metpy_kinematics(u, v, scalar, lat, lon):
+    """The fields of computations.kinematics computed by metpy in float64 on the
+    same sphere (metpy uses the ellipsoid of the grid by default)"""
+    def data_array(values, unit):
+        return xr.DataArray(np.asarray(values, dtype='float64'), dims=('time', 'lat', 'lon'),
+                            coords={'lat': lat, 'lon': lon},
+                            attrs={'units': unit}).metpy.assign_crs(
+                                grid_mapping_name='latitude_longitude', earth_radius=computations.earth_radius)
+    u, v, scalar = data_array(u, 'm/s'), data_array(v, 'm/s'), data_array(scalar, 'K')
+    fields = {'divergence': mpcalc.divergence(u, v), 'vorticity': mpcalc.vorticity(u, v),
+              'stretching': mpcalc.stretching_deformation(u, v),
+              'shearing': mpcalc.shearing_deformation(u, v),
+              'advection': mpcalc.advection(scalar, u, v)}
+
+    return {name: field.metpy.dequantify().values for name, field in fields.items()}
+
+
+@pytest.mark.filterwarnings('ignore:Vertical dimension number not found')
+@pytest.mark.parametrize('shape, seed', [((4, 100, 120), 0), ((2, 57, 83), 1)])
+def test_kinematics_same_as_metpy(shape, seed):
+    u, v, scalar, lat, lon = sample_winds(shape, seed)
+    fields = computations.kinematics(u, v, computations.grid_metrics(lat, lon), scalar)
+    for name, reference in metpy_kinematics(u, v, scalar, lat, lon).items():
+        assert fields[name].dtype == np.float32
+        error = np.nanmax(np.abs(fields[name] - reference)) / np.nanmax(np.abs(reference))
+        assert error <= tolerance, name
+
+
+def test_only_requested_fields():
+    u, v, _, lat, lon = sample_winds((1, 20, 30))
+    fields = computations.kinematics(u, v, computations.grid_metrics(lat, lon), fields=('vorticity',))
+    assert list(fields) == ['vorticity']
@@ -0,0 +1,28 @@
+import os
+import bz2
+import asyncio
+import pytest
+import download_dwd
+from dwd_stand_in import fixture_folder, fixture_run, fixture_hours, fixture_url_path
+
+
+def test_download_matches_fixture(stand_in, tmp_path):
+    """A file failing once is retried, every file equals the fixture"""
+    stand_in.failures[os.path.basename(fixture_url_path('t_2m', fixture_run, 1))] = 1
+    files = asyncio.run(download_dwd.download_variables(['t_2m', 'tot_prec'], fixture_run,
+                                                        folder=str(tmp_path)))
+    for var in ['t_2m', 'tot_prec']:
+        for hour in fixture_hours:
+            path = fixture_url_path(var, fixture_run, hour)
+            filename = download_dwd.extracted_filename(path, str(tmp_path))
+            assert filename in files
+            with bz2.open(os.path.join(fixture_folder, path)) as f, open(filename, 'rb') as g:
+                assert f.read() == g.read()
+
+
+def test_download_error_keeps_other_files(stand_in, tmp_path):
+    """A file failing always raises DownloadError, the other ones are downloaded"""
+    stand_in.failures[os.path.basename(fixture_url_path('t_2m', fixture_run, 1))] = -1
+    with pytest.raises(download_dwd.DownloadError):
+        asyncio.run(download_dwd.download_variables(['t_2m'], fixture_run, folder=str(tmp_path)))
+    assert len(os.listdir(tmp_path)) == len(fixture_hours) - 1
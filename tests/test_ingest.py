@@ -0,0 +1,66 @@
+import os
+import bz2
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+import ingest
+from dwd_stand_in import fixture_run, fixture_hours, fixture_url_path, fixture_values, grib_message
+
+run_store = ingest.run_store
+# A corrupt file and a file without hourly steps (only a 100 minutes one) of t_2m
+corrupt = os.path.basename(fixture_url_path('t_2m', fixture_run, 1))
+no_steps = os.path.basename(fixture_url_path('t_2m', fixture_run, 2))
+
+
+@pytest.fixture(scope='module')
+def streamed(stand_in, tmp_path_factory):
+    """Stream the fixture in a temporary run store, returns the IngestError raised"""
+    run = pd.to_datetime(fixture_run, format='%Y%m%d%H')
+    header = b'GRIB\x00\x00\x00\x02' + (64).to_bytes(8, 'big')
+    stand_in.contents[corrupt] = bz2.compress(header + bytes(48))
+    stand_in.contents[no_steps] = bz2.compress(grib_message('t_2m', run, 100, fixture_values('t_2m', 100)))
+    output = str(tmp_path_factory.mktemp('ingest'))
+    with pytest.MonkeyPatch.context() as patch:
+        # Only the hours of the fixture are waited for
+        patch.setattr(run_store, 'forecast_hours', max(fixture_hours))
+        with pytest.raises(ingest.IngestError) as error:
+            asyncio.run(ingest.stream_run(['t_2m', 'tot_prec'], fixture_run, folder=output,
+                                          poll_interval=0.1, timeout=60))
+        yield error.value
+
+
+def test_given_up_steps_reported(streamed):
+    assert streamed.missing == {'t_2m': [1, 2]}
+
+
+def test_corrupt_file_given_up(streamed, stand_in):
+    assert stand_in.requests[corrupt] == ingest.max_attempts
+
+
+def test_file_without_hourly_steps_not_downloaded_again(streamed, stand_in):
+    assert stand_in.requests[no_steps] == 1
+
+
+def test_ready_steps(streamed):
+    assert run_store.ready_steps(streamed.path) == {'t_2m': {0}, 'tot_prec': set(fixture_hours)}
+
+
+def test_hourly_steps_match_fixture(streamed):
+    dset, _ = run_store.open_dataset(streamed.path, ['t_2m', 'tot_prec'])
+    catalog = run_store.open_store(streamed.path).attrs['catalog']
+    for var, steps in {'t_2m': [0], 'tot_prec': fixture_hours}.items():
+        for step in steps:
+            values = dset[catalog[var]['array']].isel(time=step).values
+            np.testing.assert_allclose(values, fixture_values(var, step * 60), atol=1e-3)
+
+
+def test_fine_steps_only_for_tot_prec(streamed):
+    catalog = run_store.open_store(streamed.path).attrs['catalog']
+    assert 't_2m' + run_store.fine_suffix not in catalog
+    dset, run = run_store.open_dataset(streamed.path, ['tot_prec' + run_store.fine_suffix])
+    dset = run_store.fine_to_time(dset)
+    minutes = (dset['time'] - np.datetime64(run)) / np.timedelta64(1, 'm')
+    for itime, minute in enumerate(minutes.values):
+        np.testing.assert_allclose(dset[catalog['tot_prec']['array']].isel(time=itime).values,
+                                   fixture_values('tot_prec', minute), atol=1e-3)
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import zarr
+import run_store
+import point_server
+
+# Grid point asked and the values of the synthetic store there
+ilat, ilon = 3, 7
+expected = np.arange(run_store.forecast_hours + 1) + ilat + ilon / 1000.
+
+
+def values(path, var):
+    """Store the values of var at the grid point are read from and the values"""
+    data = point_server.RunData(path)
+    window, weights = data.index(data.lat[ilat], data.lon[ilon])
+    store = data.arrays[var].chunk_store.path.rstrip('/')
+
+    return ('points' if store == run_store.points_path(path) else 'run'), data.values(var, window, weights)
+
+
+def test_complete_only_when_all_steps_ready(synthetic_store):
+    ready = os.path.join(synthetic_store, run_store.ready_file)
+    with open(ready) as f:
+        events = f.readlines()
+    with open(ready, 'w') as f:
+        f.writelines(events[:-1])
+    assert not point_server.complete(synthetic_store)
+    with open(ready, 'w') as f:
+        f.writelines(events)
+    assert point_server.complete(synthetic_store)
+
+
+def test_points_store_used_once_copied(synthetic_store):
+    run_store.write_points(synthetic_store, 't_2m')
+    # tot_prec as left by a copy still running (or interrupted): created but not in the catalog
+    source = zarr.open_group(synthetic_store, mode='r')['tp']
+    points = zarr.open_group(run_store.points_path(synthetic_store), mode='a')
+    points.create_dataset('tp', shape=source.shape, dtype=source.dtype, fill_value=np.nan,
+                          overwrite=True).attrs['_ARRAY_DIMENSIONS'] = source.attrs['_ARRAY_DIMENSIONS']
+    for var, store in [('t_2m', 'points'), ('tot_prec', 'run')]:
+        read_from, data = values(synthetic_store, var)
+        assert read_from == store, var
+        np.testing.assert_allclose(data, expected)
+    run_store.write_points(synthetic_store, 'tot_prec')
+    read_from, data = values(synthetic_store, 'tot_prec')
+    assert read_from == 'points'
+    np.testing.assert_allclose(data, expected)
+
+
+def test_fine_steps_not_served(synthetic_store):
+    assert 'tot_prec' + run_store.fine_suffix not in point_server.RunData(synthetic_store).catalog
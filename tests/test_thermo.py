@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import metpy.calc as mpcalc
+from metpy.units import units
+import thermo
+
+# Maximum differences from metpy (K, kg/kg)
+tolerance = {'dewpoint': 0.01, 'theta': 0.01, 'theta_e': 0.05, 'mixing_ratio': 1e-6,
+             'wet_bulb': 0.2}
+
+
+def sample_fields(shape, seed=0):
+    """Random but realistic p (Pa), t (K) and rh (%) of shape (time, plev, lat, lon)"""
+    rng = np.random.default_rng(seed)
+    plev = np.array([95000., 85000., 70000., 50000.][:shape[1]], dtype='float32')
+    t = (288. - 0.0065 * 8400. * np.log(100000. / plev))[None, :, None, None] + \
+        rng.uniform(-10., 10., shape)
+    rh = rng.uniform(5., 100., shape)
+
+    return plev[:, None, None], t.astype('float32'), rh.astype('float32')
+
+
+@pytest.fixture(scope='module')
+def fields():
+    """thermo_fields and metpy on the same random data"""
+    p, t, rh = sample_fields((1, 4, 50, 50))
+    p = np.broadcast_to(p, t.shape)
+    p_q, t_q = units.Quantity(p.astype('float64'), 'Pa'), units.Quantity(t.astype('float64'), 'K')
+    td_q = mpcalc.dewpoint_from_relative_humidity(t_q, units.Quantity(rh.astype('float64'), 'percent'))
+
+    return thermo.thermo_fields(p, t, rh), (p_q, t_q, td_q)
+
+
+@pytest.mark.parametrize('name', ['dewpoint', 'theta', 'theta_e', 'mixing_ratio'])
+def test_same_as_metpy(fields, name):
+    values, (p_q, t_q, td_q) = fields
+    reference = {
+        'dewpoint': lambda: td_q.m_as('K'),
+        'theta': lambda: mpcalc.potential_temperature(p_q, t_q).m_as('K'),
+        'theta_e': lambda: mpcalc.equivalent_potential_temperature(p_q, t_q, td_q).m_as('K'),
+        'mixing_ratio': lambda: mpcalc.mixing_ratio(mpcalc.saturation_vapor_pressure(td_q), p_q).m_as(''),
+    }[name]()
+    assert np.nanmax(np.abs(values[name] - reference)) <= tolerance[name]
+
+
+def test_wet_bulb_same_as_metpy(fields):
+    """Only on some points as metpy is very slow there"""
+    values, (p_q, t_q, td_q) = fields
+    some = np.random.default_rng(1).choice(t_q.size, 200, replace=False)
+    reference = mpcalc.wet_bulb_temperature(p_q.ravel()[some], t_q.ravel()[some], td_q.ravel()[some]).m_as('K')
+    assert np.nanmax(np.abs(values['wet_bulb'].ravel()[some] - reference)) <= tolerance['wet_bulb']
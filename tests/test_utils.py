@@ -0,0 +1,48 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import utils
+
+
+def chunk_sums(chunk):
+    return {name: float(chunk[name].sum()) for name in chunk.data_vars}
+
+
+@pytest.fixture
+def dataset():
+    """Random dataset of 49 steps on a 200 x 240 grid"""
+    rng = np.random.default_rng(0)
+    shape = (49, 200, 240)
+    return xr.Dataset({name: (('time', 'lat', 'lon'), rng.normal(size=shape).astype('float32'))
+                       for name in ['2t', 'prmsl', '10u']},
+                      coords={'time': pd.date_range('2024-01-01', periods=shape[0], freq='1h'),
+                              'lat': np.linspace(43., 58., shape[1]), 'lon': np.linspace(-4., 20., shape[2])})
+
+
+def test_shared_chunks_read_by_workers(dataset):
+    """The chunks read by the Pool workers equal the original ones and the
+    shared files are gone after map_chunks"""
+    n = utils.chunks_size
+    chunks = list(utils.chunks_dataset(dataset, n))
+    folders = utils._shared_folders[:]
+    results = utils.map_chunks(chunk_sums, chunks)
+    expected = [chunk_sums(dataset.isel(time=slice(i, i + n))) for i in range(0, dataset.sizes['time'], n)]
+    assert len(results) == len(expected)
+    for result, sums in zip(results, expected):
+        assert result == pytest.approx(sums)
+    assert not any(os.path.exists(folder) for folder in folders)
+
+
+def test_shared_chunk_pickled_small(dataset):
+    """Only a descriptor of the shared chunk is sent to the workers"""
+    n = utils.chunks_size
+    folders = utils._shared_folders[:]
+    chunks = list(utils.chunks_dataset(dataset, n))
+    try:
+        assert len(pickle.dumps(chunks[0])) < len(pickle.dumps(dataset.isel(time=slice(0, n)))) / 100
+    finally:
+        utils.remove_shared([folder for folder in utils._shared_folders if folder not in folders])
+
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time as time_module
+import subprocess
+import argparse
+import numpy as np
+import pandas as pd
+import get_last_run
+
+# Long-lived alternative to the cron job: wait for every new run, polling the server often
+# only when the files are expected, and start the processing as soon as they are complete.
+run_interval = pd.Timedelta('3 hours')
+# Seconds between two listings inside/outside the expected publication window
+fast_poll = 60
+slow_poll = 15 * 60
+# Window used when there is no history yet (minutes after the nominal run time)
+default_window = (60, 150)
+# Minimum half width of the window around the predicted publication (minutes)
+min_margin = 10
+# Number of past runs kept for every run hour and variable
+history_length = 30
+# A run still incomplete after these hours is reported, and replaced by the following run once that is available
+give_up = pd.Timedelta('6 hours')
+# Forecast steps that must be on the server to start the command: the streaming ingest
+# started by copy_data.run waits for the other ones
+trigger_steps = get_last_run.f_times[:1]
+# Seconds before the command is executed again for a run for which it failed
+retry_wait = 15 * 60
+history_file = os.path.join(get_last_run.data_folder, 'publication_latency.json')
+command = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'copy_data.run')
+
+
+def print_message(message):
+    """Formatted print"""
+    print('%s watch_runs.py : %s' % (pd.Timestamp.utcnow().strftime('%Y-%m-%d %H:%M:%S'), message),
+          flush=True)
+
+
+def utcnow():
+    return pd.Timestamp.utcnow().tz_localize(None)
+
+
+def load_history(filename=history_file):
+    """Publication latencies {run hour: {variable: [minutes, ...]}}"""
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return {}
+
+
+def save_history(history, filename=history_file):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def record_latency(history, run, var, latency):
+    """Add the latency (minutes between the nominal run time and the moment all
+    steps of var were on the server) of run (YYYYMMDDHH)"""
+    latencies = history.setdefault(run[-2:], {}).setdefault(var, [])
+    latencies.append(round(float(latency), 1))
+    del latencies[:-history_length]
+
+
+def predict_window(history, run):
+    """Interval (Timestamps) in which the files of run (YYYYMMDDHH) are expected
+    to be complete, from the latencies of the past runs with the same hour
+    (or all hours if there are none yet). The slowest variable sets the window."""
+    per_hour = history.get(run[-2:]) or {}
+    if not per_hour:
+        per_hour = {}
+        for hour in history.values():
+            for var, latencies in hour.items():
+                per_hour.setdefault(var, []).extend(latencies)
+    run_time = pd.to_datetime(run, format='%Y%m%d%H')
+    if not per_hour:
+        return (run_time + pd.Timedelta(minutes=default_window[0]),
+                run_time + pd.Timedelta(minutes=default_window[1]))
+    expected = max(np.median(latencies) for latencies in per_hour.values())
+    margin = max([min_margin] + [2 * np.std(latencies) for latencies in per_hour.values()])
+
+    return (run_time + pd.Timedelta(minutes=expected - margin),
+            run_time + pd.Timedelta(minutes=expected + margin))
+
+
+def next_poll(now, window):
+    """Seconds to wait before the next listing: poll fast inside the window,
+    sleep until the window otherwise, and back off slowly once it has passed"""
+    start, end = window
+    if now < start:
+        return max(fast_poll, min(slow_poll, (start - now).total_seconds()))
+    if now <= end:
+        return fast_poll
+    # Late run: double the interval for every window width that has passed
+    late = (now - end) / max(end - start, pd.Timedelta(minutes=min_margin))
+
+    return min(slow_poll, fast_poll * 2 ** int(late))
+
+
+def next_run(last_processed=None, now=None):
+    """Run (YYYYMMDDHH) to wait for after last_processed. If there is no
+    previous run, or it is more than a day old, the last nominal run is used."""
+    now = now or utcnow()
+    latest = now.floor('3h')
+    if last_processed:
+        run = pd.to_datetime(last_processed, format='%Y%m%d%H') + run_interval
+        if run > latest - pd.Timedelta('1 day'):
+            return run.strftime('%Y%m%d%H')
+
+    return latest.strftime('%Y%m%d%H')
+
+
+def steps_complete(matrix, steps):
+    """Whether all the steps of every variable (all levels) are in the availability matrix"""
+    return matrix[steps].groupby(level='variable', sort=False).all().all(axis=1)
+
+
+def watch(command=command, vars_2d=None, vars_3d=['t'], levels_3d=['850'],
+          steps=trigger_steps, last_processed=None, history_filename=history_file,
+          once=False):
+    """Wait for the next runs and execute command with the run (YYYYMMDDHH) as
+    last argument when the steps of the variables are on the server. If command
+    fails the run is tried again after retry_wait. Returns the run and the exit
+    code of command after the first attempt if once is True."""
+    history = load_history(history_filename)
+    last_processed = last_processed or get_last_run.read_last_processed()
+    failed = None
+    while True:
+        run = next_run(last_processed)
+        if failed and run != failed:
+            print_message('ERROR: run %s was never processed successfully, moving to run %s' % (failed, run))
+        run_time = pd.to_datetime(run, format='%Y%m%d%H')
+        following = (run_time + run_interval).strftime('%Y%m%d%H')
+        window = predict_window(history, run)
+        print_message('Waiting for run %s, expected between %s and %s' % (
+            run, window[0].strftime('%H:%M'), window[1].strftime('%H:%M')))
+        # Variables that were seen incomplete: only for these the latency is measured,
+        # otherwise we don't know when the files appeared
+        incomplete = set()
+        late = False
+        while True:
+            now = utcnow()
+            # Once the run is late the following one is checked too
+            runs = [run, following] if now - run_time > give_up else [run]
+            try:
+                matrices = get_last_run.get_availability(runs, vars_2d=vars_2d, vars_3d=vars_3d,
+                                                         levels_3d=levels_3d)
+            except Exception as e:
+                print_message('WARNING: listing failed (%s)' % e)
+                time_module.sleep(fast_poll)
+                continue
+            complete = steps_complete(matrices[run], steps)
+            for var, done in complete.items():
+                if not done:
+                    incomplete.add(var)
+                elif var in incomplete:
+                    incomplete.discard(var)
+                    record_latency(history, run, var, (now - run_time) / pd.Timedelta('1 minute'))
+                    save_history(history, history_filename)
+            if complete.all():
+                break
+            if len(runs) > 1:
+                missing = ', '.join(complete.index[~complete.values])
+                if steps_complete(matrices[following], steps).all():
+                    print_message('ERROR: run %s still incomplete (%s), processing run %s instead' % (
+                        run, missing, following))
+                    run = following
+                    break
+                if not late:
+                    print_message('ERROR: run %s still incomplete (%s) after %s, waiting for it or for run %s' % (
+                        run, missing, give_up, following))
+                    late = True
+            time_module.sleep(next_poll(utcnow(), window))
+        print_message('Run %s available, starting %s' % (run, command))
+        returncode = subprocess.run('%s %s' % (command, run), shell=True).returncode
+        if returncode == 0:
+            print_message('Run %s processed' % run)
+            last_processed, failed = run, None
+        else:
+            print_message('ERROR: %s exited with code %d for run %s, trying again in %d minutes' % (
+                command, returncode, run, retry_wait // 60))
+            failed = run
+        if once:
+            return run, returncode
+        if failed:
+            time_module.sleep(retry_wait)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--command', help='Command executed when a run is complete',
+                        required=False, default=command)
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be checked',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checked',
+                        required=False, default=['t'], nargs='+')
+    parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
+                        required=False, default=['850'], nargs='+')
+    parser.add_argument('-s', '--steps', help='Forecast steps that must be available to start the command (default the first one)',
+                        required=False, default=trigger_steps, nargs='+', type=int)
+    parser.add_argument('--once', help='Exit after the next run',
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    run, returncode = watch(command=args.command, vars_2d=args.vars_2d, vars_3d=args.vars_3d,
+                            levels_3d=args.levels_3d, steps=args.steps, once=args.once)
+    sys.exit(returncode)